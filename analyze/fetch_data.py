@@ -1,18 +1,35 @@
+import json
+
 import requests
 
-def fetch_data(url):
+def fetch_data(url, retries=3):
     """
     Fetch data from the specified URL.
 
+    The measurements are streamed as NDJSON. If the connection breaks, the download is resumed after
+    the last received measurement.
+
     Args:
         url (str): URL to fetch data from.
+        retries (int): Number of times an interrupted download is resumed. Default is 3.
 
     Returns:
         list: Fetched data as a list of dictionaries, or None if fetching fails.
     """
-    response = requests.get(url)
-    if response.status_code == 200:
-        return response.json()
-    else:
-        print(f"Failed to fetch data. Status code: {response.status_code}")
-        return None
+    data = []
+    for attempt in range(retries + 1):
+        params = {"format": "ndjson"}
+        if data:
+            params["after_id"] = data[-1]["measurement_id"]
+        try:
+            with requests.get(url, params=params, stream=True) as response:
+                if response.status_code != 200:
+                    print(f"Failed to fetch data. Status code: {response.status_code}")
+                    return None
+                for line in response.iter_lines():
+                    if line:
+                        data.append(json.loads(line))
+            return data
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+            print(f"Connection lost after {len(data)} measurements (attempt {attempt + 1} of {retries + 1}): {e}")
+    return None
@@ -3,7 +3,7 @@ import os
 import datetime
 import yaml
 from fetch_data import fetch_data
-from process_data import compare_predictions, write_to_csv
+from process_data import compare_predictions, evaluate_predictions, write_to_csv
 
 
 def load_config(config_path='config.yaml'):
@@ -52,6 +52,7 @@ def main():
     config = load_config()
     url_fetch = config['url_fetch']
     url_predict = config['url_predict']
+    url_evaluate = config.get('url_evaluate')
     num_measurements = config['num_measurements']
     parameter_sets = config['parameter_sets']
     rooms = config.get('rooms', [])
@@ -69,8 +70,13 @@ def main():
         for step, parameters in enumerate(parameter_sets, start=1):
             api_parameters = parameters["parameters"]
             parameter_names = list(api_parameters.keys()) + ["algorithm_value"]
-            results = compare_predictions(data, num_measurements, url_predict, api_parameters, parameter_names, rooms,
-                                          corridors)
+            # Random subsets per measurement are only supported by the per-measurement predictions
+            uses_subsets = "measurements_per_room" in api_parameters or "measurements_per_corridor" in api_parameters
+            if url_evaluate and not uses_subsets:
+                results = evaluate_predictions(data, num_measurements, url_evaluate, api_parameters, rooms, corridors)
+            else:
+                results = compare_predictions(data, num_measurements, url_predict, api_parameters, parameter_names,
+                                              rooms, corridors)
             filename = os.path.join(output_dir, f"{parameters['name']}.csv")
             write_to_csv(results, filename, parameter_names)
             print(f"Results have been written to {filename}")
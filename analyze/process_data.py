@@ -186,6 +186,60 @@ def compare_predictions(data, num_measurements, url_predict, parameters, paramet
 
     return results
 
+def evaluate_predictions(data, num_measurements, url_evaluate, parameters, rooms, corridors, timeout=3600):
+    """
+    Compare predictions with actual room names using the leave-one-out evaluation of the API.
+
+    Every parameter combination is evaluated with a single request instead of one request per
+    measurement. The returned rows have the same layout as those of compare_predictions.
+
+    Args:
+        data (list): List of data elements.
+        num_measurements (int): Number of measurements to process.
+        url_evaluate (str): URL for the evaluation API.
+        parameters (dict): Dictionary of parameter values.
+        rooms (list): List of room names.
+        corridors (list): List of corridor names.
+        timeout (int): Timeout for one evaluation request.
+
+    Returns:
+        list: Results of the comparison.
+    """
+    if rooms and corridors:
+        data = [data_element for data_element in data if data_element['room_name'] in rooms]
+
+    if num_measurements > 0:
+        data = data[:num_measurements]
+
+    measurement_ids = [measurement['measurement_id'] for measurement in data]
+    results = []
+
+    for param_values in generate_parameter_combinations(parameters):
+        payload = {"measurement_ids": measurement_ids}
+        payload.update(param_values)
+
+        start_time = time.time()
+        try:
+            response_evaluate = requests.post(url_evaluate, json=payload, timeout=timeout)
+        except requests.exceptions.RequestException as e:
+            print(f"An error occurred: {e}")
+            continue
+
+        if response_evaluate.status_code != 200:
+            print(f"Failed to send data. Status code: {response_evaluate.status_code}")
+            continue
+
+        params_str = ", ".join(f"{name}={value}" for name, value in param_values.items())
+        print(f"Evaluated params ({params_str}) (took {time.time() - start_time:.2f} seconds)")
+
+        for row in response_evaluate.json():
+            results.append([
+                row['device_id'], row['measurement_id'], row['room_name'], row['room_id'], row['predict_room'],
+                row['distance'], *param_values.values(), row['duration'], row['correct']
+            ])
+
+    return results
+
 def write_to_csv(results, filename, parameter_names):
     """
     Write results to a CSV file.
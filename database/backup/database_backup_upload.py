@@ -17,6 +17,10 @@ port = 8000
 ping_url = f"http://{current_ip}:{port}/ping"
 reset_url = f"http://{current_ip}:{port}/measurements/reset"
 measurements_url = f"http://{current_ip}:{port}/measurements/add"
+measurements_bulk_url = f"http://{current_ip}:{port}/measurements/add/bulk"
+
+# Number of measurements sent per bulk request
+batch_size = 500
 
 # measurements_url = f"http://{current_ip}:{port}/measurements/add"
 
@@ -78,12 +82,15 @@ def exit_on_failure(response, step_name):
 # exit_on_failure(reset_response, "Database reset")
 # print("Database reset successful.")
 
-# Send data to the API
-for entry in json_list:
-    print(entry)
-    response = requests.post(measurements_url, json=entry)
-    if response.status_code == 200:
-        print(f"Successfully sent: {entry}")
-    else:
+# Send data to the API in batches
+for start in range(0, len(json_list), batch_size):
+    batch = json_list[start:start + batch_size]
+    response = requests.post(measurements_bulk_url, json={"measurements": batch})
+    if response.status_code != 200:
         print(f"Error sending data: {response.status_code}, {response.text}")
         # exit(1)
+        continue
+    print(response.json()["message"])
+    for result in response.json()["results"]:
+        if result["status"] != "created":
+            print(f"Not added: {batch[result['index']]}, {result['status']}: {result.get('detail')}")
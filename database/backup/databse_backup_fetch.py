@@ -1,5 +1,6 @@
 import requests
 import csv
+import json
 from datetime import datetime
 
 # IP addresses
@@ -12,22 +13,41 @@ url_fetch = f"http://{current_ip}:5000/measurements/all"
 
 # url_fetch_reset = f"http://{current_ip}:5000/measurements/reset"
 
-def fetch_data(url):
+def fetch_data(url, retries=3):
     """
-    Fetch data from the given URL.
+    Fetch the measurements from the given URL as a stream.
+
+    The measurements are streamed as NDJSON and yielded one by one. If the connection breaks, the
+    download is resumed after the last received measurement.
 
     Args:
         url (str): The URL to fetch data from.
+        retries (int): Number of times an interrupted download is resumed. Default is 3.
 
-    Returns:
-        dict: The JSON response from the URL.
+    Yields:
+        dict: One measurement.
 
     Raises:
         requests.HTTPError: If an HTTP error occurs.
     """
-    response = requests.get(url)
-    response.raise_for_status()  # Error handling for HTTP requests
-    return response.json()
+    after_id = None
+    for attempt in range(retries + 1):
+        params = {"format": "ndjson"}
+        if after_id is not None:
+            params["after_id"] = after_id
+        try:
+            with requests.get(url, params=params, stream=True) as response:
+                response.raise_for_status()  # Error handling for HTTP requests
+                for line in response.iter_lines():
+                    if line:
+                        measurement = json.loads(line)
+                        after_id = measurement["measurement_id"]
+                        yield measurement
+            return
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+            if attempt == retries:
+                raise
+            print(f"Connection lost after measurement {after_id}, resuming: {e}")
 
 # def format_timestamp(timestamp):
 #     """
@@ -60,15 +80,18 @@ def save_to_csv(data, filename):
     Save the given data to a CSV file.
 
     Args:
-        data (list): The data to save.
+        data (iterable): The data to save.
         filename (str): The name of the CSV file.
     """
+    data = iter(data)
+    first_row = next(data)
     # Determine headers from the keys of the first element
-    headers = data[0].keys()
+    headers = first_row.keys()
 
     with open(filename, mode='w', newline='') as file:
         writer = csv.DictWriter(file, fieldnames=headers)
         writer.writeheader()
+        writer.writerow(first_row)
         for row in data:
             # Reformat timestamp
             # row['timestamp'] = format_timestamp(row['timestamp'])
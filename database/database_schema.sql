@@ -4,6 +4,7 @@ CREATE DATABASE wifi_fingerprints;
 
 USE wifi_fingerprints;
 
+DROP TABLE IF EXISTS measurement_changes;
 DROP TABLE IF EXISTS measurement_router;
 DROP TABLE IF EXISTS measurements;
 DROP TABLE IF EXISTS routers;
@@ -42,3 +43,10 @@ CREATE TABLE measurement_router (
       FOREIGN KEY (measurement_id) REFERENCES measurements(measurement_id),
       FOREIGN KEY (router_id) REFERENCES routers(router_id)
 );
+
+CREATE TABLE measurement_changes (
+      change_id INT AUTO_INCREMENT PRIMARY KEY,
+      measurement_id INT,
+      change_type VARCHAR(16) NOT NULL,
+      generation VARCHAR(32)
+);
@@ -0,0 +1,175 @@
+import asyncio
+import functools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from prometheus_client import Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+CPU_BUDGET = int(os.getenv("CPU_BUDGET", str(os.cpu_count() or 1)))
+COMPUTE_POOL_WORKERS = int(os.getenv("COMPUTE_POOL_WORKERS", str(CPU_BUDGET)))
+
+COMPUTE_POOL_QUEUE_DEPTH = Gauge(
+    "compute_pool_queue_depth",
+    "Number of tasks waiting for a worker of the compute pool"
+)
+COMPUTE_POOL_ACTIVE = Gauge(
+    "compute_pool_active_tasks",
+    "Number of tasks currently running in the compute pool"
+)
+CPU_BUDGET_IN_USE = Gauge(
+    "cpu_budget_in_use",
+    "Number of CPUs of the CPU budget currently reserved"
+)
+COMPUTE_POOL_WAIT_SECONDS = Histogram(
+    "compute_pool_wait_seconds",
+    "Time a task waited in the queue of the compute pool",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+COMPUTE_POOL_RUN_SECONDS = Histogram(
+    "compute_pool_run_seconds",
+    "Time a task ran in the compute pool",
+    buckets=(0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+)
+
+
+class CpuBudget:
+    """
+    CpuBudget is a counting semaphore over the CPUs the server may keep busy with model work.
+
+    Every task of the compute pool holds one CPU while it runs. Work that can use more threads, such as
+    random forest training, reserves additional CPUs without waiting and only gets what is free, so a
+    parallel fit never oversubscribes the machine while other predictions are running.
+
+    Attributes:
+    - cpus (int): Size of the budget.
+    """
+
+    def __init__(self, cpus=CPU_BUDGET):
+        self.cpus = max(1, cpus)
+        self._available = self.cpus
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, count=1, blocking=True):
+        """
+        Reserve CPUs for the duration of a with block.
+
+        Parameters:
+        count (int): Number of CPUs to reserve. Default is 1.
+        blocking (bool): Wait until count CPUs are free. If False, reserve as many as are free right now,
+                         up to count. Default is True.
+
+        Yields:
+        int: Number of CPUs reserved.
+        """
+        count = min(max(0, count), self.cpus)
+        with self._condition:
+            if blocking:
+                self._condition.wait_for(lambda: self._available >= count)
+                granted = count
+            else:
+                granted = min(count, self._available)
+            self._available -= granted
+        CPU_BUDGET_IN_USE.inc(granted)
+        try:
+            yield granted
+        finally:
+            CPU_BUDGET_IN_USE.dec(granted)
+            with self._condition:
+                self._available += granted
+                self._condition.notify_all()
+
+
+class ComputePool:
+    """
+    ComputePool runs the CPU-heavy part of the prediction endpoints on a dedicated thread pool.
+
+    Sync endpoints share AnyIO's threadpool, so a slow model fit there delays every other sync
+    endpoint. The prediction endpoints are async and await this pool instead; the rest of the API
+    keeps the default threadpool to itself. A thread pool is used because the training data and the
+    fitted models live in this process (snapshot, model registry) and the expensive stages (numpy,
+    libsvm, tree building) release the GIL for most of their runtime.
+
+    Attributes:
+    - max_workers (int): Number of worker threads.
+    """
+
+    def __init__(self, max_workers=COMPUTE_POOL_WORKERS):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="compute")
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._active = 0
+        self._started = 0
+        self._completed = 0
+        self._total_wait = 0.0
+
+    def _run(self, function, submitted_at):
+        with cpu_budget.reserve(1):
+            return self._run_reserved(function, submitted_at)
+
+    def _run_reserved(self, function, submitted_at):
+        wait = time.perf_counter() - submitted_at
+        with self._lock:
+            self._queued -= 1
+            self._active += 1
+            self._started += 1
+            self._total_wait += wait
+        COMPUTE_POOL_QUEUE_DEPTH.dec()
+        COMPUTE_POOL_ACTIVE.inc()
+        COMPUTE_POOL_WAIT_SECONDS.observe(wait)
+
+        start_time = time.perf_counter()
+        try:
+            return function()
+        finally:
+            COMPUTE_POOL_RUN_SECONDS.observe(time.perf_counter() - start_time)
+            COMPUTE_POOL_ACTIVE.dec()
+            with self._lock:
+                self._active -= 1
+                self._completed += 1
+
+    async def run(self, function, *args, **kwargs):
+        """
+        Run a function on the pool and wait for its result without blocking the event loop.
+
+        Parameters:
+        function (callable): The function to run.
+        *args: Positional arguments for the function.
+        **kwargs: Keyword arguments for the function.
+
+        Returns:
+        object: The return value of the function.
+        """
+        with self._lock:
+            self._queued += 1
+        COMPUTE_POOL_QUEUE_DEPTH.inc()
+        call = functools.partial(function, *args, **kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._run, call, time.perf_counter())
+
+    def stats(self):
+        """
+        Return the current state of the pool.
+
+        Returns:
+        dict: Number of workers, queued, active and completed tasks, and the mean queue wait in seconds.
+        """
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "queued": self._queued,
+                "active": self._active,
+                "completed": self._completed,
+                "mean_wait_seconds": self._total_wait / self._started if self._started else 0.0
+            }
+
+
+cpu_budget = CpuBudget()
+compute_pool = ComputePool()
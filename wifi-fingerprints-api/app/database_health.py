@@ -0,0 +1,168 @@
+import logging
+import os
+import threading
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
+
+DB_BREAKER_FAILURE_THRESHOLD = int(os.getenv("DB_BREAKER_FAILURE_THRESHOLD", "3"))
+DB_BREAKER_RESET_TIMEOUT = float(os.getenv("DB_BREAKER_RESET_TIMEOUT", "10"))
+
+DB_POOL_CHECKOUT_SECONDS = Histogram(
+    "db_pool_checkout_seconds",
+    "Time spent waiting for a connection from the database pool, including opening new connections",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+DB_POOL_CONNECTIONS_IN_USE = Gauge(
+    "db_pool_connections_in_use",
+    "Number of database connections checked out of the pool"
+)
+DB_POOL_CONNECTIONS_IDLE = Gauge(
+    "db_pool_connections_idle",
+    "Number of open database connections waiting in the pool"
+)
+DB_CIRCUIT_OPEN = Gauge(
+    "db_circuit_open",
+    "1 while the database circuit breaker rejects requests, 0 otherwise"
+)
+DB_CIRCUIT_REJECTED = Counter(
+    "db_circuit_rejected",
+    "Requests that did not try the database because the circuit breaker was open"
+)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    InstrumentedQueuePool is a QueuePool that records how long a checkout waits for a connection.
+    """
+
+    def _do_get(self):
+        start_time = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT_SECONDS.observe(time.perf_counter() - start_time)
+
+
+def instrument_pool(pool):
+    """
+    Export the number of used and idle connections of a pool as Prometheus gauges.
+
+    Parameters:
+    pool (QueuePool): The connection pool of the engine.
+    """
+    DB_POOL_CONNECTIONS_IN_USE.set_function(pool.checkedout)
+    DB_POOL_CONNECTIONS_IDLE.set_function(pool.checkedin)
+
+
+class DatabaseUnavailableError(Exception):
+    """
+    Raised instead of connecting to the database while the circuit breaker is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    CircuitBreaker stops requests from waiting on a database that is down.
+
+    After failure_threshold consecutive connection failures the breaker opens: requests fail at once
+    instead of each one waiting for a connection timeout. Every reset_timeout seconds a single request
+    is let through as a trial; the first successful checkout of a connection closes the breaker again,
+    a failure keeps it open.
+
+    Attributes:
+    - failure_threshold (int): Number of consecutive failures that open the breaker.
+    - reset_timeout (float): Seconds between two trial requests while the breaker is open.
+    """
+
+    def __init__(self, failure_threshold=DB_BREAKER_FAILURE_THRESHOLD, reset_timeout=DB_BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self.opened = 0
+        self.rejected = 0
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def allow_request(self):
+        """
+        Return whether a request may use the database, letting through one trial request per reset_timeout
+        while the breaker is open.
+
+        Returns:
+        bool: True if the request may use the database.
+        """
+        if self._opened_at is None:
+            return True
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self._opened_at >= self.reset_timeout:
+                self._opened_at = now
+                logger.info("Database circuit breaker lets a trial request through")
+                return True
+            self.rejected += 1
+        DB_CIRCUIT_REJECTED.inc()
+        return False
+
+    def check(self):
+        """
+        Raise DatabaseUnavailableError if the request may not use the database, see allow_request.
+        """
+        if not self.allow_request():
+            raise DatabaseUnavailableError("The database is unavailable")
+
+    def record_success(self):
+        """
+        Record a successful connection checkout, closing the breaker.
+        """
+        if self._failures == 0 and self._opened_at is None:
+            return
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("Database is available again, circuit breaker closed")
+            self._failures = 0
+            self._opened_at = None
+        DB_CIRCUIT_OPEN.set(0)
+
+    def record_failure(self):
+        """
+        Record a failed database access, opening the breaker after failure_threshold failures in a row.
+        """
+        with self._lock:
+            self._failures += 1
+            if self._opened_at is None and self._failures < self.failure_threshold:
+                return
+            if self._opened_at is None:
+                self.opened += 1
+                logger.error(f"Database circuit breaker opened after {self._failures} failures")
+            self._opened_at = time.monotonic()
+        DB_CIRCUIT_OPEN.set(1)
+
+    def stats(self):
+        """
+        Return the state and counters of the breaker.
+
+        Returns:
+        dict: Whether the breaker is open, consecutive failures, how often it opened and rejected requests.
+        """
+        with self._lock:
+            return {
+                'open': self._opened_at is not None,
+                'failures': self._failures,
+                'failure_threshold': self.failure_threshold,
+                'reset_timeout': self.reset_timeout,
+                'opened': self.opened,
+                'rejected': self.rejected
+            }
+
+
+database_breaker = CircuitBreaker()
@@ -0,0 +1,171 @@
+import logging
+import time
+
+import numpy as np
+
+from prediction import PREDICTION_ERRORS, select_candidate_rooms, build_training_matrix, preprocess, fit_model, \
+    predict_with_model
+from utils import prepare_received_data
+
+logger = logging.getLogger(__name__)
+
+
+def shares_training_matrix(config):
+    """
+    Return whether all folds of a leave-one-out evaluation can share one kNN model.
+
+    The folds share the preprocessed training matrix, apart from the left out row, if it does not depend
+    on the query (see model_registry.get_query_dependencies) nor on the presence counts of the routers
+    per room, which change with every left out row.
+
+    Parameters:
+    config (PredictConfig): The prediction configuration.
+
+    Returns:
+    bool: True if a single model fitted on all measurements can predict every fold.
+    """
+    return config.algorithm in ['knn_sorensen', 'knn_euclidean'] \
+        and not config.use_remove_unreceived_bssids \
+        and config.handle_missing_values_strategy != 'use_received' \
+        and config.value_scaling_strategy == 'none' \
+        and not config.router_presence_threshold \
+        and not config.candidate_rooms
+
+
+def predict_folds_with_shared_model(matrix, config, ignored, rows):
+    """
+    Predict the leave-one-out folds of several rows with one kNN model fitted on all measurements.
+
+    The neighbor search of each row skips the row itself, which gives the neighbors of a model trained on
+    the fold. Rows that are the only measurement with one of the routers are skipped: their fold has fewer
+    columns, which changes the distances.
+
+    Parameters:
+    matrix (FingerprintMatrix): The fingerprints of the snapshot.
+    config (PredictConfig): The prediction configuration, see shares_training_matrix.
+    ignored (set): IDs of measurements left out of every fold.
+    rows (list): Rows of the matrix to predict.
+
+    Returns:
+    dict: Dictionary mapping the predicted rows to their predicted room, distance and optional value.
+    """
+    X, y, mac_address_list, training_rows = matrix.select(config, {}, ignored, return_rows=True)
+    if X.shape[0] <= config.k_value:
+        return {}
+
+    present = ~np.isnan(X)
+    single_rows = set(training_rows[present[:, present.sum(axis=0) == 1].any(axis=1)].tolist())
+    rows = [row for row in rows if row not in single_rows]
+    if not rows:
+        return {}
+    training_positions = np.full(matrix.X.shape[0], -1)
+    training_positions[training_rows] = np.arange(training_rows.size)
+
+    X_new = np.vstack([prepare_received_data(matrix.get_received_data(row), mac_address_list) for row in rows])
+    try:
+        X, X_new, _ = preprocess(X, mac_address_list, config, {}, X_new)
+        model = fit_model(config, X, y)
+        predicted_rooms, distances = model.predict_with_distance(X_new, training_positions[rows])
+    except PREDICTION_ERRORS:
+        logger.exception(f"Leave-one-out prediction with a shared {config.algorithm} model failed")
+        return {}
+    return {row: (predicted_room, distance, -1)
+            for row, predicted_room, distance in zip(rows, predicted_rooms, distances)}
+
+
+def predict_fold(snapshot, config, fold_ignored, received_data):
+    """
+    Predict a left out measurement with a model trained on its fold.
+
+    Parameters:
+    snapshot (FingerprintSnapshot): The fingerprint snapshot.
+    config (PredictConfig): The prediction configuration.
+    fold_ignored (set): IDs of the measurements left out of the fold, including the predicted one.
+    received_data (dict): Dictionary mapping 'bssid' to 'signal_strength' of the left out measurement.
+
+    Returns:
+    tuple: Predicted room, distance and optional value, see predict_with_model.
+    """
+    candidate_rooms = select_candidate_rooms(snapshot, config, received_data, fold_ignored)
+    X, y, mac_address_list = build_training_matrix(snapshot.matrix, config, received_data, fold_ignored,
+                                                   candidate_rooms)
+    if X.size == 0 or y.size == 0:
+        return None, None, -1
+
+    X, X_new, _ = preprocess(X, mac_address_list, config, received_data)
+    try:
+        # Every fold has its own training set, so its model is never reused
+        model = fit_model(config, X, y, query_dependent=True)
+        return predict_with_model(config, model, X_new)[0]
+    except PREDICTION_ERRORS:
+        logger.exception(f"Prediction of a fold with {config.algorithm} failed")
+        return None, None, -1
+
+
+def leave_one_out(snapshot, config, measurement_ids=None):
+    """
+    Run a leave-one-out evaluation of the configured pipeline over the stored measurements.
+
+    Each measurement is predicted with a model trained on all other measurements, exactly as if it
+    had been sent to /measurements/predict with its own ID in ignore_measurements. The fingerprint
+    matrix of the snapshot is built once; the training set of every fold is selected from it with masks.
+    kNN configurations whose training matrix is the same for every fold fit one model for all folds, see
+    predict_folds_with_shared_model. Other configurations fit one model per fold, so the evaluation only
+    saves the HTTP overhead of sending every measurement to /measurements/predict.
+
+    Parameters:
+    snapshot (FingerprintSnapshot): The fingerprint snapshot to evaluate on.
+    config (PredictConfig): The prediction configuration. Its ignore_measurements are left out of every fold.
+    measurement_ids (list): IDs of the measurements to predict. Default is None, which predicts all of them.
+
+    Returns:
+    list: One dictionary per measurement with the columns of the analysis CSV files: 'device_id',
+          'measurement_id', 'room_name', 'room_id', 'predict_room', 'distance', 'optional_value',
+          'duration' and 'correct'.
+    """
+    matrix = snapshot.matrix
+    ignored = set(config.ignore_measurements or [])
+
+    if measurement_ids is None:
+        rows = range(matrix.X.shape[0])
+    else:
+        rows = [matrix.row_index[measurement_id] for measurement_id in measurement_ids
+                if measurement_id in matrix.row_index]
+
+    shared_predictions = {}
+    shared_duration = 0.0
+    if shares_training_matrix(config):
+        start_time = time.time()
+        shared_predictions = predict_folds_with_shared_model(matrix, config, ignored, list(rows))
+        # The shared model is fitted once, its time is split evenly over the rows it predicted
+        shared_duration = (time.time() - start_time) / max(len(shared_predictions), 1)
+
+    results = []
+    for row in rows:
+        start_time = time.time()
+        measurement_id = int(matrix.measurement_ids[row])
+        room_id = matrix.y[row]
+        received_data = matrix.get_received_data(row)
+        if row in shared_predictions:
+            predicted_room, distance, optional_value = shared_predictions[row]
+            start_time -= shared_duration
+        else:
+            predicted_room, distance, optional_value = predict_fold(snapshot, config, ignored | {measurement_id},
+                                                                    received_data)
+
+        room_name = snapshot.get_room_name(room_id)
+        predicted_room_name = snapshot.get_room_name(predicted_room)
+        results.append({
+            'device_id': matrix.device_ids[row],
+            'measurement_id': measurement_id,
+            'room_name': room_name,
+            'room_id': int(room_id),
+            'predict_room': predicted_room_name,
+            'distance': distance,
+            'optional_value': optional_value,
+            'duration': time.time() - start_time,
+            'correct': predicted_room_name == room_name
+        })
+
+    logger.info(f"Leave-one-out evaluation of {len(results)} measurements finished")
+    return results
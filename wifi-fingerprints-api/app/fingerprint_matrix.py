@@ -0,0 +1,263 @@
+import numpy as np
+
+from utils import EDUROAM_SSIDS
+
+
+class FingerprintMatrix:
+    """
+    FingerprintMatrix holds all stored fingerprints as one dense matrix with one row per measurement
+    and one column per BSSID.
+
+    The columns form a global BSSID vocabulary: the feature ID of a column is the router_id of its BSSID,
+    and columns are ordered by feature ID (routers that appear after the matrix was built are appended).
+    The per-request filters of the prediction pipeline (ignored measurements, remove_unreceived_bssids,
+    eduroam selection, rare router removal) are applied as row, column and cell masks over this column
+    space, so a training matrix contains its columns in the same order no matter which rows it was
+    selected from, and training matrices and models can be shared by all requests with the same masks.
+
+    Attributes:
+    - X (numpy.ndarray): Signal strengths, NaN where a measurement did not see a BSSID.
+    - positions (numpy.ndarray): Position of each BSSID within its measurement, -1 where it was not seen.
+    - y (numpy.ndarray): Room ID of each row.
+    - measurement_ids (numpy.ndarray): Measurement ID of each row.
+    - device_ids (list): Device ID of each row.
+    - router_ids (numpy.ndarray): Feature ID, i.e. router ID, of each column.
+    - mac_address_list (list): BSSID of each column.
+    - ssids (list): SSID of each column.
+    """
+
+    def __init__(self, X, positions, y, measurement_ids, device_ids, router_ids, mac_address_list, ssids,
+                 buffers=None):
+        self.X = X
+        self.positions = positions
+        self.y = y
+        self.measurement_ids = measurement_ids
+        self.device_ids = device_ids
+        self.router_ids = router_ids
+        self.mac_address_list = mac_address_list
+        self.ssids = ssids
+        self.column_index = {router_id: index for index, router_id in enumerate(router_ids.tolist())}
+        self.mac_address_index = {mac_address: index for index, mac_address in enumerate(mac_address_list)}
+        self.row_index = {measurement_id: index for index, measurement_id in enumerate(measurement_ids.tolist())}
+        self.eduroam_columns = np.array([ssid in EDUROAM_SSIDS for ssid in ssids], dtype=bool)
+        self.room_ids, self.room_codes = np.unique(y, return_inverse=True)
+        # X and positions may be views of larger buffers with spare rows and columns for append()
+        self._buffers = buffers
+        self._appended = False
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Build the matrix from fingerprints in long format.
+
+        Parameters:
+        rows (list): List of dictionaries containing 'measurement_id', 'room_id', 'device_id', 'router_id', 'bssid',
+                     'ssid' and 'signal_strength'.
+
+        Returns:
+        FingerprintMatrix: The matrix with rows in order of first appearance of each measurement and columns
+                           ordered by router ID.
+        """
+        row_index = {}
+        column_index = {}
+        measurement_ids = []
+        room_ids = []
+        device_ids = []
+        router_ids = []
+        mac_address_list = []
+        ssids = []
+        row_sizes = []
+        row_indices = []
+        column_indices = []
+        values = []
+        positions = []
+
+        for row in rows:
+            index = row_index.get(row['measurement_id'])
+            if index is None:
+                index = row_index[row['measurement_id']] = len(measurement_ids)
+                measurement_ids.append(row['measurement_id'])
+                room_ids.append(row['room_id'])
+                device_ids.append(row['device_id'])
+                row_sizes.append(0)
+
+            column = column_index.get(row['router_id'])
+            if column is None:
+                column = column_index[row['router_id']] = len(column_index)
+                router_ids.append(row['router_id'])
+                mac_address_list.append(row['bssid'])
+                ssids.append(row['ssid'])
+
+            row_indices.append(index)
+            column_indices.append(column)
+            values.append(row['signal_strength'])
+            positions.append(row_sizes[index])
+            row_sizes[index] += 1
+
+        order = np.argsort(np.array(router_ids, dtype=np.int64), kind='stable')
+        column_ranks = np.empty(order.size, dtype=np.intp)
+        column_ranks[order] = np.arange(order.size)
+        column_indices = column_ranks[np.array(column_indices, dtype=np.intp)]
+
+        X = np.full((len(measurement_ids), len(column_index)), np.nan)
+        X[row_indices, column_indices] = np.array(values, dtype=np.float64)
+        position_matrix = np.full(X.shape, -1, dtype=np.int32)
+        position_matrix[row_indices, column_indices] = positions
+
+        return cls(X, position_matrix, np.array(room_ids), np.array(measurement_ids, dtype=np.int64), device_ids,
+                   np.array(router_ids, dtype=np.int64)[order], [mac_address_list[column] for column in order],
+                   [ssids[column] for column in order])
+
+    def append(self, rows):
+        """
+        Return a matrix with additional measurements, without rebuilding the existing rows.
+
+        New measurements become new rows and BSSIDs that were not seen before become new columns, appended in
+        order of their router ID, so the columns of the existing matrix keep their position. The cells of
+        existing rows in new columns are missing (NaN). Rows and columns are written into spare capacity of
+        shared buffers, which grow geometrically, so appending is amortized linear in the size of the new
+        rows. The existing matrix stays valid, but append() should only be called once per matrix.
+
+        Parameters:
+        rows (list): Fingerprints of the new measurements in long format, see from_rows.
+
+        Returns:
+        FingerprintMatrix: The extended matrix.
+        """
+        new = FingerprintMatrix.from_rows(rows)
+        if new.X.shape[0] == 0:
+            return self
+
+        router_ids = self.router_ids.tolist()
+        mac_address_list = list(self.mac_address_list)
+        ssids = list(self.ssids)
+        column_index = dict(self.column_index)
+        columns = []
+        for router_id, mac_address, ssid in zip(new.router_ids.tolist(), new.mac_address_list, new.ssids):
+            if router_id not in column_index:
+                column_index[router_id] = len(router_ids)
+                router_ids.append(router_id)
+                mac_address_list.append(mac_address)
+                ssids.append(ssid)
+            columns.append(column_index[router_id])
+
+        n_rows, n_columns = self.X.shape
+        shape = (n_rows + new.X.shape[0], len(mac_address_list))
+        X_buffer, positions_buffer = self._buffers if self._buffers is not None else (None, None)
+        if self._appended or X_buffer is None or shape[0] > X_buffer.shape[0] or shape[1] > X_buffer.shape[1]:
+            capacity = (max(shape[0], 2 * n_rows), max(shape[1], 2 * n_columns))
+            X_buffer = np.full(capacity, np.nan)
+            positions_buffer = np.full(capacity, -1, dtype=np.int32)
+            X_buffer[:n_rows, :n_columns] = self.X
+            positions_buffer[:n_rows, :n_columns] = self.positions
+        self._appended = True
+
+        new_cells = np.ix_(np.arange(n_rows, shape[0]), columns)
+        X_buffer[new_cells] = new.X
+        positions_buffer[new_cells] = new.positions
+
+        return FingerprintMatrix(
+            X_buffer[:shape[0], :shape[1]],
+            positions_buffer[:shape[0], :shape[1]],
+            np.concatenate([self.y, new.y]),
+            np.concatenate([self.measurement_ids, new.measurement_ids]),
+            self.device_ids + new.device_ids,
+            np.array(router_ids, dtype=np.int64),
+            mac_address_list,
+            ssids,
+            buffers=(X_buffer, positions_buffer)
+        )
+
+    def get_received_data(self, row):
+        """
+        Return a stored measurement in the format of process_received_data.
+
+        Parameters:
+        row (int): Row index of the measurement.
+
+        Returns:
+        dict: Dictionary mapping 'bssid' to 'signal_strength', sorted by BSSID.
+        """
+        columns = np.flatnonzero(self.positions[row] >= 0)
+        received_data = {self.mac_address_list[column]: self.X[row, column] for column in columns}
+        return dict(sorted(received_data.items()))
+
+    def get_received_features(self, received_data):
+        """
+        Map a query onto the vocabulary.
+
+        BSSIDs that are not in the vocabulary cannot be part of any training matrix, so the training
+        matrix and the model of a request only depend on the query through the returned features.
+
+        Parameters:
+        received_data (dict): Dictionary mapping 'bssid' to 'signal_strength' of the query.
+
+        Returns:
+        dict: Dictionary mapping the feature ID of each known BSSID to its signal strength, sorted by feature ID.
+        """
+        features = {int(self.router_ids[self.mac_address_index[mac_address]]): signal_strength
+                    for mac_address, signal_strength in received_data.items() if mac_address in self.mac_address_index}
+        return dict(sorted(features.items()))
+
+    def select(self, config, received_data, ignore_measurements=None, room_ids=None, return_rows=False):
+        """
+        Apply the configured fingerprint filters and return the raw training matrix.
+
+        Parameters:
+        config (PredictConfig): The prediction configuration.
+        received_data (dict): Dictionary mapping 'bssid' to 'signal_strength' of the query.
+        ignore_measurements (iterable): Measurement IDs to leave out. Default is None.
+        room_ids (iterable): Only keep the measurements of these rooms. Default is None, which keeps all rooms.
+        return_rows (bool): Whether to also return the indices of the selected rows. Default is False.
+
+        Returns:
+        tuple: Feature matrix (NaN for missing values), target labels, and list of MAC addresses. Rows are
+               grouped by room, rooms in the order of their first selected measurement. Columns are the
+               columns of the vocabulary that are present in the selected rows, in vocabulary order. With
+               return_rows, the indices of the selected rows of this matrix follow in the order of the
+               feature matrix.
+        """
+        rows = np.ones(self.X.shape[0], dtype=bool)
+        if ignore_measurements:
+            rows &= ~np.isin(self.measurement_ids, np.fromiter(ignore_measurements, dtype=np.int64))
+        if room_ids is not None:
+            rows &= np.isin(self.y, list(room_ids))
+
+        # Rooms are ordered by their first measurement that was not ignored
+        room_order = np.full(self.room_ids.size, rows.size)
+        np.minimum.at(room_order, self.room_codes[rows], np.flatnonzero(rows))
+
+        columns = np.ones(self.X.shape[1], dtype=bool)
+        if config.use_remove_unreceived_bssids:
+            received_columns = [self.mac_address_index[mac] for mac in received_data if mac in self.mac_address_index]
+            columns = np.zeros(self.X.shape[1], dtype=bool)
+            columns[received_columns] = True
+        if config.router_selection == 'eduroam':
+            columns &= self.eduroam_columns
+
+        present = (self.positions >= 0) & rows[:, None] & columns[None, :]
+        rows &= present.any(axis=1)
+
+        if config.router_presence_threshold > 0:
+            room_rows = np.zeros((self.room_ids.size, rows.size))
+            room_rows[self.room_codes[rows], np.flatnonzero(rows)] = 1
+            router_counts = room_rows @ present
+            min_required_counts = config.router_presence_threshold * room_rows.sum(axis=1)
+            rare = router_counts < min_required_counts[:, None]
+            present &= ~rare[self.room_codes]
+            rows &= present.any(axis=1)
+
+        kept_rows = np.flatnonzero(rows)
+        if kept_rows.size == 0:
+            if return_rows:
+                return np.empty((0, 0)), np.array([]), [], kept_rows
+            return np.empty((0, 0)), np.array([]), []
+        kept_rows = kept_rows[np.lexsort((kept_rows, room_order[self.room_codes[kept_rows]]))]
+        present = present[kept_rows]
+        kept_columns = np.flatnonzero(present.any(axis=0))
+
+        X = np.where(present[:, kept_columns], self.X[np.ix_(kept_rows, kept_columns)], np.nan)
+        mac_address_list = [self.mac_address_list[column] for column in kept_columns]
+        if return_rows:
+            return X, self.y[kept_rows], mac_address_list, kept_rows
+        return X, self.y[kept_rows], mac_address_list
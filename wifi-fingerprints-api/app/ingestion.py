@@ -0,0 +1,124 @@
+import logging
+from datetime import datetime
+
+from sqlalchemy import insert, select, tuple_
+from sqlalchemy.exc import IntegrityError
+
+from lookup_cache import lookup_cache
+from models import Measurement, MeasurementRouter, MeasurementChange
+
+logger = logging.getLogger(__name__)
+
+
+def find_measurement_ids(db, keys):
+    """
+    Look up the IDs of measurements by device ID and timestamp.
+
+    Parameters:
+    db (Session): The database session.
+    keys (set): Set of (device_id, timestamp) tuples.
+
+    Returns:
+    dict: Dictionary mapping (device_id, timestamp) to measurement ID for the measurements that exist.
+    """
+    if not keys:
+        return {}
+    rows = db.execute(
+        select(Measurement.device_id, Measurement.timestamp, Measurement.measurement_id)
+        .where(tuple_(Measurement.device_id, Measurement.timestamp).in_(list(keys)))
+    )
+    return {(device_id, timestamp): measurement_id for device_id, timestamp, measurement_id in rows}
+
+
+def add_measurements_bulk(db, measurements):
+    """
+    Add many measurements in one transaction.
+
+    Rooms and routers are resolved through the lookup cache; unknown ones are inserted with one
+    INSERT IGNORE and read back with one SELECT each. Measurements and their signal strengths are
+    inserted with multi-row INSERT statements. Items are validated like in /measurements/add; invalid
+    items and measurements that already exist are skipped and reported, the other items are stored
+    together, and every created measurement is logged in the change log. If the transaction fails on
+    a foreign key, e.g. because another worker reset the database and cached IDs are gone, the cache
+    is reloaded and the batch is tried once more.
+
+    Parameters:
+    db (Session): The database session.
+    measurements (list): List of MeasurementData.
+
+    Returns:
+    list: One dictionary per item with 'index', 'status' ('created', 'exists', 'duplicate' or 'invalid')
+          and 'measurement_id' or 'detail'.
+    """
+    try:
+        return _add_measurements(db, measurements)
+    except IntegrityError as e:
+        db.rollback()
+        logger.warning(f"Bulk ingestion failed, reloading the lookup cache and retrying: {e}")
+        lookup_cache.load(db)
+        return _add_measurements(db, measurements)
+
+
+def _add_measurements(db, measurements):
+    results = [None] * len(measurements)
+    pending = {}
+
+    for index, data in enumerate(measurements):
+        if not data.room_name or not data.device_id or not data.timestamp or not data.routers:
+            results[index] = {"index": index, "status": "invalid", "detail": "Missing data"}
+            continue
+        key = (data.device_id, datetime.utcfromtimestamp(data.timestamp))
+        if key in pending:
+            results[index] = {"index": index, "status": "duplicate",
+                              "detail": f"Same device_id and timestamp as item {pending[key]}"}
+            continue
+        pending[key] = index
+
+    existing = find_measurement_ids(db, set(pending))
+    for key, measurement_id in existing.items():
+        index = pending.pop(key)
+        results[index] = {"index": index, "status": "exists", "measurement_id": measurement_id,
+                          "detail": "Measurement with the same device_id and timestamp already exists"}
+
+    if pending:
+        room_ids = lookup_cache.get_room_ids(db, {measurements[index].room_name for index in pending.values()})
+
+        routers = {}
+        for index in pending.values():
+            for router_data in measurements[index].routers:
+                if router_data.bssid and router_data.signal_strength is not None:
+                    routers.setdefault(router_data.bssid, router_data.ssid)
+        router_ids = lookup_cache.get_router_ids(db, routers)
+
+        db.execute(insert(Measurement), [
+            {"device_id": device_id, "timestamp": timestamp, "room_id": room_ids[measurements[index].room_name]}
+            for (device_id, timestamp), index in pending.items()
+        ])
+        measurement_ids = find_measurement_ids(db, set(pending))
+
+        measurement_routers = []
+        for key, index in pending.items():
+            measurement_id = measurement_ids[key]
+            seen = set()
+            for router_data in measurements[index].routers:
+                if not router_data.bssid or router_data.signal_strength is None or router_data.bssid in seen:
+                    continue
+                seen.add(router_data.bssid)
+                measurement_routers.append({
+                    "measurement_id": measurement_id,
+                    "router_id": router_ids[router_data.bssid],
+                    "signal_strength": router_data.signal_strength
+                })
+            results[index] = {"index": index, "status": "created", "measurement_id": measurement_id}
+
+        if measurement_routers:
+            db.execute(insert(MeasurementRouter), measurement_routers)
+        # Logged in ascending ID order, so the in-memory fingerprints of every worker can append them
+        db.execute(insert(MeasurementChange), [
+            {"measurement_id": measurement_id, "change_type": "add"}
+            for measurement_id in sorted(measurement_ids.values())
+        ])
+
+    db.commit()
+    logger.info(f"Bulk ingestion: {len(pending)} of {len(measurements)} measurements created")
+    return results
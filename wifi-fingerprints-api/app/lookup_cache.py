@@ -0,0 +1,196 @@
+import logging
+import threading
+
+from sqlalchemy import event, insert, select
+
+from models import Room, Router, SessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+def insert_ignore(db, model):
+    """
+    Build an INSERT statement that skips rows violating a unique key.
+
+    Parameters:
+    db (Session): The database session.
+    model (Base): The model to insert into.
+
+    Returns:
+    Insert: The INSERT IGNORE statement for the dialect of the session.
+    """
+    if db.get_bind().dialect.name == 'sqlite':
+        return insert(model).prefix_with('OR IGNORE')
+    return insert(model).prefix_with('IGNORE')
+
+
+def upsert_rooms(db, room_names):
+    """
+    Insert the rooms that do not exist yet and return the IDs of all given rooms.
+
+    The IDs are read back with a locking read. A plain SELECT would read the snapshot of the transaction,
+    which under REPEATABLE READ does not contain a room committed by another worker after the transaction
+    started its first read, although INSERT IGNORE skipped it as existing.
+
+    Parameters:
+    db (Session): The database session.
+    room_names (set): Names of the rooms.
+
+    Returns:
+    dict: Dictionary mapping room name to room ID.
+    """
+    if not room_names:
+        return {}
+    db.execute(insert_ignore(db, Room), [{"room_name": room_name} for room_name in room_names])
+    rows = db.execute(select(Room.room_name, Room.room_id).where(Room.room_name.in_(room_names))
+                      .with_for_update(read=True))
+    return {room_name: room_id for room_name, room_id in rows}
+
+
+def upsert_routers(db, routers):
+    """
+    Insert the routers that do not exist yet and return the IDs of all given routers.
+
+    The SSID of an existing router is not changed. The IDs are read back with a locking read, see upsert_rooms.
+
+    Parameters:
+    db (Session): The database session.
+    routers (dict): Dictionary mapping BSSID to SSID.
+
+    Returns:
+    dict: Dictionary mapping BSSID to router ID.
+    """
+    if not routers:
+        return {}
+    db.execute(insert_ignore(db, Router), [{"bssid": bssid, "ssid": ssid} for bssid, ssid in routers.items()])
+    rows = db.execute(select(Router.bssid, Router.router_id).where(Router.bssid.in_(list(routers)))
+                      .with_for_update(read=True))
+    return {bssid: router_id for bssid, router_id in rows}
+
+
+class LookupCache:
+    """
+    LookupCache is a process-wide, write-through cache of room and router IDs for ingestion.
+
+    Known rooms and routers are resolved without a query. Unknown ones are inserted with INSERT IGNORE
+    and read back, so two workers inserting the same new BSSID at the same time both get the ID of
+    the row that won. IDs resolved inside a transaction are only published to the cache when the
+    session commits; on rollback they are discarded, as the rows may not exist.
+
+    Attributes:
+    - room_ids (dict): Dictionary mapping room name to room ID.
+    - router_ids (dict): Dictionary mapping BSSID to router ID.
+    """
+
+    def __init__(self):
+        self.room_ids = {}
+        self.router_ids = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def load(self, db):
+        """
+        Fill the cache with all rooms and routers in the database.
+
+        Parameters:
+        db (Session): The database session.
+        """
+        room_ids = {room_name: room_id for room_name, room_id in db.execute(select(Room.room_name, Room.room_id))}
+        router_ids = {bssid: router_id for bssid, router_id in db.execute(select(Router.bssid, Router.router_id))}
+        with self._lock:
+            self.room_ids = room_ids
+            self.router_ids = router_ids
+        logger.info(f"Lookup cache loaded with {len(room_ids)} rooms and {len(router_ids)} routers")
+
+    def _resolve(self, db, cache, keys, upsert, pending_key):
+        with self._lock:
+            ids = {key: cache[key] for key in keys if key in cache}
+        missing = [key for key in keys if key not in ids]
+        with self._lock:
+            self._hits += len(ids)
+            self._misses += len(missing)
+        if missing:
+            resolved = upsert(db, missing)
+            db.info.setdefault(pending_key, {}).update(resolved)
+            ids.update(resolved)
+        return ids
+
+    def get_room_ids(self, db, room_names):
+        """
+        Return the IDs of the given rooms, inserting the rooms that do not exist yet.
+
+        Parameters:
+        db (Session): The database session.
+        room_names (set): Names of the rooms.
+
+        Returns:
+        dict: Dictionary mapping room name to room ID.
+        """
+        return self._resolve(db, self.room_ids, room_names,
+                             lambda db, missing: upsert_rooms(db, set(missing)), 'pending_room_ids')
+
+    def get_router_ids(self, db, routers):
+        """
+        Return the IDs of the given routers, inserting the routers that do not exist yet.
+
+        Parameters:
+        db (Session): The database session.
+        routers (dict): Dictionary mapping BSSID to SSID.
+
+        Returns:
+        dict: Dictionary mapping BSSID to router ID.
+        """
+        return self._resolve(db, self.router_ids, routers,
+                             lambda db, missing: upsert_routers(db, {bssid: routers[bssid] for bssid in missing}),
+                             'pending_router_ids')
+
+    def publish(self, session):
+        room_ids = session.info.pop('pending_room_ids', None)
+        router_ids = session.info.pop('pending_router_ids', None)
+        with self._lock:
+            if room_ids:
+                self.room_ids.update(room_ids)
+            if router_ids:
+                self.router_ids.update(router_ids)
+
+    def discard(self, session):
+        session.info.pop('pending_room_ids', None)
+        session.info.pop('pending_router_ids', None)
+
+    def clear(self):
+        """
+        Remove all entries, e.g. after the tables were emptied.
+        """
+        with self._lock:
+            self.room_ids = {}
+            self.router_ids = {}
+        logger.info("Lookup cache cleared")
+
+    def stats(self):
+        """
+        Return the size and hit counters of the cache.
+
+        Returns:
+        dict: Number of rooms and routers, hits and misses.
+        """
+        with self._lock:
+            return {
+                "rooms": len(self.room_ids),
+                "routers": len(self.router_ids),
+                "hits": self._hits,
+                "misses": self._misses
+            }
+
+
+lookup_cache = LookupCache()
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def publish_lookup_ids(session):
+    lookup_cache.publish(session)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def discard_lookup_ids(session):
+    lookup_cache.discard(session)
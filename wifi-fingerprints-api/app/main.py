@@ -1,19 +1,34 @@
 import logging
 import os
 import time
-from fastapi import FastAPI, HTTPException, Depends, Body
+from fastapi import FastAPI, HTTPException, Depends, Body, Request, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
 from sqlalchemy.orm import Session
-from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import OperationalError, TimeoutError as SQLAlchemyTimeoutError
 from prometheus_fastapi_instrumentator import Instrumentator
-from models import Base, Room, Measurement, Router, MeasurementRouter, SessionLocal, engine
-from schemas import MeasurementData, PredictData
-from datetime import datetime
+from models import Base, Room, Measurement, Router, MeasurementRouter, MeasurementChange, SessionLocal, engine, sql_statement_counter
+from schemas import MeasurementData, MeasurementBulkData, PredictData, PredictBatchData, EvaluateData
+from snapshot import fingerprint_snapshots, ensure_generation, new_generation
+from shared_matrix import shared_matrices
+from model_registry import model_registry
+from model_store import model_store
+from database_health import DatabaseUnavailableError, database_breaker
+from neighbors import recall_tracker
+from pipeline_metrics import time_stage
+from prediction_cache import prediction_cache
+from profiling import request_profiler
+from prediction import ALGORITHMS, predict_scans
+from evaluation import leave_one_out
+from compute_pool import compute_pool
+from ingestion import add_measurements_bulk
+from lookup_cache import lookup_cache
+from measurement_reader import MEASUREMENTS_PAGE_SIZE, fetch_all_measurements, fetch_measurement, \
+    fetch_measurement_page, stream_measurements
 import numpy as np
-from typing import List
+from typing import List, Optional
 
-from utils import process_received_data, remove_non_eduroam_bssids, remove_unreceived_bssids, process_fingerprint_data, \
-    remove_rare_routers, prepare_data, handle_missing_values, prepare_received_data, handle_router_rssi_threshold, \
-    value_scaling, knn, random_forest, svm
+from utils import process_received_data
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
@@ -59,26 +74,81 @@ Instrumentator().instrument(app).expose(app)
 
 Base.metadata.create_all(bind=engine)
 
+with SessionLocal() as session:
+    ensure_generation(session)
+    lookup_cache.load(session)
+
+@app.middleware("http")
+async def count_sql_statements(request: Request, call_next):
+    """
+    Report the number of SQL statements executed for a request in the 'X-SQL-Statements' header.
+    """
+    counter = [0]
+    token = sql_statement_counter.set(counter)
+    try:
+        response = await call_next(request)
+    finally:
+        sql_statement_counter.reset(token)
+    response.headers["X-SQL-Statements"] = str(counter[0])
+    logger.debug(f"{request.method} {request.url.path} executed {counter[0]} SQL statements")
+    return response
+
+@app.middleware("http")
+async def profile_request(request: Request, call_next):
+    """
+    Profile the request if it sends the 'X-Profile' header or is sampled, see RequestProfiler.
+
+    The name of the profile file is returned in the 'X-Profile-File' header. For streamed responses, only
+    the time until the response starts is profiled.
+    """
+    if not request_profiler.wants_profile(request):
+        return await call_next(request)
+    sampler = request_profiler.start()
+    if sampler is None:
+        return await call_next(request)
+    start_time = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        file_name = await run_in_threadpool(request_profiler.finish, sampler, request,
+                                            time.perf_counter() - start_time)
+    if file_name:
+        response.headers["X-Profile-File"] = file_name
+    return response
+
+def open_db():
+    db = SessionLocal()
+    try:
+        yield db
+    except OperationalError:
+        database_breaker.record_failure()
+        raise
+    finally:
+        db.close()
+
 def get_db():
-    retries = 5  # Anzahl der Versuche, die Verbindung wiederherzustellen
-    delay = 5    # Sekunden, die zwischen den Versuchen gewartet wird
+    """
+    Provide a database session, failing at once with 503 while the database circuit breaker is open.
+    """
+    database_breaker.check()
+    yield from open_db()
 
-    db = None
-    for attempt in range(retries):
-        try:
-            db = SessionLocal()
-            yield db
-            break  # Erfolgreiche Verbindung, Schleife verlassen
-        except OperationalError as e:
-            if attempt < retries - 1:
-                logger.warning(f"Verbindung zur Datenbank fehlgeschlagen. Versuch {attempt + 1} von {retries}. Fehler: {e}")
-                time.sleep(delay)
-            else:
-                logger.error(f"Verbindung zur Datenbank fehlgeschlagen nach {retries} Versuchen. Fehler: {e}")
-                raise
-        finally:
-            if db:
-                db.close()
+def get_db_if_available():
+    """
+    Provide a database session like get_db, or None while the database circuit breaker is open.
+    """
+    if not database_breaker.allow_request():
+        yield None
+        return
+    yield from open_db()
+
+@app.exception_handler(DatabaseUnavailableError)
+@app.exception_handler(OperationalError)
+@app.exception_handler(SQLAlchemyTimeoutError)
+async def database_unavailable(request: Request, exc: Exception):
+    logger.warning(f"Database unavailable for {request.method} {request.url.path}: {exc}")
+    return JSONResponse(status_code=503, content={"detail": "Database unavailable"},
+                        headers={"Retry-After": str(int(database_breaker.reset_timeout))})
 
 @app.get("/")
 def read_root():
@@ -88,73 +158,95 @@ def read_root():
 def health():
     return {"status": "ok"}
 
+@app.get("/cache/stats", response_model=dict)
+def get_cache_stats():
+    return {
+        "snapshot": fingerprint_snapshots.stats(),
+        "shared_matrix": shared_matrices.stats(),
+        "model_registry": model_registry.stats(),
+        "compute_pool": compute_pool.stats(),
+        "lookup_cache": lookup_cache.stats(),
+        "model_store": model_store.stats(),
+        "prediction_cache": prediction_cache.stats(),
+        "knn_index_recall": recall_tracker.stats(),
+        "profiler": request_profiler.stats(),
+        "database": database_breaker.stats()
+    }
+
+@app.post("/profiling", response_model=dict)
+def set_profiling(sample_rate: float):
+    if not 0 <= sample_rate <= 1:
+        raise HTTPException(status_code=400, detail="sample_rate must be between 0 and 1")
+    request_profiler.sample_rate = sample_rate
+    logger.info(f"Profiling sample rate set to {sample_rate}")
+    return request_profiler.stats()
+
 @app.post("/measurements/add", response_model=dict)
 def add_measurement(data: MeasurementData, db: Session = Depends(get_db)):
     logger.info("Adding new measurement")
-    room_name = data.room_name
-    device_id = data.device_id
-    timestamp = data.timestamp  # Expecting timestamp in seconds
-    routers = data.routers
+    result = add_measurements_bulk(db, [data])[0]
 
-    if not room_name or not device_id or not timestamp or not routers:
+    if result["status"] == "invalid":
         logger.error("Missing data in request")
         raise HTTPException(status_code=400, detail="Missing data")
-
-    room = db.query(Room).filter_by(room_name=room_name).first()
-    if not room:
-        room = Room(room_name=room_name)
-        db.add(room)
-        db.commit()
-        db.refresh(room)
-
-    # Convert the timestamp from seconds to a datetime object
-    timestamp_obj = datetime.utcfromtimestamp(timestamp)
-    existing_measurement = db.query(Measurement).filter_by(device_id=device_id, timestamp=timestamp_obj).first()
-    if existing_measurement:
+    if result["status"] == "exists":
         logger.info("Measurement already exists")
         raise HTTPException(status_code=409, detail="Measurement with the same device_id and timestamp already exists")
 
-    measurement = Measurement(
-        timestamp=timestamp_obj,
-        device_id=device_id,
-        room_id=room.room_id
-    )
-    db.add(measurement)
-    db.commit()
-    db.refresh(measurement)
-
-    for router_data in routers:
-        bssid = router_data.bssid
-        ssid = router_data.ssid
-        signal_strength = router_data.signal_strength
-
-        if not bssid or signal_strength is None:
-            continue
-
-        router = db.query(Router).filter_by(bssid=bssid).first()
-        if not router:
-            router = Router(bssid=bssid, ssid=ssid)
-            db.add(router)
-            db.commit()
-            db.refresh(router)
-
-        measurement_router = MeasurementRouter(
-            measurement_id=measurement.measurement_id,
-            router_id=router.router_id,
-            signal_strength=signal_strength
-        )
-        db.add(measurement_router)
-
-    db.commit()
+    fingerprint_snapshots.request_sync()
+    model_registry.clear()
+    prediction_cache.clear()
     logger.info("Measurement added successfully")
     return {"message": "Measurement added successfully"}
 
+@app.post("/measurements/add/bulk", response_model=dict)
+def add_measurement_bulk(data: MeasurementBulkData, db: Session = Depends(get_db)):
+    logger.info(f"Adding {len(data.measurements)} measurements")
+    results = add_measurements_bulk(db, data.measurements)
+    created = sum(result["status"] == "created" for result in results)
+    if created:
+        fingerprint_snapshots.request_sync()
+        model_registry.clear()
+        prediction_cache.clear()
+    logger.info(f"{created} measurements added successfully")
+    return {"message": f"{created} of {len(results)} measurements added", "results": results}
+
+async def load_snapshot(db, algorithm):
+    """
+    Return the fingerprint snapshot for a prediction. While the database is unavailable, the loaded
+    snapshot is used even if it may be outdated; only without a loaded snapshot the request fails.
+    """
+    if db is not None:
+        # A miss means that the snapshot is loaded or updated from the database
+        cache = 'hit' if fingerprint_snapshots.is_current() else 'miss'
+        try:
+            with time_stage('snapshot', algorithm, cache):
+                return await run_in_threadpool(fingerprint_snapshots.get, db)
+        except OperationalError as e:
+            database_breaker.record_failure()
+            logger.warning(f"Could not update the fingerprint snapshot: {e}")
+
+    snapshot = fingerprint_snapshots.get_stale()
+    if snapshot is None:
+        raise DatabaseUnavailableError("No fingerprint snapshot is loaded and the database is unavailable")
+    logger.warning(f"Database unavailable, predicting with snapshot version {snapshot.version}")
+    return snapshot
+
+def check_algorithm(algorithm):
+    """
+    Reject unknown algorithms before they reach the pipeline, where they would fail the request and
+    be used as the algorithm label of the pipeline metrics.
+    """
+    if algorithm not in ALGORITHMS:
+        logger.error(f"Invalid algorithm {algorithm!r} in request")
+        raise HTTPException(status_code=400, detail=f"Invalid algorithm. Must be one of {ALGORITHMS}")
+
 @app.post("/measurements/predict", response_model=dict)
-def predict_room(
+async def predict_room(
     data: PredictData = Body(
         example=EXAMPLE_PREDICT_DATA
     ),
-    db: Session = Depends(get_db)
+    db: Optional[Session] = Depends(get_db_if_available)
 ):
     logger.info("Predicting room")
     print(data)
@@ -166,143 +258,77 @@ def predict_room(
         logger.error("Missing data in request")
         raise HTTPException(status_code=400, detail="Missing data")
 
-    # Extract configuration parameters from request data
-    use_remove_unreceived_bssids = data.use_remove_unreceived_bssids
-    handle_missing_values_strategy = data.handle_missing_values_strategy
-    router_selection = data.router_selection
-    router_presence_threshold = data.router_presence_threshold
-    value_scaling_strategy = data.value_scaling_strategy
-    router_rssi_threshold = data.router_rssi_threshold
-    algorithm = data.algorithm
-    k_value = data.k_value
-    weights = data.weights
-    n_estimators = data.n_estimators
-    c_value = data.c_value
-    gamma_value = data.gamma_value
-    max_depth = data.max_depth
-
-    max_features = data.max_features
-
-    if max_depth == "None":
-        max_depth = None  
-
-    if max_features == "None":
-        max_features = None          
-
+    # Print sent parameters
+    print(
+        f"Parameters: algorithm={data.algorithm}, k_value={data.k_value}, weights={data.weights}, n_estimators={data.n_estimators}, c_value={data.c_value}, gamma_value={data.gamma_value}")
 
-    # Placeholder for actual data processing and prediction logic
+    check_algorithm(data.algorithm)
     received_data = process_received_data(routers)
-    measurements = db.query(Measurement).all()
-    result = []
-
-    for measurement in measurements:
-        if ignore_measurements and measurement.measurement_id in ignore_measurements:
-            logger.info(f"Ignoring measurement with ID {ignore_measurements}")
-            continue
-
-        measurement_routers = db.query(MeasurementRouter).filter_by(measurement_id=measurement.measurement_id).all()
-        for router in measurement_routers:
-            router_info = db.query(Router).filter_by(router_id=router.router_id).first()
-            result.append({
-                'measurement_id': measurement.measurement_id,
-                'timestamp': measurement.timestamp,
-                'device_id': measurement.device_id,
-                'room_id': measurement.room_id,
-                'bssid': router_info.bssid,
-                'ssid': router_info.ssid,
-                'signal_strength': router.signal_strength
-            })
-
-    rooms = process_fingerprint_data(result)
-
-    if use_remove_unreceived_bssids:
-        rooms = remove_unreceived_bssids(rooms, received_data)
-
-    if router_selection == 'eduroam':
-        rooms = remove_non_eduroam_bssids(rooms)
-
-    if router_presence_threshold > 0:
-        rooms = remove_rare_routers(rooms, threshold=router_presence_threshold)
-
-    X, y, mac_address_list = prepare_data(rooms)
+    snapshot = await load_snapshot(db, data.algorithm)
+    if ignore_measurements:
+        logger.info(f"Ignoring measurements with IDs {ignore_measurements}")
 
-    if X.size == 0 or y.size == 0:
-        return {"error": "Training data is empty. Check the input data."}, 400
+    result = (await compute_pool.run(predict_scans, snapshot, data, [received_data]))[0]
 
-    X = handle_missing_values(X, mac_address_list, received_data, handle_missing_values_strategy)
-    X_new = prepare_received_data(received_data, mac_address_list)
-    min_rssi_value = np.array(min(X.min(), X_new.min()))
+    if "error" in result:
+        return result, 400
 
-    X, X_new = handle_router_rssi_threshold(X, X_new, router_rssi_threshold=router_rssi_threshold)
-    X, X_new = value_scaling(X, X_new, min_rssi_value=min_rssi_value, value_scaling_strategy=value_scaling_strategy)
+    room_name = result["room_name"]
+    distance = result["distance"]
 
-    if X_new.size == 0:
-        raise ValueError("Received data is empty. Check the input data.")
+    # Print prediction result
+    print(f"Predicted: room_name={room_name}, distance={distance}")
 
-    # Print sent parameters
-    print(
-        f"Parameters: algorithm={algorithm}, k_value={k_value}, weights={weights}, n_estimators={n_estimators}, c_value={c_value}, gamma_value={gamma_value}")
+    logger.info(f"Predicted room name: {room_name}")
+    logger.info(f"Distance: {distance}")
 
-    optional_value = -1
+    return result
 
-    if algorithm == 'knn_sorensen':
-        predicted_room, distance = knn(X, X_new, y, k_value, metric='sorensen', weights=weights)
-    elif algorithm == 'knn_euclidean':
-        predicted_room, distance = knn(X, X_new, y, k_value, metric='euclidean', weights=weights)
-    elif algorithm == 'random_forest':
-        predicted_room, distance = random_forest(X, X_new, y, n_estimators, max_depth, max_features)
-    elif algorithm == 'svm_linear':
-        predicted_room, distance, optional_value = svm(X, X_new, y, C=c_value, kernel='linear', gamma=gamma_value)
-    elif algorithm == 'svm_rbf':
-        predicted_room, distance, optional_value = svm(X, X_new, y, C=c_value, kernel='rbf', gamma=gamma_value)
+@app.post("/measurements/predict/batch", response_model=List[dict])
+async def predict_room_batch(data: PredictBatchData, db: Optional[Session] = Depends(get_db_if_available)):
+    logger.info(f"Predicting rooms for {len(data.scans)} scans")
+    scans = data.scans
 
-    room_name = handle_get_room_name_by_id(predicted_room, db)
+    if not scans or any(not routers for routers in scans):
+        logger.error("Missing data in request")
+        raise HTTPException(status_code=400, detail="Missing data")
 
-    # Print prediction result
-    print(f"Predicted: room_name={room_name}, distance={distance}")
+    check_algorithm(data.algorithm)
+    received_scans = [process_received_data(routers) for routers in scans]
+    snapshot = await load_snapshot(db, data.algorithm)
+    results = await compute_pool.run(predict_scans, snapshot, data, received_scans)
 
-    logger.info(f"Predicted room: {predicted_room}")
-    logger.info(f"Predicted room name: {room_name}")
-    logger.info(f"Distance: {distance}")
+    logger.info(f"Predicted rooms for {len(results)} scans")
+    return results
 
-    return {"room_name": room_name, "distance": distance, "optional_value": optional_value}
+@app.post("/measurements/evaluate", response_model=List[dict])
+async def evaluate_leave_one_out(data: EvaluateData, db: Optional[Session] = Depends(get_db_if_available)):
+    logger.info("Running leave-one-out evaluation")
+    check_algorithm(data.algorithm)
+    snapshot = await load_snapshot(db, data.algorithm)
+    results = await compute_pool.run(leave_one_out, snapshot, data, data.measurement_ids)
+    logger.info(f"Evaluated {len(results)} measurements")
+    return results
 
 @app.get("/measurements/all", response_model=List[dict])
-def get_all_measurements(db: Session = Depends(get_db)):
-    logger.info("Fetching all measurements")
-    measurements = db.query(
-        Measurement.measurement_id,
-        Measurement.timestamp,
-        Measurement.device_id,
-        Measurement.room_id,
-        Room.room_name
-    ).join(Room, Measurement.room_id == Room.room_id).all()
-
-    result = []
-    for measurement in measurements:
-        routers = db.query(MeasurementRouter).filter_by(measurement_id=measurement.measurement_id).all()
-        router_data = []
-        for router in routers:
-            router_info = db.query(Router).filter_by(router_id=router.router_id).first()
-            router_data.append({
-                'bssid': router_info.bssid,
-                'ssid': router_info.ssid,
-                'signal_strength': router.signal_strength
-            })
-
-        # Convert timestamp to seconds since epoch
-        timestamp_seconds = int(measurement.timestamp.timestamp())
+def get_all_measurements(
+    format: str = "json",
+    after_id: Optional[int] = Query(None, ge=0),
+    limit: Optional[int] = Query(None, ge=1),
+    db: Session = Depends(get_db)
+):
+    if format == "ndjson":
+        logger.info(f"Streaming measurements after ID {after_id}")
+        return StreamingResponse(stream_measurements(after_id, limit), media_type="application/x-ndjson")
+    if format != "json":
+        raise HTTPException(status_code=400, detail="Invalid format. Must be 'json' or 'ndjson'")
+    if after_id is not None or limit is not None:
+        return JSONResponse(content=fetch_measurement_page(db, after_id, limit or MEASUREMENTS_PAGE_SIZE))
 
-        result.append({
-            'measurement_id': measurement.measurement_id,
-            'timestamp': timestamp_seconds,
-            'device_id': measurement.device_id,
-            'room_id': measurement.room_id,
-            'room_name': measurement.room_name,
-            'routers': router_data
-        })
+    logger.info("Fetching all measurements")
+    result = fetch_all_measurements(db)
     logger.info("All measurements fetched successfully")
-    return result
+    return JSONResponse(content=result)
 
 @app.get("/rooms/all", response_model=List[dict])
 def get_all_rooms(db: Session = Depends(get_db)):
@@ -358,71 +384,16 @@ def get_all_routers(db: Session = Depends(get_db)):
     logger.info("All routers fetched successfully")
     return result
 
-@app.get("/measurements/all", response_model=List[dict])
-def get_all_measurements(db: Session = Depends(get_db)):
-    logger.info("Fetching all measurements")
-    measurements = db.query(
-        Measurement.measurement_id,
-        Measurement.timestamp,
-        Measurement.device_id,
-        Measurement.room_id,
-        Room.room_name
-    ).join(Room, Measurement.room_id == Room.room_id).all()
-
-    result = []
-    for measurement in measurements:
-        routers = db.query(MeasurementRouter).filter_by(measurement_id=measurement.measurement_id).all()
-        router_data = []
-        for router in routers:
-            router_info = db.query(Router).filter_by(router_id=router.router_id).first()
-            router_data.append({
-                'bssid': router_info.bssid,
-                'ssid': router_info.ssid,
-                'signal_strength': router.signal_strength
-            })
-
-        # Convert timestamp to seconds since epoch
-        timestamp_seconds = int(measurement.timestamp.timestamp())
-
-        result.append({
-            'measurement_id': measurement.measurement_id,
-            'timestamp': timestamp_seconds,
-            'device_id': measurement.device_id,
-            'room_id': measurement.room_id,
-            'room_name': measurement.room_name,
-            'routers': router_data
-        })
-    logger.info("All measurements fetched successfully")
-    return result
-
 @app.get("/measurements/{measurement_id}", response_model=dict)
 def get_measurement_by_id(measurement_id: int, db: Session = Depends(get_db)):
     logger.info(f"Fetching measurement with ID {measurement_id}")
-    measurement = db.query(Measurement).filter_by(measurement_id=measurement_id).first()
+    result = fetch_measurement(db, measurement_id)
 
-    if not measurement:
+    if not result:
         logger.error(f"Measurement with ID {measurement_id} not found")
         raise HTTPException(status_code=404, detail="Measurement not found")
 
-    routers = db.query(MeasurementRouter).filter_by(measurement_id=measurement.measurement_id).all()
-    router_data = []
-    for router in routers:
-        router_info = db.query(Router).filter_by(router_id=router.router_id).first()
-        router_data.append({
-            'bssid': router_info.bssid,
-            'ssid': router_info.ssid,
-            'signal_strength': router.signal_strength
-        })
-
-    timestamp_seconds = int(measurement.timestamp.timestamp())
-
-    result = {
-        'measurement_id': measurement.measurement_id,
-        'timestamp': timestamp_seconds,
-        'device_id': measurement.device_id,
-        'room_id': measurement.room_id,
-        'routers': router_data
-    }
+    del result['room_name']
     logger.info(f"Measurement with ID {measurement_id} fetched successfully")
     return result
 
@@ -451,8 +422,17 @@ def reset_database(db: Session = Depends(get_db)):
         db.query(Measurement).delete()
         db.query(Router).delete()
         db.query(Room).delete()
-        
+        # Der Reset wird protokolliert, damit andere Worker ihre Fingerprints neu laden
+        reset = MeasurementChange(change_type='reset', generation=new_generation())
+        db.add(reset)
+        db.flush()
+        db.query(MeasurementChange).filter(MeasurementChange.change_id < reset.change_id).delete()
+
         db.commit()
+        fingerprint_snapshots.invalidate()
+        model_registry.clear()
+        prediction_cache.clear()
+        lookup_cache.clear()
 
         logger.info("Datenbank erfolgreich zurückgesetzt (Daten gelöscht)")
         return {"message": "Database reset successfully"}
@@ -460,21 +440,3 @@ def reset_database(db: Session = Depends(get_db)):
         db.rollback()
         logger.error(f"Fehler beim Zurücksetzen der Datenbank: {e}")
         raise HTTPException(status_code=500, detail="Fehler beim Zurücksetzen der Datenbank")
-
-
-
-def handle_get_room_name_by_id(room_id: int, db: Session):
-    """
-    Retrieve the room name based on the room ID.
-
-    Parameters:
-    room_id (int): The ID of the room.
-    db (Session): The database session.
-
-    Returns:
-    str: The name of the room or "Unknown" if not found.
-    """
-    room = db.query(Room).filter_by(room_id=room_id).first()
-    if not room:
-        return "Unknown"
-    return room.room_name
@@ -0,0 +1,165 @@
+import json
+import logging
+import os
+
+from sqlalchemy import select
+
+from models import Room, Measurement, Router, MeasurementRouter, SessionLocal
+
+logger = logging.getLogger(__name__)
+
+MEASUREMENTS_PAGE_SIZE = int(os.getenv("MEASUREMENTS_PAGE_SIZE", "500"))
+
+
+def group_measurement_rows(rows):
+    """
+    Group joined measurement rows into the response shape of the measurement endpoints.
+
+    Parameters:
+    rows (iterable): Rows with 'measurement_id', 'timestamp', 'device_id', 'room_id', 'room_name', 'bssid',
+                     'ssid' and 'signal_strength', ordered by measurement_id. 'bssid' is None for a
+                     measurement without routers.
+
+    Returns:
+    list: One dictionary per measurement with 'measurement_id', 'timestamp' (seconds since epoch),
+          'device_id', 'room_id', 'room_name' and 'routers'.
+    """
+    result = []
+    current = None
+    for row in rows:
+        if current is None or current['measurement_id'] != row.measurement_id:
+            current = {
+                'measurement_id': row.measurement_id,
+                'timestamp': int(row.timestamp.timestamp()),
+                'device_id': row.device_id,
+                'room_id': row.room_id,
+                'room_name': row.room_name,
+                'routers': []
+            }
+            result.append(current)
+        if row.bssid is not None:
+            current['routers'].append({
+                'bssid': row.bssid,
+                'ssid': row.ssid,
+                'signal_strength': row.signal_strength
+            })
+    return result
+
+
+def measurement_query(measurement_ids=None):
+    """
+    Build the joined query for measurements, their rooms and their routers.
+
+    Parameters:
+    measurement_ids (Subquery): Subquery with a 'measurement_id' column that selects the measurements.
+                                Default is None, which selects all measurements.
+
+    Returns:
+    Select: Query of all rows of the measurements, ordered by measurement_id and router_id.
+    """
+    query = (
+        select(
+            Measurement.measurement_id,
+            Measurement.timestamp,
+            Measurement.device_id,
+            Measurement.room_id,
+            Room.room_name,
+            Router.bssid,
+            Router.ssid,
+            MeasurementRouter.signal_strength
+        )
+    )
+    if measurement_ids is not None:
+        query = query.select_from(measurement_ids).join(
+            Measurement, Measurement.measurement_id == measurement_ids.c.measurement_id)
+    return (
+        query
+        .join(Room, Measurement.room_id == Room.room_id)
+        .outerjoin(MeasurementRouter, MeasurementRouter.measurement_id == Measurement.measurement_id)
+        .outerjoin(Router, MeasurementRouter.router_id == Router.router_id)
+        .order_by(Measurement.measurement_id, MeasurementRouter.router_id)
+    )
+
+
+def fetch_all_measurements(db):
+    """
+    Fetch all measurements with one query.
+
+    Parameters:
+    db (Session): The database session.
+
+    Returns:
+    list: Measurements in the format of group_measurement_rows, ordered by measurement_id.
+    """
+    return group_measurement_rows(db.execute(measurement_query()))
+
+
+def fetch_measurement(db, measurement_id):
+    """
+    Fetch a single measurement with one query.
+
+    Parameters:
+    db (Session): The database session.
+    measurement_id (int): The ID of the measurement.
+
+    Returns:
+    dict: The measurement in the format of group_measurement_rows, or None if it does not exist.
+    """
+    rows = db.execute(measurement_query().where(Measurement.measurement_id == measurement_id))
+    measurements = group_measurement_rows(rows)
+    return measurements[0] if measurements else None
+
+
+def fetch_measurement_page(db, after_id=None, limit=MEASUREMENTS_PAGE_SIZE):
+    """
+    Fetch the next measurements after a cursor with one query.
+
+    Measurements are paged by measurement_id (keyset pagination), so every page costs the same no
+    matter how far into the table it is, and rows added while paging do not shift later pages.
+
+    Parameters:
+    db (Session): The database session.
+    after_id (int): Only return measurements with a larger ID. Default is None, which starts at the beginning.
+    limit (int): Maximum number of measurements. Default is MEASUREMENTS_PAGE_SIZE.
+
+    Returns:
+    list: Measurements in the format of group_measurement_rows, ordered by measurement_id.
+    """
+    page = select(Measurement.measurement_id)
+    if after_id is not None:
+        page = page.where(Measurement.measurement_id > after_id)
+    page = page.order_by(Measurement.measurement_id).limit(limit).subquery()
+    return group_measurement_rows(db.execute(measurement_query(page)))
+
+
+def stream_measurements(after_id=None, limit=None, page_size=MEASUREMENTS_PAGE_SIZE):
+    """
+    Yield measurements as NDJSON lines, one page at a time.
+
+    The generator uses its own session, because it runs while the response is streamed, after the
+    request's dependencies have been closed. Only one page is held in memory. A client that loses
+    the connection can resume by passing the last received measurement_id as after_id.
+
+    Parameters:
+    after_id (int): Cursor; only measurements with a larger ID are returned. Default is None.
+    limit (int): Maximum number of measurements in total. Default is None, which returns all of them.
+    page_size (int): Number of measurements fetched per query. Default is MEASUREMENTS_PAGE_SIZE.
+
+    Yields:
+    str: One JSON encoded measurement per line.
+    """
+    sent = 0
+    with SessionLocal() as db:
+        while limit is None or sent < limit:
+            size = page_size if limit is None else min(page_size, limit - sent)
+            page = fetch_measurement_page(db, after_id, size)
+            # End the transaction, so no snapshot is held open while the client reads the page
+            db.rollback()
+            if not page:
+                break
+            yield "".join(json.dumps(measurement) + "\n" for measurement in page)
+            sent += len(page)
+            after_id = page[-1]['measurement_id']
+            if len(page) < size:
+                break
+    logger.info(f"Streamed {sent} measurements")
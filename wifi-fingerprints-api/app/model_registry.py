@@ -0,0 +1,277 @@
+import hashlib
+import logging
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import scipy.sparse
+
+logger = logging.getLogger(__name__)
+
+MODEL_REGISTRY_MAX_ENTRIES = int(os.getenv("MODEL_REGISTRY_MAX_ENTRIES", "32"))
+MODEL_REGISTRY_MAX_BYTES = int(os.getenv("MODEL_REGISTRY_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# Options of PredictData that change the training matrix
+PREPROCESSING_OPTIONS = (
+    'use_remove_unreceived_bssids',
+    'handle_missing_values_strategy',
+    'router_selection',
+    'router_presence_threshold',
+    'value_scaling_strategy',
+    'router_rssi_threshold',
+    'use_sparse_matrix',
+    'candidate_rooms'
+)
+
+# Options of PredictData that change the estimator, per algorithm
+ALGORITHM_OPTIONS = {
+    'knn_sorensen': ('k_value', 'weights', 'knn_index', 'knn_probes'),
+    'knn_euclidean': ('k_value', 'weights', 'knn_index', 'knn_probes'),
+    'random_forest': ('n_estimators', 'max_depth', 'max_features'),
+    'svm_linear': ('c_value', 'gamma_value', 'svm_confidence'),
+    'svm_rbf': ('c_value', 'gamma_value', 'svm_confidence')
+}
+
+
+def get_query_dependencies(data, received_features, min_rssi_value, candidate_rooms=None):
+    """
+    Collect the parts of a prediction request that make the training matrix depend on the query itself.
+
+    The training matrix is not only a function of the stored data and the configuration:
+    - ignore_measurements removes rows,
+    - use_remove_unreceived_bssids keeps only the BSSIDs of the query,
+    - the 'use_received' strategy fills missing values with the signal strengths of the query,
+    - value scaling uses the minimum RSSI of training and query data,
+    - the two-stage prediction only keeps the rooms closest to the query.
+    All of these are added to the registry key, so a fitted model is only reused for requests that
+    would have produced exactly the same training matrix. The query enters the key in the feature space
+    of the fingerprint matrix, so BSSIDs that are not in the vocabulary do not prevent reuse.
+
+    Parameters:
+    data (PredictData): The prediction request.
+    received_features (dict): Dictionary mapping the feature IDs of the known BSSIDs of the query to their
+                              signal strengths, see FingerprintMatrix.get_received_features.
+    min_rssi_value (float): Minimum RSSI value used for value scaling.
+    candidate_rooms (list): Rooms preselected by the two-stage prediction. Default is None.
+
+    Returns:
+    tuple: The query dependent part of the key, or an empty tuple if the training matrix does not depend on the query.
+    """
+    dependencies = []
+    if data.ignore_measurements:
+        dependencies.append(('ignore_measurements', tuple(sorted(set(data.ignore_measurements)))))
+    if data.use_remove_unreceived_bssids:
+        dependencies.append(('received_features', tuple(received_features.keys())))
+    if data.handle_missing_values_strategy == 'use_received':
+        dependencies.append(('received_data', tuple(received_features.items())))
+    if data.value_scaling_strategy != 'none':
+        dependencies.append(('min_rssi_value', float(min_rssi_value)))
+    if candidate_rooms is not None:
+        dependencies.append(('candidate_rooms', tuple(candidate_rooms)))
+    return tuple(dependencies)
+
+
+def make_model_key(version, data, received_features, min_rssi_value, candidate_rooms=None):
+    """
+    Build the registry key of the model for a prediction request.
+
+    Parameters:
+    version (int): Dataset version of the fingerprint snapshot.
+    data (PredictData): The prediction request.
+    received_features (dict): Dictionary mapping the feature IDs of the known BSSIDs of the query to their
+                              signal strengths.
+    min_rssi_value (float): Minimum RSSI value used for value scaling.
+    candidate_rooms (list): Rooms preselected by the two-stage prediction. Default is None.
+
+    Returns:
+    tuple: Dataset version, preprocessing options, algorithm, hyperparameters and a digest of the query dependencies.
+    """
+    preprocessing = tuple(getattr(data, option) for option in PREPROCESSING_OPTIONS)
+    hyperparameters = tuple(getattr(data, option) for option in ALGORITHM_OPTIONS.get(data.algorithm, ()))
+
+    dependencies = get_query_dependencies(data, received_features, min_rssi_value, candidate_rooms)
+    digest = hashlib.sha1(repr(dependencies).encode()).hexdigest() if dependencies else None
+
+    return version, preprocessing, data.algorithm, hyperparameters, digest
+
+
+def is_query_dependent(key):
+    """
+    Return whether a registry key depends on the query, i.e. whether its model will rarely be reused.
+
+    Parameters:
+    key (tuple): Registry key as returned by make_model_key.
+
+    Returns:
+    bool: True if the training matrix of the key depends on the query.
+    """
+    return key[-1] is not None
+
+
+def estimate_model_size(model):
+    """
+    Estimate the memory footprint of a fitted model by the size of the arrays it holds.
+
+    The arrays (training data of kNN models, tree nodes of forests, support vectors of SVMs) make up
+    nearly all of the memory of a model. They are found by walking the state of the model, i.e. the
+    attributes of plain objects and the arrays of extension types such as sklearn's trees, and the
+    contents of lists, tuples and dicts. Other objects are counted with sys.getsizeof. Unlike pickling
+    the model, this does not copy the arrays.
+
+    Parameters:
+    model (object): The fitted model.
+
+    Returns:
+    int: Size in bytes.
+    """
+    # Keeps the visited objects alive, so the IDs of temporary states are not reused
+    seen = {}
+    pending = [model]
+    size = 0
+    while pending:
+        value = pending.pop()
+        if id(value) in seen:
+            continue
+        seen[id(value)] = value
+
+        if isinstance(value, np.ndarray):
+            if isinstance(value.base, np.ndarray):
+                # A view shares the memory of its base array
+                pending.append(value.base)
+            else:
+                size += value.nbytes
+            if value.dtype == object:
+                pending.extend(value.ravel().tolist())
+        elif scipy.sparse.issparse(value):
+            pending.extend(getattr(value, array) for array in ('data', 'indices', 'indptr') if hasattr(value, array))
+        elif isinstance(value, (str, bytes, int, float, bool, type(None), type)):
+            size += sys.getsizeof(value)
+        elif isinstance(value, dict):
+            size += sys.getsizeof(value)
+            pending.extend(value.keys())
+            pending.extend(value.values())
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            size += sys.getsizeof(value)
+            pending.extend(value)
+        else:
+            # The state is the attribute dict of plain objects and holds the arrays of extension types
+            # such as sklearn's Tree and KDTree
+            size += sys.getsizeof(value)
+            try:
+                pending.append(value.__getstate__())
+            except TypeError:
+                pass
+    return size
+
+
+class ModelRegistry:
+    """
+    ModelRegistry keeps fitted estimators in memory so that they can be reused across requests.
+
+    Entries are evicted in least recently used order as soon as either the number of entries or
+    the estimated size of all entries exceeds its limit. Concurrent requests for the same key
+    wait for a single fit instead of fitting the same model in parallel.
+    """
+
+    def __init__(self, max_entries=MODEL_REGISTRY_MAX_ENTRIES, max_bytes=MODEL_REGISTRY_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._fit_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rejected = 0
+        self.query_dependent = 0
+
+    def get_or_fit(self, key, fit):
+        """
+        Return the model for the given key, fitting and storing it if it is not in the registry.
+
+        Parameters:
+        key (tuple): Registry key as returned by make_model_key.
+        fit (callable): Function without arguments that returns a fitted model.
+
+        Returns:
+        object: The fitted model.
+        """
+        with self._lock:
+            if is_query_dependent(key):
+                self.query_dependent += 1
+            model = self._get(key)
+            if model is not None:
+                return model
+            fit_lock = self._fit_locks.setdefault(key, threading.Lock())
+
+        with fit_lock:
+            with self._lock:
+                model = self._get(key)
+                if model is not None:
+                    return model
+                self.misses += 1
+
+            try:
+                model = fit()
+                self._put(key, model, estimate_model_size(model))
+            finally:
+                with self._lock:
+                    self._fit_locks.pop(key, None)
+            return model
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def _put(self, key, model, size):
+        with self._lock:
+            if size > self.max_bytes:
+                self.rejected += 1
+                logger.info(f"Model of {size} bytes exceeds the registry budget of {self.max_bytes} bytes")
+                return
+
+            self._entries[key] = (model, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Remove all models from the registry.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """
+        Return the registry counters.
+
+        Returns:
+        dict: Number of entries, used and maximum bytes, hits, misses, evictions, rejected models and
+              lookups whose key depended on the query.
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'rejected': self.rejected,
+                'query_dependent': self.query_dependent
+            }
+
+
+model_registry = ModelRegistry()
@@ -0,0 +1,148 @@
+import hashlib
+import logging
+import os
+import threading
+
+import joblib
+import numpy as np
+import sklearn
+
+from sparse_fingerprints import SparseFingerprints
+
+logger = logging.getLogger(__name__)
+
+# Absolute, so the store does not depend on the working directory or end up in the mounted source tree
+MODEL_STORE_DIR = os.getenv("MODEL_STORE_DIR", "/data/model_store")
+MODEL_STORE_MAX_BYTES = int(os.getenv("MODEL_STORE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+
+
+def content_digest(X, y, parameters):
+    """
+    Compute a digest of everything a deterministic fit depends on.
+
+    Parameters:
+    X (numpy.ndarray or SparseFingerprints): Training data matrix.
+    y (numpy.ndarray): Target labels.
+    parameters (dict): Estimator parameters, including the random state.
+
+    Returns:
+    str: Hex digest identifying the fitted model.
+    """
+    digest = hashlib.sha1()
+    digest.update(repr((sklearn.__version__, sorted(parameters.items()), X.shape)).encode())
+    if isinstance(X, SparseFingerprints):
+        for array in (X.observed.data, X.observed.indices, X.observed.indptr, X.fill):
+            digest.update(np.ascontiguousarray(array).tobytes())
+    else:
+        digest.update(np.ascontiguousarray(X, dtype=np.float64).tobytes())
+    digest.update(repr(np.asarray(y).tolist()).encode())
+    return digest.hexdigest()
+
+
+class ModelStore:
+    """
+    ModelStore persists fitted models on disk with joblib, keyed by a digest of their training content.
+
+    Unlike the in-memory model registry, the store survives restarts and is shared by all workers that
+    use the same directory. Files are written to a temporary name and renamed, so readers never see a
+    partial file. When the directory grows beyond max_bytes, the least recently used files are removed.
+
+    Attributes:
+    - directory (str): Directory of the stored models. An empty string disables the store.
+    - max_bytes (int): Maximum total size of the stored models.
+    """
+
+    def __init__(self, directory=MODEL_STORE_DIR, max_bytes=MODEL_STORE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._errors = 0
+
+    def _path(self, digest):
+        return os.path.join(self.directory, f"{digest}.joblib")
+
+    def get_or_fit(self, digest, fit):
+        """
+        Return the stored model for a digest, or fit it and store it.
+
+        Parameters:
+        digest (str): Digest of the training content, see content_digest.
+        fit (callable): Function without arguments that returns the fitted model.
+
+        Returns:
+        object: The fitted model.
+        """
+        if not self.directory:
+            return fit()
+
+        path = self._path(digest)
+        try:
+            model = joblib.load(path)
+            os.utime(path)
+            with self._lock:
+                self._hits += 1
+            return model
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Could not load stored model {path}: {e}")
+            with self._lock:
+                self._errors += 1
+
+        with self._lock:
+            self._misses += 1
+        model = fit()
+        self._save(path, model)
+        return model
+
+    def _save(self, path, model):
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            joblib.dump(model, temporary_path)
+            os.replace(temporary_path, path)
+        except OSError as e:
+            logger.warning(f"Could not store model {path}: {e}")
+            with self._lock:
+                self._errors += 1
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            return
+        self._enforce_size_limit()
+
+    def _enforce_size_limit(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".joblib"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                logger.info(f"Removed stored model {path} to stay within {self.max_bytes} bytes")
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        """
+        Return the hit counters of the store.
+
+        Returns:
+        dict: Directory, hits, misses and errors.
+        """
+        with self._lock:
+            return {
+                "directory": self.directory,
+                "hits": self._hits,
+                "misses": self._misses,
+                "errors": self._errors
+            }
+
+
+model_store = ModelStore()
@@ -1,14 +1,55 @@
 import os
-from sqlalchemy import Column, Integer, String, ForeignKey, TIMESTAMP
+from contextvars import ContextVar
+from sqlalchemy import Column, Integer, String, ForeignKey, TIMESTAMP, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
 from sqlalchemy import create_engine
+from database_health import InstrumentedQueuePool, instrument_pool, database_breaker
 
 # Retrieve the database URL from the environment variables
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Connection pool settings
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+# Seconds a request waits for a free connection before it fails
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+# Seconds after which a connection is replaced, below the wait_timeout of MariaDB
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# Test every connection before it is handed out, so connections broken by a database restart are replaced
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+
 # Create the SQLAlchemy engine using the database URL
-engine = create_engine(DATABASE_URL)
+engine = create_engine(
+    DATABASE_URL,
+    poolclass=InstrumentedQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING
+)
+instrument_pool(engine.pool)
+
+# Number of SQL statements executed on behalf of the current request
+sql_statement_counter = ContextVar("sql_statement_counter", default=None)
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def count_sql_statement(conn, cursor, statement, parameters, context, executemany):
+    """
+    Count every SQL statement sent to the database for the request that is currently being served.
+    """
+    counter = sql_statement_counter.get()
+    if counter is not None:
+        counter[0] += 1
+
+@event.listens_for(engine.pool, "checkout")
+def close_circuit_breaker(dbapi_connection, connection_record, connection_proxy):
+    """
+    A connection was handed out after passing the pre-ping, so the database is available.
+    """
+    database_breaker.record_success()
 
 # Configure the session maker to handle database sessions
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -97,3 +138,27 @@ class MeasurementRouter(Base):
 
     measurement = relationship("Measurement")
     router = relationship("Router")
+
+class MeasurementChange(Base):
+    """
+    MeasurementChange model represents the 'measurement_changes' table, a log of changes to the measurements.
+
+    Every added measurement is logged in the same transaction that inserts it, and a reset of the database
+    is logged as a single 'reset' entry. Workers that keep the fingerprints in memory read the entries after
+    the last one they applied, so they can catch up with writes made by other workers.
+
+    Every reset starts a new generation of the data. Change IDs are only comparable within a generation,
+    since they restart when the table is recreated.
+
+    Attributes:
+    - change_id (int): Primary key, auto-incremented, orders the changes.
+    - measurement_id (int): ID of the added measurement, empty for a reset.
+    - change_type (str): 'add' or 'reset'.
+    - generation (str): Random identifier of the generation started by a reset, empty for an added measurement.
+    """
+    __tablename__ = 'measurement_changes'
+
+    change_id = Column(Integer, primary_key=True, index=True)
+    measurement_id = Column(Integer)
+    change_type = Column(String(16), nullable=False)
+    generation = Column(String(32))
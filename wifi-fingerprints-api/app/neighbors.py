@@ -0,0 +1,452 @@
+import os
+import random
+import threading
+
+import numpy as np
+from prometheus_client import Histogram
+from sklearn.cluster import KMeans
+from sklearn.neighbors import BallTree, KDTree
+
+KNN_METRICS = ['euclidean', 'sorensen']
+KNN_WEIGHTS = ['uniform', 'distance']
+KNN_INDEXES = ['brute', 'tree', 'ivf']
+
+# Upper bound for the number of matrix cells held in memory while computing distances
+DISTANCE_CHUNK_CELLS = 2 ** 22
+
+# Share of index queries that are also answered exactly to measure the recall of the index
+KNN_RECALL_SAMPLE_RATE = float(os.getenv("KNN_RECALL_SAMPLE_RATE", "0.05"))
+
+KNN_INDEX_RECALL = Histogram(
+    "knn_index_recall",
+    "Share of the exact k nearest neighbors found by the kNN index, for sampled queries",
+    ["index", "metric"],
+    buckets=(0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99, 1.0)
+)
+
+
+def euclidean_distances(X, x):
+    """
+    Compute the Euclidean distance between every row of X and the vector x.
+
+    Parameters:
+    X (numpy.ndarray): Matrix of shape (n_samples, n_features).
+    x (numpy.ndarray): Vector of shape (n_features,).
+
+    Returns:
+    numpy.ndarray: Distances of shape (n_samples,).
+    """
+    return np.sqrt(np.sum((X - x) ** 2, axis=1))
+
+
+def sorensen_distances(X, x):
+    """
+    Compute the Sorensen (Bray-Curtis) distance between every row of X and the vector x.
+
+    Parameters:
+    X (numpy.ndarray): Matrix of shape (n_samples, n_features).
+    x (numpy.ndarray): Vector of shape (n_features,).
+
+    Returns:
+    numpy.ndarray: Distances of shape (n_samples,).
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sum(np.abs(X - x), axis=1) / np.sum(np.abs(X) + np.abs(x), axis=1)
+
+
+DISTANCE_FUNCTIONS = {
+    'euclidean': euclidean_distances,
+    'sorensen': sorensen_distances
+}
+
+
+def check_finite(*arrays):
+    """
+    Raise a ValueError if an array contains NaN or infinity, as sklearn's input validation does.
+
+    A degenerate scaling, e.g. of a query whose signal strengths are all equal, produces NaN values;
+    predictions on them would pick arbitrary neighbors.
+
+    Parameters:
+    arrays (numpy.ndarray): The arrays to check.
+    """
+    for array in arrays:
+        if not np.all(np.isfinite(array)):
+            raise ValueError("Input contains NaN or infinity.")
+
+
+def pairwise_distances(X_new, X, metric='euclidean'):
+    """
+    Compute the distances between every query row and every training row.
+
+    The per-row computations are done on whole arrays. Query rows are processed one at a time so
+    that the temporary (n_samples, n_features) difference matrix stays small.
+
+    Parameters:
+    X_new (numpy.ndarray): Query matrix of shape (n_queries, n_features).
+    X (numpy.ndarray): Training matrix of shape (n_samples, n_features).
+    metric (str): 'euclidean' or 'sorensen'. Default is 'euclidean'.
+
+    Returns:
+    numpy.ndarray: Distance matrix of shape (n_queries, n_samples).
+    """
+    distance_function = DISTANCE_FUNCTIONS[metric]
+    distances = np.empty((X_new.shape[0], X.shape[0]))
+    for i in range(X_new.shape[0]):
+        distances[i] = distance_function(X, X_new[i])
+    return distances
+
+
+def sparse_pairwise_distances(X_new, S, fill, metric='euclidean', row_abs_sums=None):
+    """
+    Compute the distances between every query row and every row of a sparse training matrix.
+
+    The training matrix is S + fill, where S is a CSR matrix that only stores the cells that differ
+    from the fill value of their column. With q = x - fill, the terms of all implicit cells are
+    computed once per query from q and only the stored cells are corrected, so the cost per query
+    is linear in the number of stored values instead of n_samples * n_features.
+
+    Parameters:
+    X_new (numpy.ndarray): Query matrix of shape (n_queries, n_features).
+    S (scipy.sparse.csr_matrix): Training matrix minus fill, of shape (n_samples, n_features).
+    fill (numpy.ndarray): Fill value of each column.
+    metric (str): 'euclidean' or 'sorensen'. Default is 'euclidean'.
+    row_abs_sums (numpy.ndarray): Sum of absolute values of every row of S + fill. Required for 'sorensen'.
+
+    Returns:
+    numpy.ndarray: Distance matrix of shape (n_queries, n_samples).
+    """
+    entry_rows = np.repeat(np.arange(S.shape[0]), np.diff(S.indptr))
+    distances = np.empty((X_new.shape[0], S.shape[0]))
+    for i in range(X_new.shape[0]):
+        q = X_new[i] - fill
+        q_stored = q[S.indices]
+        if metric == 'euclidean':
+            corrections = np.bincount(entry_rows, weights=(S.data - q_stored) ** 2 - q_stored ** 2,
+                                      minlength=S.shape[0])
+            distances[i] = np.sqrt(np.maximum(np.dot(q, q) + corrections, 0.0))
+        else:
+            corrections = np.bincount(entry_rows, weights=np.abs(S.data - q_stored) - np.abs(q_stored),
+                                      minlength=S.shape[0])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                distances[i] = (np.abs(q).sum() + corrections) / (row_abs_sums + np.abs(X_new[i]).sum())
+    return distances
+
+
+class RecallTracker:
+    """
+    RecallTracker collects the recall of sampled index queries against the exact neighbors.
+
+    The recall of a query is the share of its k returned neighbors that are at most as far away as the
+    k-th exact neighbor, so ties between equally distant rows do not count as misses.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = {}
+
+    def record(self, index, metric, recalls):
+        for recall in recalls:
+            KNN_INDEX_RECALL.labels(index=index, metric=metric).observe(recall)
+        with self._lock:
+            count, total = self._totals.get((index, metric), (0, 0.0))
+            self._totals[(index, metric)] = (count + len(recalls), total + float(np.sum(recalls)))
+
+    def stats(self):
+        """
+        Return the mean recall per index and metric.
+
+        Returns:
+        dict: Dictionary mapping '<index>_<metric>' to the number of sampled queries and their mean recall.
+        """
+        with self._lock:
+            return {
+                f"{index}_{metric}": {"queries": count, "mean_recall": total / count}
+                for (index, metric), (count, total) in self._totals.items()
+            }
+
+
+recall_tracker = RecallTracker()
+
+
+class TreeIndex:
+    """
+    TreeIndex finds the exact nearest neighbors with a KD tree (Euclidean) or a ball tree (Sorensen).
+
+    The Sorensen distance is the Bray-Curtis distance of sklearn's BallTree as long as the two vectors
+    have the same sign in every column, which holds for signal strengths before and after scaling.
+    Queries cost about O(log n_samples) distance computations for few features, but degrade towards a
+    full scan in high dimensions.
+    """
+
+    def __init__(self, X, metric):
+        if metric == 'euclidean':
+            self._tree = KDTree(X)
+        else:
+            self._tree = BallTree(X, metric='braycurtis')
+
+    def query(self, X_new, n_neighbors):
+        return self._tree.query(X_new, k=n_neighbors)
+
+
+class IVFIndex:
+    """
+    IVFIndex is an approximate inverted file index: the training rows are clustered with k-means and a
+    query is only compared with the rows of the n_probes clusters whose centroids are closest.
+
+    More probes give a higher recall at a higher latency; probing all clusters is exact.
+
+    Attributes:
+    - n_lists (int): Number of clusters.
+    - n_probes (int): Number of clusters searched per query.
+    """
+
+    def __init__(self, X, metric, n_probes, n_lists=None):
+        self.metric = metric
+        self.n_lists = n_lists or max(1, min(X.shape[0], int(np.sqrt(X.shape[0]))))
+        self.n_probes = max(1, min(n_probes, self.n_lists))
+        kmeans = KMeans(n_clusters=self.n_lists, n_init=1, random_state=0).fit(X)
+        self._X = X
+        self._centroids = kmeans.cluster_centers_
+        order = np.argsort(kmeans.labels_, kind='stable')
+        bounds = np.searchsorted(kmeans.labels_[order], np.arange(self.n_lists + 1))
+        self._lists = [order[bounds[i]:bounds[i + 1]] for i in range(self.n_lists)]
+
+    def query(self, X_new, n_neighbors):
+        distance_function = DISTANCE_FUNCTIONS[self.metric]
+        distances = np.empty((X_new.shape[0], n_neighbors))
+        indices = np.empty((X_new.shape[0], n_neighbors), dtype=np.intp)
+        for i, x in enumerate(X_new):
+            probe_order = np.argsort(euclidean_distances(self._centroids, x))
+            # Probe further clusters if the closest ones hold fewer than n_neighbors rows
+            n_candidates = np.cumsum([self._lists[j].size for j in probe_order])
+            n_probes = max(self.n_probes, int(np.searchsorted(n_candidates, n_neighbors)) + 1)
+            candidates = np.concatenate([self._lists[j] for j in probe_order[:n_probes]])
+            candidate_distances = distance_function(self._X[candidates], x)
+            nearest = np.argsort(candidate_distances, kind='stable')[:n_neighbors]
+            distances[i] = candidate_distances[nearest]
+            indices[i] = candidates[nearest]
+        return distances, indices
+
+
+class FingerprintKNN:
+    """
+    FingerprintKNN is a brute-force k-Nearest Neighbors classifier with vectorized distance computations.
+
+    It replaces sklearn's KNeighborsClassifier with a Python callable as metric, which computes one
+    distance per Python call. Neighbor selection, weighting and class probabilities follow sklearn,
+    so predictions and distances are the same. The training matrix can also be given in sparse form
+    (see fit), in which case distances are computed from the stored values only.
+
+    Instead of scanning all training rows, the neighbors can be found with an index that is built in fit:
+    'tree' (exact, see TreeIndex) or 'ivf' (approximate, see IVFIndex). A share of the index queries
+    (KNN_RECALL_SAMPLE_RATE) is also answered by the full scan to report the recall of the index.
+
+    Attributes:
+    - n_neighbors (int): Number of neighbors to use.
+    - metric (str): 'euclidean' or 'sorensen'.
+    - weights (str): 'uniform' or 'distance'.
+    - index (str): 'brute', 'tree' or 'ivf'.
+    - n_probes (int): Number of clusters searched per query by the 'ivf' index.
+    - classes_ (numpy.ndarray): Sorted class labels, available after fit.
+    """
+
+    def __init__(self, n_neighbors=5, metric='euclidean', weights='uniform', index='brute', n_probes=8):
+        if metric not in KNN_METRICS:
+            raise ValueError(f"Invalid metric. Must be one of {KNN_METRICS}")
+        if weights not in KNN_WEIGHTS:
+            raise ValueError(f"Invalid weights. Must be one of {KNN_WEIGHTS}")
+        if index not in KNN_INDEXES:
+            raise ValueError(f"Invalid kNN index. Must be one of {KNN_INDEXES}")
+        self.n_neighbors = n_neighbors
+        self.metric = metric
+        self.weights = weights
+        self.index = index
+        self.n_probes = n_probes
+
+    def fit(self, X, y, fill=None):
+        """
+        Store the training data and build the neighbor index.
+
+        Parameters:
+        X (numpy.ndarray or scipy.sparse.csr_matrix): Training data matrix. If fill is given, a CSR matrix
+                                                      holding the training data minus fill.
+        y (numpy.ndarray): Target labels.
+        fill (numpy.ndarray): Fill value of each column of a sparse training matrix. Default is None.
+
+        Returns:
+        FingerprintKNN: The fitted model.
+        """
+        if fill is None:
+            self._fit_X = np.ascontiguousarray(X, dtype=np.float64)
+            self._fill = None
+            check_finite(self._fit_X)
+        else:
+            check_finite(X.data, fill)
+            self._fit_X = X
+            self._fill = np.asarray(fill, dtype=np.float64)
+            # Sums of |S + fill| per row: |fill| for every implicit cell, |s + fill| for the stored ones
+            entry_rows = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+            stored_fill = self._fill[X.indices]
+            corrections = np.abs(X.data + stored_fill) - np.abs(stored_fill)
+            self._row_abs_sums = np.abs(self._fill).sum() + np.bincount(entry_rows, weights=corrections,
+                                                                        minlength=X.shape[0])
+        self.classes_, self._y = np.unique(y, return_inverse=True)
+
+        self._index = None
+        if self.index != 'brute':
+            X_dense = self._fit_X if self._fill is None else self._fit_X.toarray() + self._fill
+            if self.index == 'tree':
+                self._index = TreeIndex(X_dense, self.metric)
+            else:
+                self._index = IVFIndex(X_dense, self.metric, self.n_probes)
+        return self
+
+    def _distances(self, X_new):
+        if self._fill is None:
+            return pairwise_distances(X_new, self._fit_X, self.metric)
+        return sparse_pairwise_distances(X_new, self._fit_X, self._fill, self.metric, self._row_abs_sums)
+
+    def kneighbors(self, X_new, n_neighbors=None, return_distance=True):
+        """
+        Find the nearest training rows for every query row.
+
+        Parameters:
+        X_new (numpy.ndarray): Query matrix.
+        n_neighbors (int): Number of neighbors. Default is the value given to the constructor.
+        return_distance (bool): Whether to return the distances. Default is True.
+
+        Returns:
+        tuple: Distances and indices of the neighbors, both of shape (n_queries, n_neighbors), sorted by distance.
+        """
+        if n_neighbors is None:
+            n_neighbors = self.n_neighbors
+        n_samples = self._fit_X.shape[0]
+        if n_neighbors <= 0:
+            raise ValueError(f"Expected n_neighbors > 0. Got {n_neighbors}")
+        if n_neighbors > n_samples:
+            raise ValueError(f"Expected n_neighbors <= n_samples_fit, but n_neighbors = {n_neighbors}, "
+                             f"n_samples_fit = {n_samples}")
+
+        X_new = np.asarray(X_new, dtype=np.float64)
+        check_finite(X_new)
+        if self._index is not None:
+            distances, indices = self._index.query(X_new, n_neighbors)
+            sampled = [i for i in range(X_new.shape[0]) if random.random() < KNN_RECALL_SAMPLE_RATE]
+            if sampled:
+                self._record_recall(X_new[sampled], distances[sampled], n_neighbors)
+        else:
+            distances, indices = self._exact_kneighbors(X_new, n_neighbors)
+        if return_distance:
+            return distances, indices
+        return indices
+
+    def _record_recall(self, X_new, distances, n_neighbors):
+        exact_distances, _ = self._exact_kneighbors(X_new, n_neighbors)
+        # Allow for rounding differences between the index and the full scan
+        found = distances <= exact_distances[:, -1:] * (1 + 1e-9) + 1e-12
+        recall_tracker.record(self.index, self.metric, found.mean(axis=1))
+
+    def _exact_kneighbors(self, X_new, n_neighbors):
+        n_samples = self._fit_X.shape[0]
+        chunk_size = max(1, DISTANCE_CHUNK_CELLS // max(1, n_samples))
+        all_distances = []
+        all_indices = []
+        for start in range(0, X_new.shape[0], chunk_size):
+            distances = self._distances(X_new[start:start + chunk_size])
+            rows = np.arange(distances.shape[0])[:, None]
+            indices = np.argpartition(distances, n_neighbors - 1, axis=1)[:, :n_neighbors]
+            order = np.argsort(distances[rows, indices], axis=1)
+            indices = indices[rows, order]
+            all_distances.append(distances[rows, indices])
+            all_indices.append(indices)
+
+        distances = np.vstack(all_distances) if all_distances else np.empty((0, n_neighbors))
+        indices = np.vstack(all_indices) if all_indices else np.empty((0, n_neighbors), dtype=np.intp)
+        return distances, indices
+
+    def _get_weights(self, distances):
+        if self.weights == 'uniform':
+            return np.ones_like(distances)
+        with np.errstate(divide='ignore'):
+            weights = 1.0 / distances
+        # Exact matches get all the weight, as in sklearn
+        inf_mask = np.isinf(weights)
+        inf_rows = np.any(inf_mask, axis=1)
+        weights[inf_rows] = inf_mask[inf_rows]
+        return weights
+
+    def predict_proba(self, X_new):
+        """
+        Compute the class probabilities for every query row.
+
+        Parameters:
+        X_new (numpy.ndarray): Query matrix.
+
+        Returns:
+        numpy.ndarray: Probabilities of shape (n_queries, n_classes) in the order of classes_.
+        """
+        distances, indices = self.kneighbors(X_new)
+        return self._proba_from_neighbors(distances, indices)
+
+    def _proba_from_neighbors(self, distances, indices):
+        weights = self._get_weights(distances)
+        labels = self._y[indices]
+        rows = np.arange(labels.shape[0])
+        proba = np.zeros((labels.shape[0], self.classes_.size))
+        for i in range(labels.shape[1]):
+            proba[rows, labels[:, i]] += weights[:, i]
+        normalizer = proba.sum(axis=1)[:, np.newaxis]
+        normalizer[normalizer == 0.0] = 1.0
+        return proba / normalizer
+
+    def kneighbors_excluding(self, X_new, exclude):
+        """
+        Find the nearest training rows for every query row, leaving out one training row per query, e.g. the
+        query itself in a leave-one-out evaluation.
+
+        Parameters:
+        X_new (numpy.ndarray): Query matrix.
+        exclude (numpy.ndarray): Index of the training row left out for each query row, or -1 to keep all rows.
+
+        Returns:
+        tuple: Distances and indices of the n_neighbors neighbors, sorted by distance.
+        """
+        distances, indices = self.kneighbors(X_new, self.n_neighbors + 1)
+        keep = indices != np.asarray(exclude)[:, None]
+        # Queries whose excluded row is not among the neighbors drop the farthest one instead
+        keep[keep.all(axis=1), -1] = False
+        shape = (indices.shape[0], self.n_neighbors)
+        return distances[keep].reshape(shape), indices[keep].reshape(shape)
+
+    def predict_with_distance(self, X_new, exclude=None):
+        """
+        Predict the class label and the distance to the nearest neighbor for every query row, from a single
+        neighbor search.
+
+        Parameters:
+        X_new (numpy.ndarray): Query matrix.
+        exclude (numpy.ndarray): Index of the training row left out for each query row, see kneighbors_excluding.
+                                 Default is None, which uses all training rows.
+
+        Returns:
+        tuple: Predicted labels and distances to the nearest neighbor.
+        """
+        if exclude is None:
+            distances, indices = self.kneighbors(X_new)
+        else:
+            distances, indices = self.kneighbors_excluding(X_new, exclude)
+        proba = self._proba_from_neighbors(distances, indices)
+        return self.classes_[np.argmax(proba, axis=1)], distances[:, 0]
+
+    def predict(self, X_new):
+        """
+        Predict the class label for every query row.
+
+        Parameters:
+        X_new (numpy.ndarray): Query matrix.
+
+        Returns:
+        numpy.ndarray: Predicted labels.
+        """
+        return self.classes_[np.argmax(self.predict_proba(X_new), axis=1)]
@@ -0,0 +1,59 @@
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Gauge, Histogram
+
+PREDICTION_STAGE_SECONDS = Histogram(
+    "prediction_stage_seconds",
+    "Time spent in each stage of the prediction pipeline. The cache label is 'hit' or 'miss' for the "
+    "stages served by a cache (snapshot, fit) and 'none' otherwise",
+    ["stage", "algorithm", "cache"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+TRAINING_ROWS = Gauge(
+    "prediction_training_rows",
+    "Number of rows of the last training matrix",
+    ["algorithm"]
+)
+TRAINING_COLUMNS = Gauge(
+    "prediction_training_columns",
+    "Number of columns of the last training matrix",
+    ["algorithm"]
+)
+
+
+def observe_stage(stage, algorithm, seconds, cache='none'):
+    """
+    Record the duration of a pipeline stage.
+
+    Parameters:
+    stage (str): Name of the stage, e.g. 'select' or 'fit'.
+    algorithm (str): The configured algorithm.
+    seconds (float): Duration of the stage.
+    cache (str): 'hit' or 'miss' for stages served by a cache, 'none' otherwise. Default is 'none'.
+    """
+    PREDICTION_STAGE_SECONDS.labels(stage=stage, algorithm=algorithm, cache=cache).observe(seconds)
+
+
+@contextmanager
+def time_stage(stage, algorithm, cache='none'):
+    """
+    Record the duration of the with block as a pipeline stage, see observe_stage.
+    """
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, algorithm, time.perf_counter() - start_time, cache)
+
+
+def record_training_shape(algorithm, X):
+    """
+    Record the size of a training matrix.
+
+    Parameters:
+    algorithm (str): The configured algorithm.
+    X (numpy.ndarray or scipy.sparse.csr_matrix): The training matrix.
+    """
+    TRAINING_ROWS.labels(algorithm=algorithm).set(X.shape[0])
+    TRAINING_COLUMNS.labels(algorithm=algorithm).set(X.shape[1])
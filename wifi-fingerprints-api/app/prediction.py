@@ -0,0 +1,422 @@
+import logging
+import os
+import time
+
+import numpy as np
+
+from compute_pool import cpu_budget
+from model_registry import model_registry, make_model_key, is_query_dependent
+from model_store import model_store, content_digest
+from pipeline_metrics import time_stage, observe_stage, record_training_shape
+from prediction_cache import prediction_cache
+from sparse_fingerprints import sparse_from_dense
+from utils import handle_missing_values, prepare_received_data, handle_router_rssi_threshold, value_scaling, \
+    handle_missing_values_sparse, handle_router_rssi_threshold_sparse, value_scaling_sparse, fit_knn, fit_random_forest, \
+    fit_svm, predict_knn, predict_random_forest, predict_svm
+
+logger = logging.getLogger(__name__)
+
+ALGORITHMS = ['knn_sorensen', 'knn_euclidean', 'random_forest', 'svm_linear', 'svm_rbf']
+
+RANDOM_FOREST_SEED = int(os.getenv("RANDOM_FOREST_SEED", "42"))
+RANDOM_FOREST_MAX_JOBS = int(os.getenv("RANDOM_FOREST_MAX_JOBS", str(os.cpu_count() or 1)))
+
+# Errors of fitting or predicting that are answered with an empty prediction instead of failing the request.
+# sklearn and FingerprintKNN raise them for invalid input, e.g. NaN values after a degenerate scaling.
+PREDICTION_ERRORS = (ValueError,)
+
+
+class SingleRoomModel:
+    """
+    SingleRoomModel stands in for an SVM whose training data contains only one room, e.g. because the
+    two-stage prediction or the router filters left a single candidate. SVC cannot be fitted on one
+    class; the only possible prediction is that room, with full confidence.
+
+    Attributes:
+    - room_id (int): The room of all training rows.
+    """
+
+    def __init__(self, room_id):
+        self.room_id = room_id
+
+
+def get_model_parameters(config):
+    """
+    Extract the hyperparameters of the configured algorithm from the request.
+
+    Parameters:
+    config (PredictConfig): The prediction configuration.
+
+    Returns:
+    dict: Hyperparameters with "None" strings converted to None.
+    """
+    max_depth = None if config.max_depth == "None" else config.max_depth
+    max_features = None if config.max_features == "None" else config.max_features
+    return {
+        'k_value': config.k_value,
+        'weights': config.weights,
+        'knn_index': config.knn_index,
+        'knn_probes': config.knn_probes,
+        'n_estimators': config.n_estimators,
+        'max_depth': max_depth,
+        'max_features': max_features,
+        'c_value': config.c_value,
+        'gamma_value': config.gamma_value,
+        'svm_confidence': config.svm_confidence
+    }
+
+
+def get_distance_mode(config):
+    """
+    Describe what the 'distance' of a prediction is for the configured algorithm.
+
+    Parameters:
+    config (PredictConfig): The prediction configuration.
+
+    Returns:
+    str: 'neighbor_distance' for kNN, 'probability' for random forests, and the svm_confidence mode for SVMs.
+    """
+    if config.algorithm in ['svm_linear', 'svm_rbf']:
+        return config.svm_confidence
+    if config.algorithm == 'random_forest':
+        return 'probability'
+    return 'neighbor_distance'
+
+
+def select_candidate_rooms(snapshot, config, received_data, ignore_measurements=None):
+    """
+    Preselect the rooms of a two-stage prediction by the distance of the query to the room centroids.
+
+    Parameters:
+    snapshot (FingerprintSnapshot): The fingerprint snapshot.
+    config (PredictConfig): The prediction configuration.
+    received_data (dict): Dictionary mapping 'bssid' to 'signal_strength' of the query.
+    ignore_measurements (iterable): Measurement IDs that are left out of the centroids. Default is None.
+
+    Returns:
+    list: Sorted IDs of the config.candidate_rooms closest rooms, or None if the two-stage prediction is disabled.
+    """
+    if not config.candidate_rooms:
+        return None
+    with time_stage('candidate_rooms', config.algorithm):
+        matrix = snapshot.matrix
+        ignore_rows = [matrix.row_index[measurement_id] for measurement_id in ignore_measurements or []
+                       if measurement_id in matrix.row_index]
+        return sorted(snapshot.centroids.rank(matrix, received_data, config.candidate_rooms, ignore_rows))
+
+
+def build_training_matrix(matrix, config, received_data, ignore_measurements=None, room_ids=None):
+    """
+    Apply the configured fingerprint filters and build the raw training matrix.
+
+    Parameters:
+    matrix (FingerprintMatrix): The fingerprints of the snapshot.
+    config (PredictConfig): The prediction configuration.
+    received_data (dict): Dictionary mapping 'bssid' to 'signal_strength' of the query.
+    ignore_measurements (iterable): Measurement IDs to leave out. Default is None.
+    room_ids (list): Only train on the measurements of these rooms. Default is None, which uses all rooms.
+
+    Returns:
+    tuple: Feature matrix (NaN for missing values, or a CSR matrix of the observed values with use_sparse_matrix),
+           target labels, and list of MAC addresses in the column order of the vocabulary.
+    """
+    with time_stage('select', config.algorithm):
+        X, y, mac_address_list = matrix.select(config, received_data, ignore_measurements, room_ids)
+        if config.use_sparse_matrix:
+            X = sparse_from_dense(X)
+    record_training_shape(config.algorithm, X)
+    return X, y, mac_address_list
+
+
+def preprocess(X, mac_address_list, config, received_data, X_new=None):
+    """
+    Impute, threshold and scale the training matrix and the query.
+
+    With use_sparse_matrix, the training matrix stays sparse: missing values become implicit per-column
+    fill values and the thresholding and scaling steps are applied to stored and fill values alike.
+
+    Parameters:
+    X (numpy.ndarray or scipy.sparse.csr_matrix): Raw training matrix as returned by build_training_matrix.
+                                                  A dense matrix is converted if use_sparse_matrix is set.
+                                                  It is not modified.
+    mac_address_list (list): List of MAC addresses corresponding to the columns of X.
+    config (PredictConfig): The prediction configuration.
+    received_data (dict): Dictionary mapping 'bssid' to 'signal_strength' of the query.
+    X_new (numpy.ndarray): Raw query matrix in the column order of mac_address_list, to preprocess several
+                           queries at once. Default is None, which builds the query from received_data.
+
+    Returns:
+    tuple: Training matrix (numpy.ndarray or SparseFingerprints), query matrix, and the minimum RSSI value used
+           for scaling.
+    """
+    if config.use_sparse_matrix:
+        return preprocess_sparse(X, mac_address_list, config, received_data, X_new)
+
+    with time_stage('missing_values', config.algorithm):
+        X = handle_missing_values(X.copy(), mac_address_list, received_data, config.handle_missing_values_strategy)
+        if X_new is None:
+            X_new = prepare_received_data(received_data, mac_address_list)
+        min_rssi_value = np.array(min(X.min(), X_new.min()))
+
+    with time_stage('rssi_threshold', config.algorithm):
+        X, X_new = handle_router_rssi_threshold(X, X_new, router_rssi_threshold=config.router_rssi_threshold)
+    with time_stage('scaling', config.algorithm):
+        X, X_new = value_scaling(X, X_new, min_rssi_value=min_rssi_value,
+                                 value_scaling_strategy=config.value_scaling_strategy)
+
+    if X_new.size == 0:
+        raise ValueError("Received data is empty. Check the input data.")
+
+    return X, X_new, min_rssi_value
+
+
+def preprocess_sparse(X, mac_address_list, config, received_data, X_new=None):
+    """
+    Sparse version of preprocess, see there.
+    """
+    with time_stage('missing_values', config.algorithm):
+        if isinstance(X, np.ndarray):
+            X = sparse_from_dense(X)
+        X = handle_missing_values_sparse(X, mac_address_list, received_data, config.handle_missing_values_strategy)
+        if X_new is None:
+            X_new = prepare_received_data(received_data, mac_address_list)
+        min_rssi_value = np.array(min(X.min(), X_new.min()))
+
+    with time_stage('rssi_threshold', config.algorithm):
+        X, X_new = handle_router_rssi_threshold_sparse(X, X_new, router_rssi_threshold=config.router_rssi_threshold)
+    with time_stage('scaling', config.algorithm):
+        X, X_new = value_scaling_sparse(X, X_new, min_rssi_value=min_rssi_value,
+                                        value_scaling_strategy=config.value_scaling_strategy)
+
+    if X_new.size == 0:
+        raise ValueError("Received data is empty. Check the input data.")
+
+    return X, X_new, min_rssi_value
+
+
+def fit_model(config, X, y, query_dependent=False):
+    """
+    Fit the configured algorithm on the training data.
+
+    A kNN index and the model store only pay off if the model is reused by later queries. A model fitted
+    on a training matrix that depends on the query is used once, so it scans all measurements whatever
+    knn_index says, and a random forest fitted on it is neither hashed nor written to the model store.
+
+    Parameters:
+    config (PredictConfig): The prediction configuration.
+    X (numpy.ndarray or SparseFingerprints): Training data matrix.
+    y (numpy.ndarray): Target labels.
+    query_dependent (bool): Whether the training matrix depends on the query. Default is False.
+
+    Returns:
+    object: The fitted model.
+    """
+    parameters = get_model_parameters(config)
+    algorithm = config.algorithm
+    knn_index = 'brute' if query_dependent else parameters['knn_index']
+
+    if algorithm == 'knn_sorensen':
+        return fit_knn(X, y, parameters['k_value'], metric='sorensen', weights=parameters['weights'],
+                       index=knn_index, n_probes=parameters['knn_probes'])
+    elif algorithm == 'knn_euclidean':
+        return fit_knn(X, y, parameters['k_value'], metric='euclidean', weights=parameters['weights'],
+                       index=knn_index, n_probes=parameters['knn_probes'])
+    elif algorithm == 'random_forest':
+        return fit_forest(X, y, parameters, persist=not query_dependent)
+    elif algorithm in ['svm_linear', 'svm_rbf'] and np.unique(y).size < 2:
+        return SingleRoomModel(y[0])
+    elif algorithm == 'svm_linear':
+        return fit_svm(X, y, kernel='linear', C=parameters['c_value'], gamma=parameters['gamma_value'],
+                       confidence=parameters['svm_confidence'])
+    elif algorithm == 'svm_rbf':
+        return fit_svm(X, y, kernel='rbf', C=parameters['c_value'], gamma=parameters['gamma_value'],
+                       confidence=parameters['svm_confidence'])
+    raise ValueError(f"Invalid algorithm. Must be one of {ALGORITHMS}")
+
+
+def fit_forest(X, y, parameters, persist=True):
+    """
+    Fit a random forest reproducibly, in parallel within the CPU budget, and persist it.
+
+    The forest is seeded with RANDOM_FOREST_SEED, so the same training data always gives the same
+    forest. That makes it safe to load a stored forest instead of fitting it again, also after a
+    restart. The fitting thread already holds one CPU of the budget; up to RANDOM_FOREST_MAX_JOBS - 1
+    further CPUs are used if they are free.
+
+    Parameters:
+    X (numpy.ndarray or SparseFingerprints): Training data matrix.
+    y (numpy.ndarray): Target labels.
+    parameters (dict): Hyperparameters as returned by get_model_parameters.
+    persist (bool): Whether the forest is loaded from and saved to the model store. Default is True.
+
+    Returns:
+    RandomForestClassifier: The fitted Random Forest model, set to predict single-threaded.
+    """
+    forest_parameters = {
+        'n_estimators': parameters['n_estimators'],
+        'max_depth': parameters['max_depth'],
+        'max_features': parameters['max_features'],
+        'random_state': RANDOM_FOREST_SEED
+    }
+
+    def fit():
+        with cpu_budget.reserve(RANDOM_FOREST_MAX_JOBS - 1, blocking=False) as extra_cpus:
+            model = fit_random_forest(X, y, n_jobs=1 + extra_cpus, **forest_parameters)
+        logger.info(f"Fitted random forest with {1 + extra_cpus} jobs")
+        model.set_params(n_jobs=None)
+        return model
+
+    if not persist:
+        return fit()
+    return model_store.get_or_fit(content_digest(X, y, forest_parameters), fit)
+
+
+def predict_with_model(config, model, X_new):
+    """
+    Predict the rooms for all rows of X_new with a fitted model.
+
+    Invalid queries, e.g. with NaN values, raise one of PREDICTION_ERRORS; callers log them and answer
+    with an empty prediction.
+
+    Parameters:
+    config (PredictConfig): The prediction configuration.
+    model (object): The fitted model.
+    X_new (numpy.ndarray): Query matrix.
+
+    Returns:
+    list: One tuple of predicted room, distance and optional value per row. The optional value is the
+          used gamma for SVMs and -1 otherwise.
+    """
+    algorithm = config.algorithm
+
+    if algorithm in ['knn_sorensen', 'knn_euclidean']:
+        return [(predicted_room, distance, -1) for predicted_room, distance in predict_knn(model, X_new)]
+    elif algorithm == 'random_forest':
+        return [(predicted_room, distance, -1) for predicted_room, distance in predict_random_forest(model, X_new)]
+    elif algorithm in ['svm_linear', 'svm_rbf']:
+        if isinstance(model, SingleRoomModel):
+            return [(model.room_id, 0.0, -1)] * X_new.shape[0]
+        return predict_svm(model, X_new)
+    raise ValueError(f"Invalid algorithm. Must be one of {ALGORITHMS}")
+
+
+def compute_predictions(snapshot, config, scans):
+    """
+    Predict the rooms for several scans that share one configuration, without the prediction cache.
+
+    The filtered training matrix is built once for all scans that lead to the same filters, and the
+    model is fitted once per registry key, i.e. once for all scans whose preprocessed training matrix
+    is identical. The query rows of such a group are then predicted together. Whether scans share a
+    model depends on the configuration: with use_remove_unreceived_bssids, the 'use_received' strategy
+    or candidate_rooms, the training matrix depends on the scan itself (see get_query_dependencies).
+
+    Parameters:
+    snapshot (FingerprintSnapshot): The fingerprint snapshot to train on.
+    config (PredictConfig): The prediction configuration.
+    scans (list): One dictionary mapping 'bssid' to 'signal_strength' per scan.
+
+    Returns:
+    list: One dictionary per scan, either with 'room_name', 'distance', 'distance_mode' and 'optional_value'
+          or with 'error'.
+    """
+    matrix = snapshot.matrix
+    results = [None] * len(scans)
+
+    training_key = None
+    training_matrix = None
+
+    def get_training_matrix(index):
+        nonlocal training_key, training_matrix
+        received_bssids = tuple(received_features[index]) if config.use_remove_unreceived_bssids else None
+        rooms = tuple(candidate_rooms[index]) if candidate_rooms[index] is not None else None
+        if training_matrix is None or (received_bssids, rooms) != training_key:
+            training_key = (received_bssids, rooms)
+            training_matrix = build_training_matrix(matrix, config, scans[index], config.ignore_measurements,
+                                                    candidate_rooms[index])
+        return training_matrix
+
+    # First pass: preprocess every scan and group the query rows by model key. Only the training
+    # matrix of the last scan is kept, so memory does not grow with the number of groups.
+    groups = {}
+    last_index = None
+    last_X = None
+    received_features = [matrix.get_received_features(received_data) for received_data in scans]
+    candidate_rooms = [select_candidate_rooms(snapshot, config, received_data, config.ignore_measurements)
+                       for received_data in scans]
+    for index, received_data in enumerate(scans):
+        X, y, mac_address_list = get_training_matrix(index)
+        if X.size == 0 or y.size == 0:
+            results[index] = {"error": "Training data is empty. Check the input data."}
+            continue
+
+        X_scaled, X_new, min_rssi_value = preprocess(X, mac_address_list, config, received_data)
+        model_key = make_model_key(snapshot.version, config, received_features[index], min_rssi_value,
+                                   candidate_rooms[index])
+        groups.setdefault(model_key, []).append((index, X_new))
+        last_index, last_X = index, X_scaled
+
+    # Second pass: fit (or look up) one model per group and predict all of its query rows at once
+    for model_key, members in groups.items():
+        first_index = members[0][0]
+        fitted = []
+
+        def fit():
+            X, y, mac_address_list = get_training_matrix(first_index)
+            if first_index == last_index:
+                X_scaled = last_X
+            else:
+                X_scaled = preprocess(X, mac_address_list, config, scans[first_index])[0]
+            with time_stage('fit', config.algorithm, 'miss'):
+                model = fit_model(config, X_scaled, y, query_dependent=is_query_dependent(model_key))
+            fitted.append(True)
+            return model
+
+        X_new = np.vstack([row for _, row in members])
+        try:
+            start_time = time.perf_counter()
+            model = model_registry.get_or_fit(model_key, fit)
+            if not fitted:
+                observe_stage('fit', config.algorithm, time.perf_counter() - start_time, 'hit')
+            with time_stage('predict', config.algorithm):
+                predictions = predict_with_model(config, model, X_new)
+        except PREDICTION_ERRORS:
+            logger.exception(f"Prediction of {len(members)} scans with {config.algorithm} failed")
+            predictions = [(None, None, -1)] * len(members)
+        for (index, _), (predicted_room, distance, optional_value) in zip(members, predictions):
+            results[index] = {
+                "room_name": snapshot.get_room_name(predicted_room),
+                "distance": distance,
+                "distance_mode": get_distance_mode(config),
+                "optional_value": optional_value
+            }
+
+    return results
+
+
+def predict_scans(snapshot, config, scans):
+    """
+    Predict the rooms for several scans that share one configuration.
+
+    Scans whose prediction is in the prediction cache are answered from it; the others are predicted
+    together by compute_predictions and their results are cached.
+
+    Parameters:
+    snapshot (FingerprintSnapshot): The fingerprint snapshot to train on.
+    config (PredictConfig): The prediction configuration.
+    scans (list): One dictionary mapping 'bssid' to 'signal_strength' per scan.
+
+    Returns:
+    list: One dictionary per scan, see compute_predictions.
+    """
+    if not prediction_cache.enabled:
+        return compute_predictions(snapshot, config, scans)
+
+    keys = [prediction_cache.make_key(snapshot.version, config, received_data) for received_data in scans]
+    results = [prediction_cache.get(key) for key in keys]
+    missing = [index for index, result in enumerate(results) if result is None]
+    if missing:
+        computed = compute_predictions(snapshot, config, [scans[index] for index in missing])
+        for index, result in zip(missing, computed):
+            prediction_cache.put(keys[index], result)
+            results[index] = result
+    return results
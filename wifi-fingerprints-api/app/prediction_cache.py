@@ -0,0 +1,188 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from prometheus_client import Counter, Gauge
+
+from model_registry import PREPROCESSING_OPTIONS, ALGORITHM_OPTIONS
+
+logger = logging.getLogger(__name__)
+
+PREDICTION_CACHE_MAX_ENTRIES = int(os.getenv("PREDICTION_CACHE_MAX_ENTRIES", "10000"))
+PREDICTION_CACHE_TTL = float(os.getenv("PREDICTION_CACHE_TTL", "30"))
+# Step in dB to which signal strengths are rounded in the cache key, 0 keeps them exact
+PREDICTION_CACHE_RSSI_STEP = int(os.getenv("PREDICTION_CACHE_RSSI_STEP", "0"))
+
+PREDICTION_CACHE_LOOKUPS = Counter(
+    "prediction_cache_lookups",
+    "Lookups of the prediction cache by result ('hit' or 'miss')",
+    ["result"]
+)
+PREDICTION_CACHE_ENTRIES = Gauge(
+    "prediction_cache_entries",
+    "Number of entries in the prediction cache"
+)
+
+
+def quantize_signal_strength(signal_strength, step):
+    """
+    Round a signal strength to a multiple of step.
+
+    Parameters:
+    signal_strength (int): The signal strength in dBm.
+    step (int): The step in dB, 0 or 1 keeps the value.
+
+    Returns:
+    int: The rounded signal strength.
+    """
+    if step <= 1:
+        return signal_strength
+    return int(round(signal_strength / step)) * step
+
+
+def make_fingerprint_key(received_data, step=PREDICTION_CACHE_RSSI_STEP):
+    """
+    Build the canonical form of a scan.
+
+    Parameters:
+    received_data (dict): Dictionary mapping 'bssid' to 'signal_strength', sorted by BSSID as returned by
+                          process_received_data.
+    step (int): Step in dB to which the signal strengths are rounded. Default is PREDICTION_CACHE_RSSI_STEP.
+
+    Returns:
+    tuple: Pairs of BSSID and rounded signal strength, sorted by BSSID.
+    """
+    return tuple((bssid, quantize_signal_strength(signal_strength, step))
+                 for bssid, signal_strength in sorted(received_data.items()))
+
+
+def make_prediction_key(version, config, received_data, step=PREDICTION_CACHE_RSSI_STEP):
+    """
+    Build the cache key of the prediction of a scan.
+
+    Parameters:
+    version (int): Dataset version of the fingerprint snapshot.
+    config (PredictConfig): The prediction configuration.
+    received_data (dict): Dictionary mapping 'bssid' to 'signal_strength' of the scan.
+    step (int): Step in dB to which the signal strengths are rounded. Default is PREDICTION_CACHE_RSSI_STEP.
+
+    Returns:
+    tuple: Dataset version, ignored measurements, preprocessing options, algorithm, hyperparameters and the
+           canonical fingerprint.
+    """
+    ignore_measurements = tuple(sorted(set(config.ignore_measurements or ())))
+    preprocessing = tuple(getattr(config, option) for option in PREPROCESSING_OPTIONS)
+    hyperparameters = tuple(getattr(config, option) for option in ALGORITHM_OPTIONS.get(config.algorithm, ()))
+    return (version, ignore_measurements, preprocessing, config.algorithm, hyperparameters,
+            make_fingerprint_key(received_data, step))
+
+
+class PredictionCache:
+    """
+    PredictionCache keeps the results of recent predictions, so that repeated scans of stationary devices
+    are answered without running the pipeline.
+
+    The key contains the dataset version of the snapshot, so results of older data are never returned;
+    they are removed by clear() when measurements are added or the database is reset, or age out by TTL
+    and LRU eviction. With rssi_step > 1, scans whose signal strengths round to the same values share
+    one entry and get the prediction of the first of them.
+
+    Attributes:
+    - max_entries (int): Maximum number of cached predictions, 0 disables the cache.
+    - ttl (float): Seconds after which a cached prediction expires.
+    - rssi_step (int): Step in dB to which the signal strengths are rounded in the key.
+    """
+
+    def __init__(self, max_entries=PREDICTION_CACHE_MAX_ENTRIES, ttl=PREDICTION_CACHE_TTL,
+                 rssi_step=PREDICTION_CACHE_RSSI_STEP):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.rssi_step = rssi_step
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.ttl > 0
+
+    def make_key(self, version, config, received_data):
+        return make_prediction_key(version, config, received_data, self.rssi_step)
+
+    def get(self, key):
+        """
+        Return a cached prediction.
+
+        Parameters:
+        key (tuple): The key built by make_key.
+
+        Returns:
+        dict: A copy of the cached result, or None if there is no valid entry.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._entries[key]
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                PREDICTION_CACHE_LOOKUPS.labels(result='miss').inc()
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        PREDICTION_CACHE_LOOKUPS.labels(result='hit').inc()
+        return dict(entry[1])
+
+    def put(self, key, result):
+        """
+        Store a prediction.
+
+        Parameters:
+        key (tuple): The key built by make_key.
+        result (dict): The prediction result.
+        """
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, dict(result))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            PREDICTION_CACHE_ENTRIES.set(len(self._entries))
+
+    def clear(self):
+        """
+        Remove all predictions from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+            PREDICTION_CACHE_ENTRIES.set(0)
+
+    def stats(self):
+        """
+        Return the settings and counters of the cache.
+
+        Returns:
+        dict: Number of entries, limits, hits, misses, hit rate, expired and evicted entries.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'rssi_step': self.rssi_step,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'expired': self.expired,
+                'evictions': self.evictions
+            }
+
+
+prediction_cache = PredictionCache()
@@ -0,0 +1,190 @@
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/data/profiles")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "100"))
+
+# Request header that asks for a profile of the request
+PROFILE_HEADER = "X-Profile"
+# Paths of the endpoints that can be profiled
+PROFILED_PATH_PREFIX = "/measurements"
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """
+    StackSampler periodically records the call stacks of all threads of the process.
+
+    A request runs on the event loop, the default threadpool and the compute pool, so all threads are
+    sampled and every stack starts with the name of its thread. Requests that run at the same time end
+    up in the same profile; the thread names tell them apart only partially. The samples are counted
+    per stack in the collapsed format ("frame;frame;frame count") read by flamegraph.pl and speedscope.
+
+    Attributes:
+    - interval (float): Seconds between two samples.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(frame_label(frame))
+                    frame = frame.f_back
+                labels.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(labels))] += 1
+            self.samples += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self):
+        """
+        Return the recorded stacks in the collapsed format.
+
+        Returns:
+        str: One line per distinct stack with its number of samples.
+        """
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class RequestProfiler:
+    """
+    RequestProfiler decides which requests are profiled and stores their profiles.
+
+    A request is profiled if it sends the X-Profile header, or at random with the probability
+    sample_rate, which can be changed at runtime. Only one request is profiled at a time; others are
+    served without profile. When profiling is not requested, the cost per request is one header
+    lookup and one random number. At most max_files profiles are kept, the oldest are removed.
+
+    Attributes:
+    - directory (str): Directory of the profile files.
+    - sample_rate (float): Share of the requests that are profiled without the header.
+    - max_files (int): Number of profile files to keep.
+    """
+
+    def __init__(self, directory=PROFILE_DIR, sample_rate=PROFILE_SAMPLE_RATE, max_files=PROFILE_MAX_FILES):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.max_files = max_files
+        self._active = threading.Lock()
+        self.profiles = 0
+        self.skipped = 0
+
+    def wants_profile(self, request):
+        """
+        Return whether a request should be profiled.
+
+        Parameters:
+        request (Request): The incoming request.
+
+        Returns:
+        bool: True if the request asks for a profile or was sampled.
+        """
+        if not request.url.path.startswith(PROFILED_PATH_PREFIX):
+            return False
+        if request.headers.get(PROFILE_HEADER):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def start(self):
+        """
+        Start a profile, unless another request is being profiled.
+
+        Returns:
+        StackSampler: The running sampler, or None if another profile is running.
+        """
+        if not self._active.acquire(blocking=False):
+            self.skipped += 1
+            return None
+        sampler = StackSampler()
+        sampler.start()
+        return sampler
+
+    def finish(self, sampler, request, duration):
+        """
+        Stop a profile and write it to the profile directory.
+
+        Parameters:
+        sampler (StackSampler): The sampler returned by start.
+        request (Request): The profiled request.
+        duration (float): Duration of the request in seconds.
+
+        Returns:
+        str: Name of the written file, or None if it could not be written.
+        """
+        try:
+            sampler.stop()
+        finally:
+            self._active.release()
+
+        path_name = re.sub(r"[^A-Za-z0-9]+", "_", request.url.path).strip("_")
+        now = time.time()
+        timestamp = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}.{int(now * 1000) % 1000:03d}"
+        file_name = f"{timestamp}_{request.method}_{path_name}_{int(duration * 1000)}ms.folded"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, file_name), "w") as file:
+                file.write(sampler.collapsed())
+        except OSError as e:
+            logger.warning(f"Could not write profile {file_name}: {e}")
+            return None
+        self.profiles += 1
+        logger.info(f"Profiled {request.method} {request.url.path} with {sampler.samples} samples: {file_name}")
+        self._remove_old_profiles()
+        return file_name
+
+    def _remove_old_profiles(self):
+        entries = sorted((entry for entry in os.scandir(self.directory) if entry.name.endswith(".folded")),
+                         key=lambda entry: entry.name)
+        for entry in entries[:max(0, len(entries) - self.max_files)]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        """
+        Return the settings and counters of the profiler.
+
+        Returns:
+        dict: Directory, sample rate, number of written and skipped profiles.
+        """
+        return {
+            "directory": self.directory,
+            "sample_rate": self.sample_rate,
+            "profiles": self.profiles,
+            "skipped": self.skipped
+        }
+
+
+request_profiler = RequestProfiler()
@@ -0,0 +1,129 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from neighbors import euclidean_distances
+
+# Signal strength assumed for a BSSID that a room or a query did not see
+MISSING_SIGNAL_STRENGTH = -100.0
+
+
+def room_sums(matrix, rows):
+    """
+    Sum up the observed signal strengths and their counts per room.
+
+    Parameters:
+    matrix (FingerprintMatrix): The fingerprints.
+    rows (numpy.ndarray): Row indices of the measurements to sum up.
+
+    Returns:
+    tuple: Room IDs, and sums and counts of shape (n_rooms, n_columns).
+    """
+    room_ids, room_codes = np.unique(matrix.y[rows], return_inverse=True)
+    present = matrix.positions[rows] >= 0
+    room_rows = csr_matrix((np.ones(rows.size), (room_codes, np.arange(rows.size))),
+                           shape=(room_ids.size, rows.size))
+    sums = np.asarray(room_rows @ np.where(present, matrix.X[rows], 0.0))
+    counts = np.asarray(room_rows @ present.astype(np.float64))
+    return room_ids, sums, counts
+
+
+class RoomCentroids:
+    """
+    RoomCentroids holds the averaged fingerprint of every room, in the column space of a FingerprintMatrix.
+
+    The centroid of a room is the mean signal strength of each BSSID over the measurements of the room
+    that saw it, as in calculate_average_signal_strength, and MISSING_SIGNAL_STRENGTH for BSSIDs the room
+    never saw. Ranking the rooms of a query by the Euclidean distance to their centroids costs one pass
+    over n_rooms instead of n_measurements rows. The centroids belong to one snapshot; append() extends
+    them for an appended matrix without summing up the existing rows again.
+
+    Attributes:
+    - room_ids (numpy.ndarray): Room ID of each centroid.
+    - sums (numpy.ndarray): Sum of the observed signal strengths per room and column.
+    - counts (numpy.ndarray): Number of observed signal strengths per room and column.
+    - centroids (numpy.ndarray): Averaged fingerprint per room and column.
+    """
+
+    def __init__(self, room_ids, sums, counts):
+        self.room_ids = room_ids
+        self.sums = sums
+        self.counts = counts
+        self.centroids = self._average(sums, counts)
+
+    @staticmethod
+    def _average(sums, counts):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(counts > 0, sums / counts, MISSING_SIGNAL_STRENGTH)
+
+    @classmethod
+    def from_matrix(cls, matrix):
+        """
+        Compute the centroids of all rooms of a matrix.
+
+        Parameters:
+        matrix (FingerprintMatrix): The fingerprints.
+
+        Returns:
+        RoomCentroids: The centroids.
+        """
+        return cls(*room_sums(matrix, np.arange(matrix.X.shape[0])))
+
+    def append(self, matrix, start_row):
+        """
+        Return the centroids of a matrix that was extended by FingerprintMatrix.append.
+
+        Parameters:
+        matrix (FingerprintMatrix): The extended matrix.
+        start_row (int): Index of the first new row.
+
+        Returns:
+        RoomCentroids: The centroids including the new rows.
+        """
+        new_room_ids, new_sums, new_counts = room_sums(matrix, np.arange(start_row, matrix.X.shape[0]))
+        room_ids = np.union1d(self.room_ids, new_room_ids)
+        sums = np.zeros((room_ids.size, matrix.X.shape[1]))
+        counts = np.zeros(sums.shape)
+        old_rooms = np.searchsorted(room_ids, self.room_ids)
+        sums[old_rooms, :self.sums.shape[1]] = self.sums
+        counts[old_rooms, :self.counts.shape[1]] = self.counts
+        new_rooms = np.searchsorted(room_ids, new_room_ids)
+        sums[new_rooms] += new_sums
+        counts[new_rooms] += new_counts
+        return RoomCentroids(room_ids, sums, counts)
+
+    def rank(self, matrix, received_data, n_rooms, ignore_rows=None):
+        """
+        Return the rooms whose centroids are closest to a query.
+
+        Parameters:
+        matrix (FingerprintMatrix): The matrix the centroids were computed from.
+        received_data (dict): Dictionary mapping 'bssid' to 'signal_strength' of the query.
+        n_rooms (int): Number of rooms to return.
+        ignore_rows (numpy.ndarray): Row indices of measurements to leave out of the centroids. Default is None.
+
+        Returns:
+        list: IDs of the n_rooms closest rooms, closest first.
+        """
+        x = np.full(self.centroids.shape[1], MISSING_SIGNAL_STRENGTH)
+        for mac_address, signal_strength in received_data.items():
+            column = matrix.mac_address_index.get(mac_address)
+            if column is not None:
+                x[column] = signal_strength
+
+        centroids = self.centroids
+        room_ids = self.room_ids
+        if ignore_rows is not None and len(ignore_rows) > 0:
+            ignored_room_ids, ignored_sums, ignored_counts = room_sums(matrix, np.asarray(ignore_rows))
+            rooms = np.searchsorted(room_ids, ignored_room_ids)
+            counts = self.counts[rooms] - ignored_counts
+            centroids = centroids.copy()
+            centroids[rooms] = self._average(self.sums[rooms] - ignored_sums, counts)
+            # Rooms without any measurement left are no candidates
+            remaining = np.ones(room_ids.size, dtype=bool)
+            remaining[rooms[~np.any(counts > 0, axis=1)]] = False
+            centroids, room_ids = centroids[remaining], room_ids[remaining]
+
+        distances = euclidean_distances(centroids, x)
+        closest = np.argsort(distances, kind='stable')[:n_rooms]
+        return room_ids[closest].tolist()
+
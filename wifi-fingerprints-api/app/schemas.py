@@ -29,12 +29,20 @@ class MeasurementData(BaseModel):
     timestamp: int
     routers: List[RouterData]
 
-class PredictData(BaseModel):
+class MeasurementBulkData(BaseModel):
     """
-    PredictData represents the structure of the data required for predicting the room based on Wi-Fi fingerprints.
+    MeasurementBulkData represents many Wi-Fi fingerprinting measurements that are added together.
+
+    Attributes:
+    - measurements (List[MeasurementData]): The measurements to add.
+    """
+    measurements: List[MeasurementData]
+
+class PredictConfig(BaseModel):
+    """
+    PredictConfig represents the configuration of the prediction pipeline shared by single and batch predictions.
 
     Attributes:
-    - routers (List[RouterData]): A list of RouterData objects representing the routers detected in the current environment.
     - ignore_measurements (Optional[List[int]]): A list of measurement IDs that should be ignored during prediction.
     - use_remove_unreceived_bssids (Optional[bool]): Whether to remove BSSIDs that were not received during prediction. Default is True.
     - handle_missing_values_strategy (Optional[str]): Strategy for handling missing values in the data. Default is "use_received".
@@ -42,15 +50,19 @@ class PredictData(BaseModel):
     - router_presence_threshold (Optional[float]): A threshold for the presence of routers. Routers below this threshold may be ignored. Default is 0.0.
     - value_scaling_strategy (Optional[str]): Strategy for scaling the values, such as signal strengths. Default is 'none'.
     - router_rssi_threshold (Optional[int]): The minimum signal strength (RSSI) threshold for considering a router in the prediction. Default is -100.
+    - use_sparse_matrix (Optional[bool]): Whether to keep the training matrix sparse, storing only the observed signal strengths. Default is False.
+    - candidate_rooms (Optional[int]): Two-stage prediction: number of rooms preselected by the distance to the averaged fingerprint of each room, the algorithm is then trained on their measurements only. Default is 0, which trains on all rooms.
     - algorithm (Optional[str]): The algorithm to use for room prediction, such as 'knn_euclidean', 'random_forest', etc. Default is 'knn_euclidean'.
     - k_value (Optional[int]): The 'k' value to use for K-Nearest Neighbors (KNN) algorithms. Default is 5.
     - weights (Optional[str]): The weighting strategy for KNN algorithms. Default is 'uniform'.
+    - knn_index (Optional[str]): How KNN algorithms find the neighbors: 'brute' (scan all measurements), 'tree' (exact KD or ball tree) or 'ivf' (approximate, clusters the measurements). The index is built once per fitted model, so 'tree' and 'ivf' only help configurations whose training data does not depend on the query, i.e. without ignore_measurements, use_remove_unreceived_bssids, the 'use_received' strategy, value scaling and candidate_rooms; other configurations always scan all measurements. Default is 'brute'.
+    - knn_probes (Optional[int]): Number of clusters searched per query with the 'ivf' index; more probes give a higher recall at a higher latency. Default is 8.
     - n_estimators (Optional[int]): Number of trees in the Random Forest algorithm. Default is 300.
     - c_value (Optional[float]): The regularization parameter for Support Vector Machines (SVM). Default is 1.0.
     - gamma_value (Optional[float]): The kernel coefficient for SVM. Default is 1.0.
+    - svm_confidence (Optional[str]): How SVMs compute the distance: 'probability' (Platt scaling with internal cross-validation) or 'decision_function' (softmax of the decision function, no cross-validation). Default is 'probability'.
     - max_depth (Optional[int]): The maximum depth of trees in the Random Forest algorithm. Default is None.
     """
-    routers: List[RouterData]
     ignore_measurements: Optional[List[int]] = None
     use_remove_unreceived_bssids: Optional[bool] = True
     handle_missing_values_strategy: Optional[str] = "use_received"
@@ -58,11 +70,46 @@ class PredictData(BaseModel):
     router_presence_threshold: Optional[float] = 0.0
     value_scaling_strategy: Optional[str] = 'none'
     router_rssi_threshold: Optional[int] = -100
+    use_sparse_matrix: Optional[bool] = False
+    candidate_rooms: Optional[int] = 0
     algorithm: Optional[str] = 'knn_euclidean'
     k_value: Optional[int] = 5
     weights: Optional[str] = 'uniform'
+    knn_index: Optional[str] = 'brute'
+    knn_probes: Optional[int] = 8
     n_estimators: Optional[int] = 300
     c_value: Optional[float] = 1.0
     gamma_value: Optional[str] = "auto"
+    svm_confidence: Optional[str] = 'probability'
     max_depth: Optional[Union[int, str]] = "None"
     max_features: Optional[Union[int, float, str]] = "sqrt"
+
+class PredictData(PredictConfig):
+    """
+    PredictData represents the structure of the data required for predicting the room based on Wi-Fi fingerprints.
+
+    Attributes:
+    - routers (List[RouterData]): A list of RouterData objects representing the routers detected in the current environment.
+    - All configuration attributes of PredictConfig.
+    """
+    routers: List[RouterData]
+
+class PredictBatchData(PredictConfig):
+    """
+    PredictBatchData represents several Wi-Fi scans that are predicted with one shared configuration.
+
+    Attributes:
+    - scans (List[List[RouterData]]): One list of RouterData objects per scan.
+    - All configuration attributes of PredictConfig.
+    """
+    scans: List[List[RouterData]]
+
+class EvaluateData(PredictConfig):
+    """
+    EvaluateData represents a leave-one-out evaluation of one prediction configuration.
+
+    Attributes:
+    - measurement_ids (Optional[List[int]]): IDs of the measurements to predict. Default is None, which predicts all stored measurements.
+    - All configuration attributes of PredictConfig.
+    """
+    measurement_ids: Optional[List[int]] = None
@@ -0,0 +1,183 @@
+import fcntl
+import json
+import logging
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+from fingerprint_matrix import FingerprintMatrix
+
+logger = logging.getLogger(__name__)
+
+# Directory shared by all workers, preferably on a tmpfs such as /dev/shm. An empty string disables sharing.
+SHARED_MATRIX_DIR = os.getenv("SHARED_MATRIX_DIR", "")
+# Number of published versions to keep besides the current one
+SHARED_MATRIX_KEEP = int(os.getenv("SHARED_MATRIX_KEEP", "2"))
+
+CURRENT_FILE = "current"
+LOCK_FILE = "lock"
+META_FILE = "meta.json"
+ARRAYS = ('X', 'positions', 'y', 'measurement_ids', 'router_ids')
+
+
+class SharedMatrixStore:
+    """
+    SharedMatrixStore publishes the fingerprint matrix into a directory that all worker processes map
+    read-only, so the training data is held once per host instead of once per worker.
+
+    Each published version is a directory with one .npy file per array of the FingerprintMatrix and a
+    meta.json with the per-row and per-column lists, the room names, the generation and change ID it
+    reflects and the change IDs below it that were not committed yet. Change IDs restart when the change
+    log is recreated, so a version is only attached for the generation it was built from.
+    A version is written under a temporary name and renamed, and the 'current' file that names the
+    current version is replaced atomically, so workers never see a partial version. Workers map the
+    arrays with np.load(mmap_mode='r'); on a tmpfs the pages are shared memory, elsewhere they are
+    shared through the page cache. Old versions are removed while workers may still map them, which
+    is safe because a removed file stays readable until its last mapping is closed. All operations run
+    under an exclusive file lock, so only one worker builds a new version at a time.
+
+    Attributes:
+    - directory (str): Directory of the published versions. An empty string disables the store.
+    - keep (int): Number of older versions to keep.
+    """
+
+    def __init__(self, directory=SHARED_MATRIX_DIR, keep=SHARED_MATRIX_KEEP):
+        self.directory = directory
+        self.keep = keep
+        self._local_lock = threading.Lock()
+        self.published = 0
+        self.attached = 0
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    @contextmanager
+    def lock(self):
+        """
+        Hold the lock of the store across threads and processes.
+        """
+        with self._local_lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, LOCK_FILE), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _current_name(self):
+        try:
+            with open(os.path.join(self.directory, CURRENT_FILE)) as file:
+                return file.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def attach(self, generation, min_change_id, required_change_ids=()):
+        """
+        Map the current version, if it belongs to a given generation and includes all changes up to a given
+        change. Call under lock().
+
+        Parameters:
+        generation (str): Generation of the change log, see snapshot.load_generation.
+        min_change_id (int): ID of the latest change the matrix has to include.
+        required_change_ids (list): IDs of changes that must not be missing from the matrix, i.e. gaps that
+                                    were filled since. Default is an empty tuple.
+
+        Returns:
+        tuple: The read-only FingerprintMatrix, the room names, the change ID and the missing change IDs of the
+               version, or None if there is no current version that includes the requested changes.
+        """
+        name = self._current_name()
+        if name is None:
+            return None
+        path = os.path.join(self.directory, name)
+        try:
+            with open(os.path.join(path, META_FILE)) as file:
+                meta = json.load(file)
+            missing_change_ids = {int(change_id): found_at
+                                  for change_id, found_at in meta.get('missing_change_ids', {}).items()}
+            if meta.get('generation') != generation or meta['change_id'] < min_change_id:
+                return None
+            if any(change_id in missing_change_ids for change_id in required_change_ids):
+                return None
+            arrays = {array: np.load(os.path.join(path, f"{array}.npy"), mmap_mode='r') for array in ARRAYS}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not attach shared fingerprint matrix {path}: {e}")
+            return None
+
+        matrix = FingerprintMatrix(arrays['X'], arrays['positions'], arrays['y'], arrays['measurement_ids'],
+                                   meta['device_ids'], arrays['router_ids'], meta['mac_address_list'], meta['ssids'])
+        room_names = {int(room_id): room_name for room_id, room_name in meta['room_names'].items()}
+        self.attached += 1
+        logger.info(f"Attached shared fingerprint matrix {name} with {matrix.X.shape[0]} measurements")
+        return matrix, room_names, meta['change_id'], missing_change_ids
+
+    def publish(self, matrix, room_names, generation, change_id, missing_change_ids=None):
+        """
+        Write a matrix as new current version and remove old versions. Call under lock().
+
+        Parameters:
+        matrix (FingerprintMatrix): The matrix to publish.
+        room_names (dict): Mapping of room IDs to room names.
+        generation (str): Generation of the change log the matrix was built from.
+        change_id (int): ID of the last change log entry included in the matrix.
+        missing_change_ids (dict): Change IDs below change_id that are not included yet. Default is None.
+        """
+        name = f"v{change_id}-{os.getpid()}-{self.published}"
+        path = os.path.join(self.directory, name)
+        temporary_path = f"{path}.tmp"
+        try:
+            os.makedirs(temporary_path)
+            for array in ARRAYS:
+                np.save(os.path.join(temporary_path, f"{array}.npy"), np.ascontiguousarray(getattr(matrix, array)))
+            with open(os.path.join(temporary_path, META_FILE), "w") as file:
+                json.dump({
+                    'generation': generation,
+                    'change_id': change_id,
+                    'device_ids': list(matrix.device_ids),
+                    'mac_address_list': list(matrix.mac_address_list),
+                    'ssids': list(matrix.ssids),
+                    'room_names': room_names,
+                    'missing_change_ids': missing_change_ids or {}
+                }, file)
+            os.rename(temporary_path, path)
+
+            current_path = os.path.join(self.directory, CURRENT_FILE)
+            with open(f"{current_path}.tmp", "w") as file:
+                file.write(name)
+            os.replace(f"{current_path}.tmp", current_path)
+        except OSError as e:
+            logger.warning(f"Could not publish shared fingerprint matrix {name}: {e}")
+            shutil.rmtree(temporary_path, ignore_errors=True)
+            return
+        self.published += 1
+        logger.info(f"Published shared fingerprint matrix {name} with {matrix.X.shape[0]} measurements")
+        self._remove_old_versions(name)
+
+    def _remove_old_versions(self, current_name):
+        versions = sorted((entry for entry in os.scandir(self.directory)
+                           if entry.is_dir() and entry.name != current_name),
+                          key=lambda entry: entry.stat().st_mtime)
+        for entry in versions[:max(0, len(versions) - self.keep)]:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+    def stats(self):
+        """
+        Return the settings and counters of the store.
+
+        Returns:
+        dict: Directory, current version and the number of published and attached versions of this process.
+        """
+        return {
+            "directory": self.directory,
+            "current": self._current_name() if self.enabled else None,
+            "published": self.published,
+            "attached": self.attached
+        }
+
+
+shared_matrices = SharedMatrixStore()
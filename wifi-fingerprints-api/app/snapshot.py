@@ -0,0 +1,501 @@
+import logging
+import os
+import threading
+import time
+import uuid
+
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from fingerprint_matrix import FingerprintMatrix
+from room_centroids import RoomCentroids
+from shared_matrix import shared_matrices
+from models import Room, Measurement, Router, MeasurementRouter, MeasurementChange
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two checks of the change log for writes made by other workers
+SNAPSHOT_SYNC_INTERVAL = float(os.getenv("SNAPSHOT_SYNC_INTERVAL", "1.0"))
+# Seconds a missing change ID is awaited before its transaction is assumed to be rolled back
+SNAPSHOT_GAP_TIMEOUT = float(os.getenv("SNAPSHOT_GAP_TIMEOUT", "60"))
+# Number of change IDs before the loaded change that are checked for gaps on a full load
+SNAPSHOT_GAP_WINDOW = 1000
+
+
+def load_fingerprint_rows(db: Session, batch_size=1000, measurement_ids=None):
+    """
+    Load stored fingerprints from the database in long format.
+
+    All rows are fetched with one joined query. The result is streamed from the server in
+    batches instead of being buffered in full by the database driver.
+
+    Parameters:
+    db (Session): The database session.
+    batch_size (int): Number of rows fetched per round-trip. Default is 1000.
+    measurement_ids (list): Only load these measurements. Default is None, which loads all of them.
+
+    Returns:
+    list: List of dictionaries containing 'measurement_id', 'timestamp', 'device_id', 'room_id', 'router_id', 'bssid',
+          'ssid' and 'signal_strength', one entry per (measurement, router) pair.
+    """
+    query = db.query(
+        Measurement.measurement_id,
+        Measurement.timestamp,
+        Measurement.device_id,
+        Measurement.room_id,
+        MeasurementRouter.router_id,
+        Router.bssid,
+        Router.ssid,
+        MeasurementRouter.signal_strength
+    ).join(MeasurementRouter, MeasurementRouter.measurement_id == Measurement.measurement_id) \
+        .join(Router, Router.router_id == MeasurementRouter.router_id)
+    if measurement_ids is not None:
+        query = query.filter(Measurement.measurement_id.in_(measurement_ids))
+    query = query \
+        .order_by(Measurement.measurement_id, MeasurementRouter.router_id) \
+        .execution_options(stream_results=True) \
+        .yield_per(batch_size)
+
+    return [
+        {
+            'measurement_id': measurement_id,
+            'timestamp': timestamp,
+            'device_id': device_id,
+            'room_id': room_id,
+            'router_id': router_id,
+            'bssid': bssid,
+            'ssid': ssid,
+            'signal_strength': signal_strength
+        }
+        for measurement_id, timestamp, device_id, room_id, router_id, bssid, ssid, signal_strength in query
+    ]
+
+
+def load_room_names(db: Session):
+    """
+    Load the mapping of room IDs to room names.
+
+    Parameters:
+    db (Session): The database session.
+
+    Returns:
+    dict: Dictionary mapping 'room_id' to 'room_name'.
+    """
+    return {room_id: room_name for room_id, room_name in db.query(Room.room_id, Room.room_name).all()}
+
+
+def load_last_change_id(db: Session):
+    """
+    Load the ID of the latest entry of the change log.
+
+    Parameters:
+    db (Session): The database session.
+
+    Returns:
+    int: The latest change ID, or 0 if the log is empty.
+    """
+    return db.query(func.max(MeasurementChange.change_id)).scalar() or 0
+
+
+def new_generation():
+    """
+    Create the identifier of a new generation of the data, see MeasurementChange.
+
+    Returns:
+    str: Random hex string.
+    """
+    return uuid.uuid4().hex
+
+
+def load_generation(db: Session):
+    """
+    Load the generation of the data, i.e. the generation of the latest reset in the change log.
+
+    Parameters:
+    db (Session): The database session.
+
+    Returns:
+    str: The generation, or None if no reset has a generation.
+    """
+    return db.query(MeasurementChange.generation) \
+        .filter(MeasurementChange.change_type == 'reset') \
+        .order_by(MeasurementChange.change_id.desc()) \
+        .limit(1) \
+        .scalar()
+
+
+def ensure_generation(db: Session):
+    """
+    Log a reset that starts a generation if the change log has none, e.g. because its table was just created.
+
+    Parameters:
+    db (Session): The database session.
+    """
+    if load_generation(db) is None:
+        db.add(MeasurementChange(change_type='reset', generation=new_generation()))
+        db.commit()
+        logger.info("Started a new generation of the change log")
+
+
+def load_changes(db: Session, after_change_id):
+    """
+    Load the entries of the change log after a given change.
+
+    Parameters:
+    db (Session): The database session.
+    after_change_id (int): ID of the last change that is already applied.
+
+    Returns:
+    list: Tuples of 'change_id', 'measurement_id' and 'change_type', ordered by change ID.
+    """
+    return db.query(MeasurementChange.change_id, MeasurementChange.measurement_id, MeasurementChange.change_type) \
+        .filter(MeasurementChange.change_id > after_change_id) \
+        .order_by(MeasurementChange.change_id) \
+        .all()
+
+
+def find_missing_change_ids(changes, after_change_id, last_change_id, now):
+    """
+    Find the change IDs that are not in the change log yet.
+
+    Change IDs are allocated when a writer inserts its entries, but become visible when it commits, so
+    a writer that commits after a writer with a higher change ID leaves a gap in the log that is filled
+    later. A gap may also stay forever if its transaction was rolled back. IDs up to the last reset are
+    never missing, since a reset deletes the older entries.
+
+    Parameters:
+    changes (list): Entries of the change log after after_change_id, see load_changes.
+    after_change_id (int): ID after which gaps are searched.
+    last_change_id (int): ID up to which gaps are searched.
+    now (float): Time at which the gaps were found, as Unix timestamp.
+
+    Returns:
+    dict: Dictionary mapping each missing change ID to the time it was found missing.
+    """
+    change_ids = set()
+    for change_id, _, change_type in changes:
+        change_ids.add(change_id)
+        if change_type == 'reset':
+            after_change_id = max(after_change_id, change_id)
+    return {change_id: now for change_id in range(after_change_id + 1, last_change_id + 1)
+            if change_id not in change_ids}
+
+
+class FingerprintSnapshot:
+    """
+    FingerprintSnapshot is an in-memory copy of the training data at a given dataset version.
+
+    A snapshot is never modified after it has been created. New measurements produce a new snapshot
+    with a higher version through append(); deletes make the store load a new snapshot from scratch.
+
+    Attributes:
+    - version (int): Dataset version the snapshot was loaded at.
+    - rows (list): Fingerprints in long format as returned by load_fingerprint_rows, or None for a snapshot
+                   attached to a shared matrix.
+    - room_names (dict): Mapping of room IDs to room names.
+    - change_id (int): ID of the last change log entry included in the snapshot.
+    - generation (str): Generation of the change log that change_id belongs to, see load_generation.
+    - missing_change_ids (dict): Change IDs below change_id that were not committed when the snapshot was
+                                 loaded, mapped to the time they were found missing (see find_missing_change_ids).
+    """
+
+    def __init__(self, version, rows, room_names, change_id=0, matrix=None, centroids=None, missing_change_ids=None,
+                 generation=None):
+        self.version = version
+        self.rows = rows
+        self.room_names = room_names
+        self.change_id = change_id
+        self.generation = generation
+        self.missing_change_ids = missing_change_ids or {}
+        self._matrix = matrix
+        if rows is not None:
+            self.row_count = len(rows)
+            self.max_measurement_id = rows[-1]['measurement_id'] if rows else 0
+        else:
+            self.row_count = int(np.count_nonzero(matrix.positions >= 0))
+            self.max_measurement_id = int(matrix.measurement_ids.max()) if matrix.measurement_ids.size else 0
+        self._centroids = centroids
+
+    @property
+    def matrix(self):
+        """
+        The fingerprints as FingerprintMatrix, built on first use.
+        """
+        if self._matrix is None:
+            self._matrix = FingerprintMatrix.from_rows(self.rows)
+        return self._matrix
+
+    @property
+    def centroids(self):
+        """
+        The RoomCentroids of the matrix, computed on first use.
+        """
+        if self._centroids is None:
+            self._centroids = RoomCentroids.from_matrix(self.matrix)
+        return self._centroids
+
+    def pending_change_ids(self, now):
+        """
+        Return the missing change IDs that are still awaited.
+
+        Parameters:
+        now (float): The current time as Unix timestamp.
+
+        Returns:
+        dict: The entries of missing_change_ids found less than SNAPSHOT_GAP_TIMEOUT seconds ago.
+        """
+        return {change_id: found_at for change_id, found_at in self.missing_change_ids.items()
+                if now - found_at < SNAPSHOT_GAP_TIMEOUT}
+
+    def append(self, version, rows, room_names, change_id, missing_change_ids=None):
+        """
+        Return a snapshot with additional measurements.
+
+        The rows of the new measurements must come after all existing rows, i.e. have larger measurement
+        IDs. A matrix and centroids that were already built are extended instead of being rebuilt.
+
+        Parameters:
+        version (int): Dataset version of the new snapshot.
+        rows (list): Fingerprints of the new measurements in long format.
+        room_names (dict): Mapping of room IDs to room names.
+        change_id (int): ID of the last change log entry included in the new snapshot.
+        missing_change_ids (dict): Change IDs still missing from the new snapshot. Default is None.
+
+        Returns:
+        FingerprintSnapshot: The new snapshot.
+        """
+        matrix = self._matrix.append(rows) if self._matrix is not None else None
+        centroids = None
+        if self._centroids is not None and matrix is not None:
+            centroids = self._centroids.append(matrix, self._matrix.X.shape[0])
+        all_rows = self.rows + rows if self.rows is not None else None
+        return FingerprintSnapshot(version, all_rows, room_names, change_id, matrix, centroids, missing_change_ids,
+                                   self.generation)
+
+    def get_room_name(self, room_id):
+        """
+        Retrieve the room name based on the room ID.
+
+        Parameters:
+        room_id (int): The ID of the room.
+
+        Returns:
+        str: The name of the room or "Unknown" if not found.
+        """
+        return self.room_names.get(room_id, "Unknown")
+
+
+class FingerprintSnapshotStore:
+    """
+    FingerprintSnapshotStore holds the process-wide fingerprint snapshot.
+
+    The snapshot is loaded lazily on first use and kept up to date with the change log: added
+    measurements are appended to it, while a reset (or any change that cannot be appended) makes the
+    next reader load it from scratch. The change log is read when a write of this process requested
+    it, and otherwise at most every SNAPSHOT_SYNC_INTERVAL seconds to pick up writes of other workers.
+    Entries are read by change ID, and gaps in the IDs are read again on every sync until their writer
+    commits or SNAPSHOT_GAP_TIMEOUT has passed, so a writer that commits out of ID order is not missed.
+    Every change increments the dataset version, so a snapshot that was loaded concurrently with a
+    reset is handed to its caller but never installed.
+
+    With a shared matrix store, the snapshot is published once for all worker processes: a worker that
+    needs a newer snapshot first attaches the published matrix if it already includes the latest change
+    of the same generation, and otherwise builds it, publishes it and attaches the published copy, so no
+    worker keeps a private copy of the fingerprints.
+    """
+
+    def __init__(self, sync_interval=SNAPSHOT_SYNC_INTERVAL, shared=shared_matrices):
+        self.sync_interval = sync_interval
+        self.shared = shared
+        self._snapshot = None
+        self._version = 0
+        self._synced_at = 0.0
+        self._sync_requested = False
+        self._state_lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self.loads = 0
+        self.appends = 0
+        self.stale_reads = 0
+
+    @property
+    def version(self):
+        return self._version
+
+    def _is_current(self, snapshot):
+        return snapshot is not None and not self._sync_requested \
+            and time.monotonic() - self._synced_at < self.sync_interval
+
+    def get(self, db: Session):
+        """
+        Return the current snapshot, loading or updating it from the database if necessary.
+
+        Parameters:
+        db (Session): The database session used if the snapshot has to be loaded or updated.
+
+        Returns:
+        FingerprintSnapshot: The current snapshot.
+        """
+        snapshot = self._snapshot
+        if self._is_current(snapshot):
+            return snapshot
+
+        with self._load_lock:
+            snapshot = self._snapshot
+            if self._is_current(snapshot):
+                return snapshot
+
+            with self._state_lock:
+                version = self._version
+                self._sync_requested = False
+            synced_at = time.monotonic()
+            try:
+                if snapshot is None:
+                    new_snapshot = self._load(db, version)
+                else:
+                    new_snapshot = self._sync(db, snapshot, version)
+            except Exception:
+                # Keep the request, so the changes are applied once the database is reachable again
+                self._sync_requested = True
+                raise
+
+            with self._state_lock:
+                if version == self._version:
+                    self._snapshot = new_snapshot
+                    self._version = new_snapshot.version
+                    self._synced_at = synced_at
+            return new_snapshot
+
+    def _load(self, db, version):
+        change_id, generation = load_last_change_id(db), load_generation(db)
+        if not self.shared.enabled:
+            return self._build(db, version, change_id, generation)
+        with self.shared.lock():
+            snapshot = self._attach(version, generation, change_id)
+            if snapshot is None:
+                snapshot = self._publish(self._build(db, version, change_id, generation))
+            return snapshot
+
+    def _build(self, db, version, change_id=None, generation=None):
+        # The change ID is read in the same transaction as the rows, so no change is missed or applied twice
+        if change_id is None:
+            change_id, generation = load_last_change_id(db), load_generation(db)
+        rows = load_fingerprint_rows(db)
+        recent_changes = load_changes(db, max(change_id - SNAPSHOT_GAP_WINDOW, 0))
+        missing_change_ids = find_missing_change_ids(recent_changes, max(change_id - SNAPSHOT_GAP_WINDOW, 0),
+                                                     change_id, time.time())
+        snapshot = FingerprintSnapshot(version, rows, load_room_names(db), change_id,
+                                       missing_change_ids=missing_change_ids, generation=generation)
+        self.loads += 1
+        logger.info(f"Loaded fingerprint snapshot version {version} with {snapshot.row_count} rows")
+        return snapshot
+
+    def _attach(self, version, generation, min_change_id, required_change_ids=()):
+        attached = self.shared.attach(generation, min_change_id, required_change_ids)
+        if attached is None:
+            return None
+        matrix, room_names, change_id, missing_change_ids = attached
+        return FingerprintSnapshot(version, None, room_names, change_id, matrix,
+                                   missing_change_ids=missing_change_ids, generation=generation)
+
+    def _publish(self, snapshot):
+        self.shared.publish(snapshot.matrix, snapshot.room_names, snapshot.generation, snapshot.change_id,
+                            snapshot.missing_change_ids)
+        return self._attach(snapshot.version, snapshot.generation, snapshot.change_id) or snapshot
+
+    def _sync(self, db, snapshot, version):
+        now = time.time()
+        pending = snapshot.pending_change_ids(now)
+        after_change_id = min(min(pending) - 1, snapshot.change_id) if pending else snapshot.change_id
+        changes = [change for change in load_changes(db, after_change_id)
+                   if change[0] > snapshot.change_id or change[0] in pending]
+        if not changes:
+            return snapshot
+
+        last_change_id = max(snapshot.change_id, changes[-1][0])
+        missing_change_ids = {change_id: found_at for change_id, found_at in pending.items()
+                              if change_id not in {change[0] for change in changes}}
+        missing_change_ids.update(find_missing_change_ids(
+            [change for change in changes if change[0] > snapshot.change_id], snapshot.change_id, last_change_id, now))
+
+        if not self.shared.enabled:
+            return self._apply_changes(db, snapshot, version, changes, last_change_id, missing_change_ids)
+        # A reset in the changes starts a new generation
+        generation = load_generation(db) if any(change[2] == 'reset' for change in changes) else snapshot.generation
+        with self.shared.lock():
+            new_snapshot = self._attach(version + 1, generation, last_change_id, [change[0] for change in changes])
+            if new_snapshot is None:
+                new_snapshot = self._publish(self._apply_changes(db, snapshot, version, changes, last_change_id,
+                                                                 missing_change_ids))
+            return new_snapshot
+
+    def _apply_changes(self, db, snapshot, version, changes, last_change_id, missing_change_ids):
+        measurement_ids = [measurement_id for _, measurement_id, change_type in changes if change_type == 'add']
+        if len(measurement_ids) < len(changes) or min(measurement_ids) <= snapshot.max_measurement_id:
+            # Deletes, and measurements committed out of ID order, cannot be appended
+            logger.info("Change log requires a full reload of the fingerprint snapshot")
+            return self._build(db, version + 1)
+
+        rows = load_fingerprint_rows(db, measurement_ids=measurement_ids)
+        room_names = snapshot.room_names
+        if any(row['room_id'] not in room_names for row in rows):
+            room_names = load_room_names(db)
+        self.appends += 1
+        logger.debug(f"Appended {len(measurement_ids)} measurements to the fingerprint snapshot")
+        return snapshot.append(version + 1, rows, room_names, last_change_id, missing_change_ids)
+
+    def is_current(self):
+        """
+        Return whether get() would return the current snapshot without querying the database.
+        """
+        return self._is_current(self._snapshot)
+
+    def get_stale(self):
+        """
+        Return the loaded snapshot without querying the database, even if it may be outdated, e.g. while
+        the database is unavailable.
+
+        Returns:
+        FingerprintSnapshot: The loaded snapshot, or None if no snapshot is loaded.
+        """
+        snapshot = self._snapshot
+        if snapshot is not None:
+            self.stale_reads += 1
+        return snapshot
+
+    def request_sync(self):
+        """
+        Make the next reader apply the change log, e.g. after this process added measurements.
+        """
+        self._sync_requested = True
+
+    def invalidate(self):
+        """
+        Drop the current snapshot and increment the dataset version.
+        """
+        with self._state_lock:
+            self._version += 1
+            self._snapshot = None
+        logger.debug(f"Fingerprint snapshot invalidated, dataset version is now {self._version}")
+
+    def stats(self):
+        """
+        Return information about the current snapshot.
+
+        Returns:
+        dict: Dataset version, whether a snapshot is loaded, its row count and change ID, and the number
+              of full loads, appends and reads of a possibly outdated snapshot.
+        """
+        snapshot = self._snapshot
+        return {
+            'version': self._version,
+            'loaded': snapshot is not None,
+            'rows': snapshot.row_count if snapshot is not None else 0,
+            'change_id': snapshot.change_id if snapshot is not None else 0,
+            'loads': self.loads,
+            'appends': self.appends,
+            'stale_reads': self.stale_reads
+        }
+
+
+fingerprint_snapshots = FingerprintSnapshotStore()
@@ -0,0 +1,150 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+class SparseFingerprints:
+    """
+    SparseFingerprints is a fingerprint matrix stored as CSR with one implicit fill value per column.
+
+    Only the signal strengths that were actually observed are stored. Every other cell has the fill
+    value of its column, which is how missing values are imputed in the sparse pipeline. The dense
+    equivalent of the matrix is therefore observed values where stored and fill values elsewhere.
+
+    Attributes:
+    - observed (scipy.sparse.csr_matrix): Observed signal strengths, explicitly stored.
+    - fill (numpy.ndarray): Fill value of each column.
+    """
+
+    def __init__(self, observed, fill):
+        self.observed = observed
+        self.fill = np.asarray(fill, dtype=np.float64)
+
+    @property
+    def shape(self):
+        return self.observed.shape
+
+    @property
+    def size(self):
+        return self.observed.shape[0] * self.observed.shape[1]
+
+    def _missing_columns(self):
+        """
+        Return a mask of the columns that contain at least one implicit fill value.
+        """
+        stored_per_column = np.bincount(self.observed.indices, minlength=self.shape[1])
+        return stored_per_column < self.shape[0]
+
+    def transform(self, function):
+        """
+        Apply an elementwise function to the stored values and the fill values.
+
+        Parameters:
+        function (callable): Function mapping an array to an array of the same shape.
+
+        Returns:
+        SparseFingerprints: The transformed matrix.
+        """
+        observed = self.observed.copy()
+        observed.data = np.asarray(function(observed.data), dtype=np.float64)
+        return SparseFingerprints(observed, function(self.fill))
+
+    def min(self):
+        """
+        Return the minimum of the dense equivalent.
+        """
+        values = [self.observed.data, self.fill[self._missing_columns()]]
+        return min(value.min() for value in values if value.size)
+
+    def max(self):
+        """
+        Return the maximum of the dense equivalent.
+        """
+        values = [self.observed.data, self.fill[self._missing_columns()]]
+        return max(value.max() for value in values if value.size)
+
+    def var(self):
+        """
+        Return the variance of all cells of the dense equivalent.
+        """
+        n_cells = self.size
+        missing_per_column = self.shape[0] - np.bincount(self.observed.indices, minlength=self.shape[1])
+        total = self.observed.data.sum() + np.dot(missing_per_column, self.fill)
+        total_squares = np.dot(self.observed.data, self.observed.data) + np.dot(missing_per_column, self.fill ** 2)
+        mean = total / n_cells
+        return total_squares / n_cells - mean ** 2
+
+    def shifted(self):
+        """
+        Return the matrix minus the fill values as CSR, so that the implicit zeros are the fill values.
+
+        Per-column shifts do not change distances, tree splits or SVM decisions, so estimators can be
+        fitted on this matrix as long as queries are shifted by the same fill values.
+
+        Returns:
+        scipy.sparse.csr_matrix: The shifted matrix.
+        """
+        shifted = self.observed.copy()
+        shifted.data = shifted.data - self.fill[shifted.indices]
+        return shifted
+
+    def toarray(self):
+        """
+        Return the dense equivalent.
+        """
+        X = np.broadcast_to(self.fill, self.shape).copy()
+        stored_rows = np.repeat(np.arange(self.shape[0]), np.diff(self.observed.indptr))
+        X[stored_rows, self.observed.indices] = self.observed.data
+        return X
+
+
+def sparse_from_dense(X):
+    """
+    Convert a dense matrix with NaN for missing values to a CSR matrix of the observed values.
+
+    Parameters:
+    X (numpy.ndarray): Feature matrix, NaN for missing values.
+
+    Returns:
+    scipy.sparse.csr_matrix: CSR matrix of observed values.
+    """
+    observed = ~np.isnan(X)
+    rows, columns = np.nonzero(observed)
+    indptr = np.concatenate(([0], np.cumsum(observed.sum(axis=1))))
+    return csr_matrix((X[rows, columns], columns.astype(np.int32), indptr), shape=X.shape)
+
+
+class ShiftedEstimator:
+    """
+    ShiftedEstimator fits a sklearn estimator on SparseFingerprints shifted by their fill values.
+
+    The estimator only ever sees the shifted CSR matrix; queries are shifted by the same fill values
+    before they are passed on. All other attributes (classes_, _gamma, ...) are those of the estimator.
+
+    Attributes:
+    - estimator (object): The wrapped sklearn estimator.
+    - fill (numpy.ndarray): Fill values the training data was shifted by.
+    """
+
+    def __init__(self, estimator):
+        self.estimator = estimator
+        self.fill = None
+
+    def fit(self, X, y):
+        self.fill = X.fill
+        # gamma='scale' depends on the variance of X, which the shift would change
+        if getattr(self.estimator, 'gamma', None) == 'scale':
+            X_var = X.var()
+            self.estimator.set_params(gamma=1.0 / (X.shape[1] * X_var) if X_var != 0 else 1.0)
+        self.estimator.fit(X.shifted(), y)
+        return self
+
+    def predict_proba(self, X_new):
+        return self.estimator.predict_proba(np.asarray(X_new) - self.fill)
+
+    def decision_function(self, X_new):
+        return self.estimator.decision_function(np.asarray(X_new) - self.fill)
+
+    def __getattr__(self, name):
+        if name in ('estimator', 'fill'):
+            raise AttributeError(name)
+        return getattr(self.estimator, name)
@@ -4,11 +4,17 @@ from typing import List
 import numpy as np
 import pandas as pd
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.neighbors import KNeighborsClassifier
 from sklearn.svm import SVC
 
+from neighbors import FingerprintKNN
+from sparse_fingerprints import SparseFingerprints, ShiftedEstimator
 from schemas import RouterData
 
+EDUROAM_SSIDS = ['eduroam', 'HowToUseEduroam', 'Gast@HTW']
+
+SVM_CONFIDENCE_MODES = ['probability', 'decision_function']
+
+
 def process_received_data(routers: List[RouterData]):
     """
     Process received WiFi fingerprint data and sort it by MAC address.
@@ -24,92 +30,6 @@ def process_received_data(routers: List[RouterData]):
     return processed_data
 
 
-def process_fingerprint_data(data):
-    """
-    Process fetched WiFi fingerprint data into a suitable format for modeling.
-
-    Parameters:
-    data (list): List of dictionaries containing 'measurement_id', 'room_id', 'signal_strength', 'ssid', and 'bssid'.
-
-    Returns:
-    dict: Nested dictionary where the keys are room IDs and measurement IDs,
-          and the values are lists of fingerprints with 'mac_address', 'signal_strength', and 'ssid'.
-    """
-    rooms = {}
-    for row in data:
-        measurement_id = row['measurement_id']
-        room_id = row['room_id']
-        signal_strength = row['signal_strength']
-        ssid = row['ssid']
-        bssid = row['bssid']
-
-        if room_id not in rooms:
-            rooms[room_id] = {}
-
-        if measurement_id not in rooms[room_id]:
-            rooms[room_id][measurement_id] = []
-
-        rooms[room_id][measurement_id].append(
-            {'mac_address': bssid, 'signal_strength': signal_strength, 'ssid': ssid}
-        )
-
-    return rooms
-
-
-def remove_non_eduroam_bssids(rooms):
-    """
-    Remove non-eduroam BSSIDs from the rooms data.
-
-    Parameters:
-    rooms (dict): Nested dictionary with room IDs and measurement IDs as keys, and lists of fingerprints as values.
-
-    Returns:
-    dict: The filtered rooms dictionary with only 'eduroam' SSIDs.
-    """
-    for room_id in list(rooms.keys()):
-        for measurement_id in list(rooms[room_id].keys()):
-            rooms[room_id][measurement_id] = [
-                router for router in rooms[room_id][measurement_id]
-                if router['ssid'] in ['eduroam', 'HowToUseEduroam', 'Gast@HTW']
-            ]
-            if not rooms[room_id][measurement_id]:
-                del rooms[room_id][measurement_id]
-        if not rooms[room_id]:
-            del rooms[room_id]
-    return rooms
-
-
-def remove_unreceived_bssids(rooms, received_data: List[RouterData]):
-    """
-    Remove all entries in rooms whose MAC address is not in received_data.
-
-    Parameters:
-    rooms (dict): Nested dictionary with room IDs and measurement IDs as keys, and lists of fingerprints as values.
-    received_data (dict): Dictionary where the keys are MAC addresses and the values are associated data (e.g., signal strength).
-
-    Returns:
-    dict: The filtered rooms dictionary where all fingerprints with MAC addresses not present in received_data have been removed.
-    """
-    received_mac_addresses = set(received_data.keys())
-
-    for room_id in list(rooms.keys()):
-        for measurement_id in list(rooms[room_id].keys()):
-            filtered_fingerprint = [
-                entry for entry in rooms[room_id][measurement_id]
-                if entry['mac_address'] in received_mac_addresses
-            ]
-
-            if filtered_fingerprint:
-                rooms[room_id][measurement_id] = filtered_fingerprint
-            else:
-                del rooms[room_id][measurement_id]  # Remove measurement if it has no valid fingerprints
-
-        if not rooms[room_id]:  # Remove room if it has no measurements
-            del rooms[room_id]
-
-    return rooms
-
-
 def calculate_average_signal_strength(rooms):
     """
     Calculate the average signal strength for each MAC address in each room.
@@ -199,6 +119,24 @@ def handle_router_rssi_threshold(X, X_new, router_rssi_threshold=-100):
     return X_scaled, X_new_scaled
 
 
+def handle_router_rssi_threshold_sparse(X, X_new, router_rssi_threshold=-100):
+    """
+    Sparse version of handle_router_rssi_threshold.
+
+    Parameters:
+    X (SparseFingerprints): Training data matrix.
+    X_new (numpy.ndarray): New data matrix.
+    router_rssi_threshold (int): Threshold for router RSSI. Default is -100.
+
+    Returns:
+    tuple: Scaled training and new data matrices.
+    """
+    def cap(values):
+        return np.where(values < router_rssi_threshold, -100, values)
+
+    return X.transform(cap), cap(X_new)
+
+
 def positive_values_representation(rssi_values, min_rssi):
     """
     Convert RSSI values to positive values.
@@ -302,225 +240,261 @@ def value_scaling(X, X_new, min_rssi_value=-100, value_scaling_strategy='none'):
     return X_scaled, X_new_scaled
 
 
-def remove_rare_routers(rooms, threshold):
+def value_scaling_sparse(X, X_new, min_rssi_value=-100, value_scaling_strategy='none'):
     """
-    Remove routers that appear less frequently than the given threshold.
+    Sparse version of value_scaling. The normalization uses the minimum and maximum of the dense equivalent.
 
     Parameters:
-    rooms (dict): Nested dictionary with room IDs and measurement IDs as keys, and lists of fingerprints as values.
-    threshold (float): Minimum required count threshold for routers.
+    X (SparseFingerprints): Training data matrix.
+    X_new (numpy.ndarray): New data matrix.
+    min_rssi_value (int): Minimum RSSI value. Default is -100.
+    value_scaling_strategy (str): Strategy for scaling values. Must be 'none', 'exponential', 'powed', or 'positive'.
 
     Returns:
-    dict: The filtered rooms dictionary with rare routers removed.
+    tuple: Scaled training and new data matrices.
     """
-    filtered_rooms = {}
-
-    for room, measurements in rooms.items():
-        total_measurements = len(measurements)
-
-        router_counts = {}
-        for measurement_id, values in measurements.items():
-            for value in values:
-                mac_address = value['mac_address']
-                if mac_address not in router_counts:
-                    router_counts[mac_address] = 0
-                router_counts[mac_address] += 1
-
-        min_required_count = threshold * total_measurements
+    alpha = 24
+    beta = np.e
 
-        rare_routers = {mac for mac, count in router_counts.items() if count < min_required_count}
+    if value_scaling_strategy == 'exponential':
+        def representation(values):
+            return exponential_representation(values, min_rssi_value, alpha)
+    elif value_scaling_strategy == 'powed':
+        def representation(values):
+            return powed_representation(values, min_rssi_value, beta)
+    elif value_scaling_strategy == 'positive':
+        def representation(values):
+            return positive_values_representation(values, min_rssi_value)
+    elif value_scaling_strategy == 'none':
+        return X, X_new
+    else:
+        raise ValueError("Invalid value_scaling_strategy. Must be 'none', 'exponential', 'powed', 'positive'")
 
-        filtered_measurements = {}
-        for measurement_id, values in measurements.items():
-            filtered_values = [value for value in values if value['mac_address'] not in rare_routers]
-            if filtered_values:
-                filtered_measurements[measurement_id] = filtered_values
+    X_scaled = X.transform(representation)
+    X_new_scaled = representation(X_new)
 
-        if filtered_measurements:
-            filtered_rooms[room] = filtered_measurements
+    min_val, max_val = X_scaled.min(), X_scaled.max()
+    X_scaled = X_scaled.transform(lambda values: (values - min_val) / (max_val - min_val))
+    X_new_scaled = (X_new_scaled - np.min(X_new_scaled)) / (np.max(X_new_scaled) - np.min(X_new_scaled))
 
-    return filtered_rooms
+    return X_scaled, X_new_scaled
 
 
 def handle_missing_values(X, mac_address_list, received_data, strategy='use_received'):
     """
     Handle missing values in the provided data matrix X.
 
+    A fill value is computed once per column and written into all missing cells with a single
+    masked assignment.
+
     Parameters:
-    X (numpy.ndarray): The data matrix with measurements for each room.
+    X (numpy.ndarray): The data matrix with measurements for each room, NaN marks a missing value.
     mac_address_list (list): List of MAC addresses corresponding to the columns of X.
     received_data (dict): Dictionary with new measurement data.
     strategy (str): Strategy to handle missing values ('zero', '-100', 'use_received').
 
     Returns:
-    numpy.ndarray: The updated data matrix X with missing values handled.
+    numpy.ndarray: The updated, C-contiguous float data matrix X with missing values handled.
     """
     if strategy not in ['zero', '-100', 'use_received']:
         raise ValueError("Strategy must be one of 'zero', '-100', or 'use_received'")
 
-    for i in range(X.shape[0]):
-        for j in range(X.shape[1]):
-            if X[i, j] is None:
-                if strategy == 'zero':
-                    X[i, j] = 0
-                elif strategy == '-100':
-                    X[i, j] = -100
-                elif strategy == 'use_received':
-                    mac_address = mac_address_list[j]
-                    X[i, j] = received_data.get(mac_address, 0)
+    X = np.ascontiguousarray(X, dtype=np.float64)
+
+    if strategy == 'zero':
+        fill_values = np.zeros(X.shape[1])
+    elif strategy == '-100':
+        fill_values = np.full(X.shape[1], -100.0)
+    else:
+        fill_values = np.array([received_data.get(mac_address, 0) for mac_address in mac_address_list],
+                               dtype=np.float64)
+
+    missing = np.isnan(X)
+    X[missing] = np.broadcast_to(fill_values, X.shape)[missing]
 
     return X
 
 
-def svm(X, X_new, y, kernel='rbf', C=1.0, gamma='scale'):
+def handle_missing_values_sparse(observed, mac_address_list, received_data, strategy='use_received'):
     """
-    Perform SVM to find the nearest room based on received data.
+    Handle missing values by attaching one implicit fill value per column.
 
     Parameters:
-    X (numpy.ndarray): Training data matrix.
-    X_new (numpy.ndarray): New data matrix.
+    observed (scipy.sparse.csr_matrix): CSR matrix of observed values.
+    mac_address_list (list): List of MAC addresses corresponding to the columns.
+    received_data (dict): Dictionary with new measurement data.
+    strategy (str): Strategy to handle missing values ('zero', '-100', 'use_received').
+
+    Returns:
+    SparseFingerprints: The matrix with fill values.
+    """
+    if strategy not in ['zero', '-100', 'use_received']:
+        raise ValueError("Strategy must be one of 'zero', '-100', or 'use_received'")
+
+    if strategy == 'zero':
+        fill_values = np.zeros(observed.shape[1])
+    elif strategy == '-100':
+        fill_values = np.full(observed.shape[1], -100.0)
+    else:
+        fill_values = np.array([received_data.get(mac_address, 0) for mac_address in mac_address_list],
+                               dtype=np.float64)
+
+    return SparseFingerprints(observed, fill_values)
+
+
+def fit_svm(X, y, kernel='rbf', C=1.0, gamma='scale', confidence='probability'):
+    """
+    Fit an SVM classifier on the training data.
+
+    Parameters:
+    X (numpy.ndarray or SparseFingerprints): Training data matrix.
     y (numpy.ndarray): Target labels.
     kernel (str): Kernel type to be used in the algorithm. Default is 'rbf'.
     C (float): Regularization parameter. Default is 1.0.
     gamma (str or float): Kernel coefficient for 'rbf', 'poly', and 'sigmoid'. Default is 'scale'.
+    confidence (str): 'probability' fits Platt scaling with an internal 5-fold cross-validation,
+                      'decision_function' skips it. Default is 'probability'.
 
     Returns:
-    tuple: Predicted room, the decision function distance, and the used gamma value.
+    SVC: The fitted SVM model.
     """
-    try:
+    if confidence not in SVM_CONFIDENCE_MODES:
+        raise ValueError(f"Invalid svm_confidence. Must be one of {SVM_CONFIDENCE_MODES}")
+    if confidence == 'probability':
         svm_model = SVC(kernel=kernel, C=C, probability=True, gamma=gamma)
-        svm_model.fit(X, y)
-        proba = svm_model.predict_proba(X_new)
-        top_index = np.argmax(proba, axis=1)[0]
-        distance = 1 - proba[0][top_index]
-        used_gamma = svm_model._gamma
-        print(f"Used gamma: {used_gamma}; Gamma Parameter: {gamma}")
-        return svm_model.classes_[top_index], distance, used_gamma
-    except Exception as e:
-        print(f"Error: {e}")
-        return []
+    else:
+        svm_model = SVC(kernel=kernel, C=C, gamma=gamma)
+    if isinstance(X, SparseFingerprints):
+        svm_model = ShiftedEstimator(svm_model)
+    svm_model.fit(X, y)
+    return svm_model
 
 
-def random_forest(X, X_new, y, n_estimators=100, max_depth=None, max_features='sqrt'):
+def softmax(values):
     """
-    Perform Random Forest to find the nearest room based on received data.
+    Compute the softmax of every row.
 
     Parameters:
-    X (numpy.ndarray): Training data matrix.
-    X_new (numpy.ndarray): New data matrix.
-    y (numpy.ndarray): Target labels.
-    n_estimators (int): The number of trees in the forest. Default is 100.
+    values (numpy.ndarray): Matrix of scores.
 
     Returns:
-    tuple: Predicted room and the decision function distance.
+    numpy.ndarray: Matrix of the same shape with rows summing to 1.
+    """
+    exponentials = np.exp(values - values.max(axis=1, keepdims=True))
+    return exponentials / exponentials.sum(axis=1, keepdims=True)
+
+
+def predict_svm(svm_model, X_new):
     """
+    Predict the rooms for all rows of X_new with a fitted SVM model.
 
-    # logging.basicConfig(level=logging.INFO)
-    # logger = logging.getLogger(__name__)
+    Models fitted with probability=True use the Platt scaled probabilities. Otherwise the confidence
+    is the softmax of the one-vs-rest decision function, which ranks the rooms like SVC.predict does.
 
-    try:
-        rf_model = RandomForestClassifier(n_estimators=n_estimators, max_depth=max_depth, max_features=max_features)
-        rf_model.fit(X, y)
-        # logger.info(f"Number of features: {rf_model.n_features_}")
-        proba = rf_model.predict_proba(X_new)
-        top_index = np.argmax(proba, axis=1)[0]
-        distance = proba[0][top_index]
-        return rf_model.classes_[top_index], distance
-    except Exception as e:
-        print(f"Error: {e}")
-        return []
+    Parameters:
+    svm_model (SVC): The fitted SVM model.
+    X_new (numpy.ndarray): New data matrix.
+
+    Returns:
+    list: One tuple of predicted room, the decision function distance, and the used gamma value per row.
+    """
+    # Newer scikit-learn versions default probability to a truthy 'deprecated' marker
+    if svm_model.probability is True:
+        proba = svm_model.predict_proba(X_new)
+    else:
+        decision = svm_model.decision_function(X_new)
+        if decision.ndim == 1:
+            # Two classes: the decision function is the score of the second class
+            decision = np.column_stack([-decision, decision])
+        proba = softmax(decision)
+    top_indices = np.argmax(proba, axis=1)
+    distances = 1 - proba[np.arange(proba.shape[0]), top_indices]
+    used_gamma = svm_model._gamma
+    return [(svm_model.classes_[top_index], distance, used_gamma)
+            for top_index, distance in zip(top_indices, distances)]
 
 
-def sorensen_distance(x, y):
+def fit_random_forest(X, y, n_estimators=100, max_depth=None, max_features='sqrt', n_jobs=None, random_state=None):
     """
-    Compute Sorensen distance between two arrays.
+    Fit a Random Forest classifier on the training data.
 
     Parameters:
-    x (numpy.ndarray): First array.
-    y (numpy.ndarray): Second array.
+    X (numpy.ndarray or SparseFingerprints): Training data matrix.
+    y (numpy.ndarray): Target labels.
+    n_estimators (int): The number of trees in the forest. Default is 100.
+    max_depth (int): The maximum depth of the trees. Default is None.
+    max_features (int, float or str): The number of features to consider for the best split. Default is 'sqrt'.
+    n_jobs (int): Number of trees trained in parallel. Default is None, which trains them one by one.
+    random_state (int): Seed for bootstrapping and feature sampling. Default is None.
 
     Returns:
-    float: Sorensen distance.
+    RandomForestClassifier: The fitted Random Forest model.
     """
-    return np.sum(np.abs(x - y)) / np.sum(np.abs(x) + np.abs(y))
+    rf_model = RandomForestClassifier(n_estimators=n_estimators, max_depth=max_depth, max_features=max_features,
+                                      n_jobs=n_jobs, random_state=random_state)
+    if isinstance(X, SparseFingerprints):
+        rf_model = ShiftedEstimator(rf_model)
+    rf_model.fit(X, y)
+    return rf_model
 
 
-def euclidean_distance(x_value, y_value):
+def predict_random_forest(rf_model, X_new):
     """
-    Compute Euclidean distance between two arrays.
+    Predict the rooms for all rows of X_new with a fitted Random Forest model.
 
     Parameters:
-    x_value (numpy.ndarray): First array.
-    y_value (numpy.ndarray): Second array.
+    rf_model (RandomForestClassifier): The fitted Random Forest model.
+    X_new (numpy.ndarray): New data matrix.
 
     Returns:
-    float: Euclidean distance.
+    list: One tuple of predicted room and the decision function distance per row.
     """
-    return np.sqrt(np.sum((x_value - y_value) ** 2))
+    proba = rf_model.predict_proba(X_new)
+    top_indices = np.argmax(proba, axis=1)
+    distances = proba[np.arange(proba.shape[0]), top_indices]
+    return [(rf_model.classes_[top_index], distance) for top_index, distance in zip(top_indices, distances)]
 
 
-def knn(X, X_new, y, n_neighbors=10, metric='euclidean', weights='distance'):
+def fit_knn(X, y, n_neighbors=10, metric='euclidean', weights='distance', index='brute', n_probes=8):
     """
-    Perform k-Nearest Neighbors to find the nearest room based on received data.
+    Fit a k-Nearest Neighbors classifier on the training data.
+
+    Distances are computed by FingerprintKNN on whole arrays instead of one Python call per pair of rows.
 
     Parameters:
-    X (numpy.ndarray): Training data matrix.
-    X_new (numpy.ndarray): New data matrix.
+    X (numpy.ndarray or SparseFingerprints): Training data matrix.
     y (numpy.ndarray): Target labels.
     n_neighbors (int): Number of neighbors to use. Default is 10.
-    metric (str): Metric to use for distance computation. Default is 'euclidean'.
+    metric (str): Metric to use for distance computation ('euclidean' or 'sorensen'). Default is 'euclidean'.
     weights (str): Weight function used in prediction. Default is 'distance'.
+    index (str): Neighbor index: 'brute' (full scan), 'tree' (exact) or 'ivf' (approximate). Default is 'brute'.
+    n_probes (int): Number of clusters searched per query by the 'ivf' index. Default is 8.
 
     Returns:
-    tuple: Predicted room and the distance to the nearest neighbor.
+    FingerprintKNN: The fitted kNN model.
     """
-    try:
-        if metric == 'sorensen':
-            knn_model = KNeighborsClassifier(n_neighbors=n_neighbors, metric=sorensen_distance, weights=weights)
-        else:
-            knn_model = KNeighborsClassifier(n_neighbors=n_neighbors, metric=euclidean_distance, weights=weights)
-
+    knn_model = FingerprintKNN(n_neighbors=n_neighbors, metric='sorensen' if metric == 'sorensen' else 'euclidean',
+                               weights=weights, index=index, n_probes=n_probes)
+    if isinstance(X, SparseFingerprints):
+        knn_model.fit(X.shifted(), y, fill=X.fill)
+    else:
         knn_model.fit(X, y)
-        proba = knn_model.predict_proba(X_new)
-        dist, indi = knn_model.kneighbors(X_new, n_neighbors=n_neighbors)
-        top_indices = np.argsort(proba, axis=1)[:, -n_neighbors:][0][::-1]
-        top_rooms = [(knn_model.classes_[i], proba[0][i]) for i in top_indices]
-        return top_rooms[0][0], dist[0][0]
-    except Exception as e:
-        print(f"Error: {e}")
-        return None, None
+    return knn_model
 
 
-def prepare_data(rooms):
+def predict_knn(knn_model, X_new):
     """
-    Prepare the data from the rooms dictionary for kNN.
+    Predict the rooms for all rows of X_new with a fitted kNN model, using the n_neighbors of the model.
 
     Parameters:
-    rooms (dict): Nested dictionary with room IDs and measurement IDs as keys, and lists of fingerprints as values.
+    knn_model (FingerprintKNN): The fitted kNN model.
+    X_new (numpy.ndarray): New data matrix.
 
     Returns:
-    tuple: Feature matrix, target labels, and list of unique MAC addresses.
+    list: One tuple of predicted room and the distance to the nearest neighbor per row.
     """
-    X = []
-    y = []
-    mac_address_list = []
-
-    for room_id, measurements in rooms.items():
-        for signals in measurements.values():
-            for signal in signals:
-                if signal['mac_address'] not in mac_address_list:
-                    mac_address_list.append(signal['mac_address'])
-
-    for room_id, measurements in rooms.items():
-        for signals in measurements.values():
-            features = [None] * len(mac_address_list)
-            for signal in signals:
-                index = mac_address_list.index(signal['mac_address'])
-                features[index] = signal['signal_strength']
-            X.append(features)
-            y.append(room_id)
-
-    return np.array(X), np.array(y), mac_address_list
+    predicted_rooms, distances = knn_model.predict_with_distance(X_new)
+    return list(zip(predicted_rooms, distances))
 
 
 def prepare_received_data(received_data, mac_address_list):
@@ -534,9 +508,10 @@ def prepare_received_data(received_data, mac_address_list):
     Returns:
     numpy.ndarray: Feature vector for the received data.
     """
-    features = [-100] * len(mac_address_list)
+    mac_address_index = {mac_address: index for index, mac_address in enumerate(mac_address_list)}
+    features = np.full((1, len(mac_address_list)), -100.0)
     for mac_address, signal_strength in received_data.items():
-        if mac_address in mac_address_list:
-            index = mac_address_list.index(mac_address)
-            features[index] = signal_strength
-    return np.array([features])
+        index = mac_address_index.get(mac_address)
+        if index is not None:
+            features[0, index] = signal_strength
+    return features
@@ -0,0 +1,61 @@
+import pytest
+
+import database_health
+from database_health import CircuitBreaker, DatabaseUnavailableError
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(database_health, "time", clock)
+    return clock
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert not breaker.is_open
+    assert breaker.allow_request()
+
+    breaker.record_failure()
+    assert breaker.is_open
+    with pytest.raises(DatabaseUnavailableError):
+        breaker.check()
+    assert breaker.stats()['opened'] == 1
+    assert breaker.stats()['rejected'] == 1
+
+
+def test_breaker_lets_one_trial_request_through_per_reset_timeout(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+    breaker.record_failure()
+
+    clock.now += 9
+    assert not breaker.allow_request()
+    clock.now += 1
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+
+    # The trial fails, so the breaker stays open for another reset_timeout
+    breaker.record_failure()
+    clock.now += 9
+    assert not breaker.allow_request()
+    clock.now += 1
+    assert breaker.allow_request()
+
+    breaker.record_success()
+    assert not breaker.is_open
+    assert breaker.allow_request()
+    assert breaker.allow_request()
+    assert breaker.stats()['opened'] == 1
@@ -0,0 +1,44 @@
+import pytest
+from sqlalchemy import select
+
+from ingestion import add_measurements_bulk
+from lookup_cache import lookup_cache
+from models import Measurement, MeasurementRouter, SessionLocal
+from schemas import MeasurementData, RouterData
+
+
+@pytest.fixture(autouse=True)
+def empty_lookup_cache():
+    lookup_cache.clear()
+
+
+def measurement(timestamp, room_name="A", routers=None):
+    if routers is None:
+        routers = [RouterData(ssid="eduroam", bssid="00:00:00:00:00:01", signal_strength=-50),
+                   RouterData(ssid="eduroam", bssid="00:00:00:00:00:02", signal_strength=-60)]
+    return MeasurementData(room_name=room_name, device_id="esp32", timestamp=timestamp, routers=routers)
+
+
+def test_bulk_ingestion_reports_a_status_per_item(database):
+    with SessionLocal() as db:
+        existing_id = add_measurements_bulk(db, [measurement(1)])[0]["measurement_id"]
+
+    with SessionLocal() as db:
+        results = add_measurements_bulk(db, [
+            measurement(2),
+            measurement(1),
+            measurement(2, room_name="B"),
+            measurement(3, routers=[]),
+            measurement(4, room_name="B")
+        ])
+
+    assert [result["status"] for result in results] == ["created", "exists", "duplicate", "invalid", "created"]
+    assert [result["index"] for result in results] == [0, 1, 2, 3, 4]
+    assert results[1]["measurement_id"] == existing_id
+    created_ids = [results[0]["measurement_id"], results[4]["measurement_id"]]
+    with SessionLocal() as db:
+        stored_ids = db.execute(select(Measurement.measurement_id)).scalars().all()
+        assert sorted(stored_ids) == sorted([existing_id] + created_ids)
+        signals = db.execute(select(MeasurementRouter.measurement_id)
+                             .where(MeasurementRouter.measurement_id.in_(created_ids))).scalars().all()
+        assert len(signals) == 4
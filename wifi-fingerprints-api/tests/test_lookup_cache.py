@@ -0,0 +1,25 @@
+from sqlalchemy import event, select
+from sqlalchemy.dialects import mysql
+
+from lookup_cache import LookupCache
+from models import Router, SessionLocal
+
+
+def test_same_new_bssid_inserted_from_two_sessions_gets_one_id(database):
+    cache = LookupCache()
+    statements = []
+    with SessionLocal() as first, SessionLocal() as second:
+        event.listen(first, "do_orm_execute", lambda state: statements.append(state.statement))
+        # The first session has already read, like the measurement lookup of a bulk ingestion
+        first.execute(select(Router.router_id)).all()
+
+        second_ids = cache.get_router_ids(second, {"00:00:00:00:00:01": "eduroam"})
+        second.commit()
+        first_ids = cache.get_router_ids(first, {"00:00:00:00:00:01": "eduroam"})
+        first.commit()
+
+    assert first_ids == second_ids
+    with SessionLocal() as db:
+        assert db.execute(select(Router.router_id)).scalars().all() == [second_ids["00:00:00:00:00:01"]]
+    # The read-back has to lock, so under REPEATABLE READ it sees the row committed by the second session
+    assert "LOCK IN SHARE MODE" in str(statements[-1].compile(dialect=mysql.dialect()))
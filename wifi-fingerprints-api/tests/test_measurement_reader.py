@@ -0,0 +1,76 @@
+import json
+from datetime import datetime
+
+import pytest
+from fastapi.testclient import TestClient
+
+from main import app
+from measurement_reader import fetch_all_measurements, fetch_measurement, stream_measurements
+from models import Room, Router, Measurement, MeasurementRouter, SessionLocal
+
+
+@pytest.fixture
+def measurements(database):
+    with SessionLocal() as db:
+        db.add_all([Room(room_id=1, room_name="A"), Room(room_id=2, room_name="B")])
+        db.add_all([Router(router_id=router_id, ssid=f"ssid{router_id}", bssid=f"00:00:00:00:00:0{router_id}")
+                    for router_id in (1, 2, 3)])
+        for measurement_id in range(1, 8):
+            db.add(Measurement(measurement_id=measurement_id, timestamp=datetime.fromtimestamp(1000 + measurement_id),
+                               device_id="esp32", room_id=1 + measurement_id % 2))
+            # Measurement 7 has no routers
+            for router_id in range(1, 4) if measurement_id < 7 else ():
+                if (measurement_id + router_id) % 3:
+                    db.add(MeasurementRouter(measurement_id=measurement_id, router_id=router_id,
+                                             signal_strength=-40 - 10 * router_id))
+        db.commit()
+
+
+def fetch_measurements_one_by_one(db):
+    # The reads before the joined query: one query for the routers of each measurement and one per router
+    result = []
+    for measurement in db.query(Measurement).order_by(Measurement.measurement_id):
+        routers = []
+        for measurement_router in db.query(MeasurementRouter).filter_by(measurement_id=measurement.measurement_id):
+            router = db.query(Router).filter_by(router_id=measurement_router.router_id).first()
+            routers.append({'bssid': router.bssid, 'ssid': router.ssid,
+                            'signal_strength': measurement_router.signal_strength})
+        result.append({
+            'measurement_id': measurement.measurement_id,
+            'timestamp': int(measurement.timestamp.timestamp()),
+            'device_id': measurement.device_id,
+            'room_id': measurement.room_id,
+            'room_name': db.query(Room).filter_by(room_id=measurement.room_id).first().room_name,
+            'routers': routers
+        })
+    return result
+
+
+def test_joined_reads_return_the_same_measurements(measurements):
+    with SessionLocal() as db:
+        expected = fetch_measurements_one_by_one(db)
+        assert fetch_all_measurements(db) == expected
+        assert [fetch_measurement(db, measurement['measurement_id']) for measurement in expected] == expected
+        assert fetch_measurement(db, 100) is None
+    assert expected[-1]['routers'] == []
+
+
+def read_stream(**kwargs):
+    lines = "".join(stream_measurements(**kwargs)).splitlines()
+    return [json.loads(line) for line in lines]
+
+
+def test_stream_resumes_after_the_last_received_measurement(measurements):
+    with SessionLocal() as db:
+        all_measurements = fetch_all_measurements(db)
+
+    assert read_stream(page_size=3) == all_measurements
+    first_part = read_stream(limit=4, page_size=3)
+    assert first_part == all_measurements[:4]
+    assert read_stream(after_id=first_part[-1]['measurement_id'], page_size=3) == all_measurements[4:]
+
+
+@pytest.mark.parametrize("query", ["limit=0", "limit=-1", "after_id=-1"])
+def test_invalid_cursor_parameters_are_rejected(measurements, query):
+    response = TestClient(app).get(f"/measurements/all?{query}")
+    assert response.status_code == 422
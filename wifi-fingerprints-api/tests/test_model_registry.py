@@ -0,0 +1,25 @@
+import pickle
+
+import numpy as np
+import pytest
+from sklearn.ensemble import RandomForestClassifier
+
+from model_registry import estimate_model_size
+from neighbors import FingerprintKNN
+from utils import fit_svm
+
+rng = np.random.default_rng(0)
+X = rng.uniform(-100, -30, size=(500, 40))
+y = rng.integers(0, 8, size=500)
+
+
+@pytest.mark.parametrize("model", [
+    FingerprintKNN(index='brute').fit(X, y),
+    FingerprintKNN(index='tree').fit(X, y),
+    FingerprintKNN(index='ivf').fit(X, y),
+    fit_svm(X, y),
+    RandomForestClassifier(n_estimators=10, random_state=0).fit(X, y)
+], ids=['knn_brute', 'knn_tree', 'knn_ivf', 'svm', 'random_forest'])
+def test_estimate_model_size_is_close_to_pickled_size(model):
+    pickled_size = len(pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL))
+    assert 0.9 * pickled_size <= estimate_model_size(model) <= 1.1 * pickled_size
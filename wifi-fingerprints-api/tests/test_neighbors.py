@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from neighbors import FingerprintKNN
+
+X = np.array([[0.0, 1.0], [0.1, 0.9], [1.0, 0.0], [0.9, 0.2]])
+y = np.array([1, 1, 2, 2])
+
+
+@pytest.mark.parametrize("index", ['brute', 'tree', 'ivf'])
+def test_fit_rejects_non_finite_training_data(index):
+    with pytest.raises(ValueError):
+        FingerprintKNN(n_neighbors=2, index=index).fit(np.vstack([X, [[np.nan, 0.0]]]), np.append(y, 1))
+
+
+@pytest.mark.parametrize("index", ['brute', 'tree', 'ivf'])
+def test_kneighbors_rejects_non_finite_queries(index):
+    model = FingerprintKNN(n_neighbors=2, index=index).fit(X, y)
+    with pytest.raises(ValueError):
+        model.kneighbors(np.array([[np.nan, np.nan]]))
+    with pytest.raises(ValueError):
+        model.predict_with_distance(np.array([[np.inf, 0.0]]))
+
+
+def test_predict_with_distance_matches_predict():
+    model = FingerprintKNN(n_neighbors=3, weights='distance').fit(X, y)
+    X_new = np.array([[0.05, 0.95], [0.8, 0.1]])
+    predicted_rooms, distances = model.predict_with_distance(X_new)
+    assert predicted_rooms.tolist() == model.predict(X_new).tolist() == [1, 2]
+    assert np.allclose(distances, model.kneighbors(X_new)[0][:, 0])
+
+
+def test_tied_class_probabilities_pick_the_first_class():
+    model = FingerprintKNN(n_neighbors=2).fit(np.array([[-50.0, -60.0], [-60.0, -50.0]]), np.array([2, 1]))
+    X_new = np.array([[-55.0, -55.0]])
+    assert model.predict_proba(X_new).tolist() == [[0.5, 0.5]]
+    predicted_rooms, _ = model.predict_with_distance(X_new)
+    assert predicted_rooms.tolist() == model.predict(X_new).tolist() == [1]
+
+
+@pytest.mark.parametrize("metric", ['euclidean', 'sorensen'])
+def test_kneighbors_excluding_matches_model_without_the_row(metric):
+    rng = np.random.default_rng(0)
+    X_fit = rng.uniform(-100, -30, size=(30, 6))
+    y_fit = rng.integers(1, 4, size=30)
+    model = FingerprintKNN(n_neighbors=3, metric=metric).fit(X_fit, y_fit)
+    distances, indices = model.kneighbors_excluding(X_fit, np.arange(30))
+    for row in range(30):
+        others = np.delete(np.arange(30), row)
+        fold_model = FingerprintKNN(n_neighbors=3, metric=metric).fit(X_fit[others], y_fit[others])
+        fold_distances, fold_indices = fold_model.kneighbors(X_fit[row:row + 1])
+        assert np.allclose(distances[row], fold_distances[0])
+        assert indices[row].tolist() == others[fold_indices[0]].tolist()
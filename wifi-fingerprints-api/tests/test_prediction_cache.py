@@ -0,0 +1,54 @@
+import pytest
+
+import prediction_cache as prediction_cache_module
+from prediction_cache import PredictionCache
+from schemas import PredictConfig
+
+SCAN = {"00:00:00:00:00:01": -51, "00:00:00:00:00:02": -67}
+RESULT = {"room_name": "A", "distance": 0.5, "optional_value": -1}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(prediction_cache_module, "time", clock)
+    return clock
+
+
+def test_entry_expires_after_ttl(clock):
+    cache = PredictionCache(max_entries=10, ttl=30)
+    key = cache.make_key(1, PredictConfig(), SCAN)
+    cache.put(key, RESULT)
+
+    clock.now += 29
+    assert cache.get(key) == RESULT
+    clock.now += 1
+    assert cache.get(key) is None
+    assert (cache.hits, cache.misses, cache.expired) == (1, 1, 1)
+
+
+def test_new_dataset_version_and_clear_invalidate_entries(clock):
+    cache = PredictionCache(max_entries=10, ttl=30)
+    cache.put(cache.make_key(1, PredictConfig(), SCAN), RESULT)
+
+    assert cache.get(cache.make_key(2, PredictConfig(), SCAN)) is None
+    assert cache.get(cache.make_key(1, PredictConfig(k_value=7), SCAN)) is None
+    assert cache.get(cache.make_key(1, PredictConfig(), SCAN)) == RESULT
+    cache.clear()
+    assert cache.get(cache.make_key(1, PredictConfig(), SCAN)) is None
+
+
+def test_rounded_scans_share_an_entry(clock):
+    cache = PredictionCache(max_entries=10, ttl=30, rssi_step=5)
+    cache.put(cache.make_key(1, PredictConfig(), SCAN), RESULT)
+    assert cache.get(cache.make_key(1, PredictConfig(), {"00:00:00:00:00:01": -49, "00:00:00:00:00:02": -66})) \
+        == RESULT
+    assert cache.get(cache.make_key(1, PredictConfig(), {"00:00:00:00:00:01": -49})) is None
@@ -0,0 +1,55 @@
+import numpy as np
+
+from fingerprint_matrix import FingerprintMatrix
+from room_centroids import RoomCentroids
+
+# measurement_id: (room_id, {router_id: signal_strength})
+MEASUREMENTS = {
+    1: (1, {1: -50, 2: -80}),
+    2: (1, {1: -90, 2: -40}),
+    3: (2, {1: -60, 2: -75}),
+    4: (3, {1: -52, 2: -78, 3: -95})
+}
+QUERY = {"00:00:00:00:00:01": -50, "00:00:00:00:00:02": -80}
+
+
+def fingerprint_rows(measurement_ids):
+    return [
+        {'measurement_id': measurement_id, 'room_id': MEASUREMENTS[measurement_id][0], 'device_id': "esp32",
+         'router_id': router_id, 'bssid': f"00:00:00:00:00:0{router_id}", 'ssid': "eduroam",
+         'signal_strength': signal_strength}
+        for measurement_id in measurement_ids
+        for router_id, signal_strength in MEASUREMENTS[measurement_id][1].items()
+    ]
+
+
+def fingerprint_matrix(measurement_ids):
+    return FingerprintMatrix.from_rows(fingerprint_rows(measurement_ids))
+
+
+def test_ranking_with_ignored_rows_equals_ranking_without_them():
+    matrix = fingerprint_matrix([1, 2, 3, 4])
+    centroids = RoomCentroids.from_matrix(matrix)
+    assert centroids.rank(matrix, QUERY, 3) == [3, 2, 1]
+
+    ignore_rows = [matrix.row_index[2]]
+    remaining = fingerprint_matrix([1, 3, 4])
+    expected = RoomCentroids.from_matrix(remaining).rank(remaining, QUERY, 3)
+    assert centroids.rank(matrix, QUERY, 3, ignore_rows) == expected == [1, 3, 2]
+    # The centroids of the snapshot are not changed
+    assert centroids.rank(matrix, QUERY, 3) == [3, 2, 1]
+
+
+def test_room_without_remaining_rows_is_no_candidate():
+    matrix = fingerprint_matrix([1, 2, 3, 4])
+    centroids = RoomCentroids.from_matrix(matrix)
+    assert centroids.rank(matrix, QUERY, 3, [matrix.row_index[4]]) == [2, 1]
+
+
+def test_appended_centroids_equal_recomputed_centroids():
+    matrix = fingerprint_matrix([1, 3])
+    appended_matrix = matrix.append(fingerprint_rows([2, 4]))
+    appended = RoomCentroids.from_matrix(matrix).append(appended_matrix, matrix.X.shape[0])
+    recomputed = RoomCentroids.from_matrix(appended_matrix)
+    np.testing.assert_array_equal(appended.room_ids, recomputed.room_ids)
+    np.testing.assert_allclose(appended.centroids, recomputed.centroids)
@@ -0,0 +1,87 @@
+from datetime import datetime
+
+import numpy as np
+
+from fingerprint_matrix import FingerprintMatrix
+from models import Base, Room, Router, Measurement, MeasurementRouter, MeasurementChange, SessionLocal, engine
+from shared_matrix import SharedMatrixStore
+from snapshot import FingerprintSnapshotStore, ensure_generation
+
+ROWS = [
+    {'measurement_id': 1, 'room_id': 1, 'device_id': "esp32", 'router_id': 1, 'bssid': "00:00:00:00:00:01",
+     'ssid': "eduroam", 'signal_strength': -50},
+    {'measurement_id': 2, 'room_id': 2, 'device_id': "esp32", 'router_id': 2, 'bssid': "00:00:00:00:00:02",
+     'ssid': "eduroam", 'signal_strength': -60}
+]
+
+
+def create_change_log():
+    # Recreating the tables restarts the change IDs at 1 in a new generation
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    with SessionLocal() as db:
+        db.add(Room(room_id=1, room_name="A"))
+        db.add(Router(router_id=1, ssid="eduroam", bssid="00:00:00:00:00:01"))
+        db.commit()
+        ensure_generation(db)
+
+
+def commit_measurement(measurement_id):
+    with SessionLocal() as db:
+        db.add(Measurement(measurement_id=measurement_id, timestamp=datetime.fromtimestamp(measurement_id),
+                           device_id="esp32", room_id=1))
+        db.add(MeasurementRouter(measurement_id=measurement_id, router_id=1, signal_strength=-50))
+        db.add(MeasurementChange(measurement_id=measurement_id, change_type='add'))
+        db.commit()
+
+
+def measurement_ids(store):
+    with SessionLocal() as db:
+        return sorted(store.get(db).matrix.measurement_ids.tolist())
+
+
+def test_published_matrix_is_attached_for_its_generation(tmp_path):
+    shared = SharedMatrixStore(str(tmp_path))
+    matrix = FingerprintMatrix.from_rows(ROWS)
+    with shared.lock():
+        shared.publish(matrix, {1: "A", 2: "B"}, "g1", 5, {4: 0.0})
+        attached = shared.attach("g1", 5)
+        assert shared.attach("g2", 5) is None
+        assert shared.attach("g1", 6) is None
+        assert shared.attach("g1", 5, required_change_ids=[4]) is None
+
+    attached_matrix, room_names, change_id, missing_change_ids = attached
+    np.testing.assert_array_equal(attached_matrix.X, matrix.X)
+    np.testing.assert_array_equal(attached_matrix.measurement_ids, matrix.measurement_ids)
+    assert attached_matrix.mac_address_list == matrix.mac_address_list
+    assert (room_names, change_id, missing_change_ids) == ({1: "A", 2: "B"}, 5, {4: 0.0})
+    assert shared.attached == 1
+
+
+def test_worker_attaches_the_matrix_published_by_another_worker(tmp_path):
+    create_change_log()
+    for measurement_id in (1, 2):
+        commit_measurement(measurement_id)
+    worker = FingerprintSnapshotStore(sync_interval=0, shared=SharedMatrixStore(str(tmp_path)))
+    assert measurement_ids(worker) == [1, 2]
+
+    other_worker = FingerprintSnapshotStore(sync_interval=0, shared=SharedMatrixStore(str(tmp_path)))
+    assert measurement_ids(other_worker) == [1, 2]
+    assert (worker.loads, other_worker.loads) == (1, 0)
+    assert other_worker.shared.attached == 1
+
+
+def test_shared_matrix_of_recreated_change_log_is_not_attached(tmp_path):
+    create_change_log()
+    for measurement_id in range(2, 6):
+        commit_measurement(measurement_id)
+    worker = FingerprintSnapshotStore(sync_interval=0, shared=SharedMatrixStore(str(tmp_path)))
+    assert measurement_ids(worker) == [2, 3, 4, 5]
+
+    # The tables are recreated, so the change IDs restart below the published change ID
+    create_change_log()
+    for measurement_id in (7, 8):
+        commit_measurement(measurement_id)
+    other_worker = FingerprintSnapshotStore(sync_interval=0, shared=SharedMatrixStore(str(tmp_path)))
+    assert measurement_ids(other_worker) == [7, 8]
+    assert other_worker.loads == 1
@@ -0,0 +1,103 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from fingerprint_matrix import FingerprintMatrix
+from models import Room, Router, Measurement, MeasurementRouter, MeasurementChange, SessionLocal
+from shared_matrix import SharedMatrixStore
+from snapshot import FingerprintSnapshotStore, load_fingerprint_rows
+
+
+def add_rooms_and_routers():
+    with SessionLocal() as db:
+        db.add_all([Room(room_id=1, room_name="A"), Room(room_id=2, room_name="B")])
+        db.add_all([Router(router_id=router_id, ssid="eduroam", bssid=f"00:00:00:00:00:0{router_id}")
+                    for router_id in (1, 2, 3)])
+        db.commit()
+
+
+@pytest.fixture
+def store(database):
+    add_rooms_and_routers()
+    return FingerprintSnapshotStore(sync_interval=0, shared=SharedMatrixStore(""))
+
+
+def commit_measurement(measurement_id, change_id, room_id=1, signals=None):
+    with SessionLocal() as db:
+        db.add(Measurement(measurement_id=measurement_id, timestamp=datetime.fromtimestamp(measurement_id),
+                           device_id="esp32", room_id=room_id))
+        for router_id, signal_strength in (signals or {1: -50}).items():
+            db.add(MeasurementRouter(measurement_id=measurement_id, router_id=router_id,
+                                     signal_strength=signal_strength))
+        db.add(MeasurementChange(change_id=change_id, measurement_id=measurement_id, change_type='add'))
+        db.commit()
+
+
+def measurement_ids(store):
+    with SessionLocal() as db:
+        return sorted(store.get(db).matrix.measurement_ids.tolist())
+
+
+def test_appended_matrix_equals_full_rebuild(store):
+    commit_measurement(1, 1, signals={1: -50})
+    assert measurement_ids(store) == [1]
+    commit_measurement(2, 2, room_id=2, signals={1: -60, 2: -70})
+    assert measurement_ids(store) == [1, 2]
+    commit_measurement(3, 3, signals={2: -65, 3: -80})
+    commit_measurement(4, 4, room_id=2, signals={3: -75})
+
+    with SessionLocal() as db:
+        appended = store.get(db).matrix
+        rebuilt = FingerprintMatrix.from_rows(load_fingerprint_rows(db))
+    assert store.loads == 1
+    assert store.appends == 2
+    np.testing.assert_array_equal(appended.X, rebuilt.X)
+    np.testing.assert_array_equal(appended.positions, rebuilt.positions)
+    np.testing.assert_array_equal(appended.y, rebuilt.y)
+    np.testing.assert_array_equal(appended.measurement_ids, rebuilt.measurement_ids)
+    np.testing.assert_array_equal(appended.router_ids, rebuilt.router_ids)
+    assert appended.device_ids == rebuilt.device_ids
+    assert appended.mac_address_list == rebuilt.mac_address_list
+    assert appended.ssids == rebuilt.ssids
+
+
+def test_change_committed_out_of_order_is_appended(store):
+    commit_measurement(1, 1)
+    assert measurement_ids(store) == [1]
+
+    # The writer of change 2 commits after the writer of change 3
+    commit_measurement(3, 3)
+    assert measurement_ids(store) == [1, 3]
+    commit_measurement(4, 2)
+    assert measurement_ids(store) == [1, 3, 4]
+    assert store.loads == 1
+
+
+def test_change_committed_out_of_order_with_lower_measurement_id_reloads(store):
+    commit_measurement(1, 1)
+    assert measurement_ids(store) == [1]
+
+    commit_measurement(3, 3)
+    assert measurement_ids(store) == [1, 3]
+    commit_measurement(2, 2)
+    assert measurement_ids(store) == [1, 2, 3]
+
+
+def test_gap_found_by_full_load_is_awaited(store):
+    commit_measurement(1, 1)
+    commit_measurement(3, 3)
+    assert measurement_ids(store) == [1, 3]
+
+    commit_measurement(4, 2)
+    assert measurement_ids(store) == [1, 3, 4]
+
+
+def test_expired_gap_is_not_awaited(store, monkeypatch):
+    monkeypatch.setattr("snapshot.SNAPSHOT_GAP_TIMEOUT", 0)
+    commit_measurement(1, 1)
+    commit_measurement(3, 3)
+    assert measurement_ids(store) == [1, 3]
+
+    commit_measurement(4, 2)
+    assert measurement_ids(store) == [1, 3]